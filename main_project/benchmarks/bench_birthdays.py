@@ -0,0 +1,81 @@
+"""
+upcoming birthdays among 1M users: birthday_day range scans (users.birthdays) against matching
+month and day of every birthday (a full scan, what the query would be without the stored column)
+"""
+import datetime
+import random
+import tempfile
+import time
+from pathlib import Path
+
+from common import setup_django, measure, print_table
+
+USERS = 1_000_000
+BATCH = 20_000
+
+directory = tempfile.TemporaryDirectory()
+setup_django(str(Path(directory.name) / 'bench.sqlite3'))
+
+from django.db import connection, transaction  # noqa: E402
+
+from users.birthdays import celebration_dates, upcoming_birthdays  # noqa: E402
+from users.models import day_of_year  # noqa: E402
+
+
+def populate():
+    random.seed(1)
+    first = datetime.date(1950, 1, 1).toordinal()
+    with transaction.atomic(), connection.cursor() as cursor:
+        for start in range(0, USERS, BATCH):
+            rows = []
+            for number in range(start, start + BATCH):
+                birthday = datetime.date.fromordinal(first + random.randrange(365 * 55))
+                email = f'{number}@mail.ru'
+                rows.append(('f', 'l', '', '1', email, email, '', birthday.isoformat(), False, '',
+                             day_of_year(birthday)))
+            cursor.executemany('INSERT INTO users_myuser (first_name, last_name, other_name, password, email, '
+                               'email_normalized, phone, birthday, is_admin, additional_info, birthday_day) '
+                               'VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)', rows)
+        cursor.execute('ANALYZE')
+
+
+def scan(start, days, size):
+    """
+    the same window without birthday_day: month and day of every live user are compared
+    """
+    month_days = [(datetime.date(2000, 1, 1) + datetime.timedelta(days=day - 1)).strftime('%m-%d')
+                  for day in celebration_dates(start, days)]  # of birthdays, Feb 29 ones included
+    placeholders = ', '.join(['%s'] * len(month_days))
+    where = f"deleted_at IS NULL AND strftime('%%m-%%d', birthday) IN ({placeholders})"
+    with connection.cursor() as cursor:
+        cursor.execute(f'SELECT COUNT(*) FROM users_myuser WHERE {where}', month_days)
+        total = cursor.fetchone()[0]
+        cursor.execute(f'SELECT id FROM users_myuser WHERE {where} LIMIT %s', [*month_days, size])
+        return total, cursor.fetchall()
+
+
+def main():
+    began = time.perf_counter()
+    populate()
+    print(f'{USERS} users inserted in {time.perf_counter() - began:.0f} s')
+
+    rows = []
+    for title, start in [('7 days from Jun 10', datetime.date(2027, 6, 10)),
+                         ('7 days from Dec 28 (wraps)', datetime.date(2027, 12, 28)),
+                         ('7 days from Feb 27 (Feb 29)', datetime.date(2027, 2, 27))]:
+        def indexed():
+            pages = upcoming_birthdays(start, 7)
+            return len(pages), pages.page(0, 100)
+
+        def full_scan():
+            return scan(start, 7, 100)
+
+        assert indexed()[0] == full_scan()[0]
+        rows.append([title, indexed()[0], '%.2f' % (measure(indexed, repeat=3, number=5) * 1e3),
+                     '%.2f' % (measure(full_scan, repeat=3, number=2) * 1e3)])
+
+    print_table(['window', 'users', 'birthday_day index, ms', 'full scan, ms'], rows)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,45 @@
+"""
+requests per second of user detail endpoints without detail cache (every request misses)
+and with it (L1 hits, L2 hits after L1 is dropped)
+"""
+from common import setup_django, measure, print_table
+
+setup_django(database=':memory:')
+
+from django.core.cache import cache  # noqa: E402
+from django.test import Client  # noqa: E402
+from users.detail_cache import get_detail_cache  # noqa: E402
+from users.models import MyUser  # noqa: E402
+
+PATHS = ['/users/private/users/2', '/users/current']
+
+
+def main():
+    admin = MyUser.objects.create(email='admin@mail.ru', password='password', first_name='mario', is_admin=True)
+    MyUser.objects.create(email='2@mail.ru', first_name='luigi', additional_info='x' * 200)
+    client = Client(HTTP_HOST='localhost')  # allowed with DEBUG and empty ALLOWED_HOSTS
+    client.cookies['userid'] = admin.id
+    detail_cache = get_detail_cache()
+
+    def uncached():
+        detail_cache.clear()
+        cache.clear()
+        assert client.get(path).status_code == 200
+
+    def l2_hit():
+        detail_cache.clear()
+        assert client.get(path).status_code == 200
+
+    def l1_hit():
+        assert client.get(path).status_code == 200
+
+    rows = []
+    for path in PATHS:
+        results = [1 / measure(func, number=300) for func in (uncached, l2_hit, l1_hit)]
+        rows.append([path, *('%.0f' % result for result in results), '%.2fx' % (results[2] / results[0])])
+
+    print_table(['path', 'no cache, rps', 'L2 hit, rps', 'L1 hit, rps', 'speedup'], rows)
+
+
+if __name__ == '__main__':
+    main()
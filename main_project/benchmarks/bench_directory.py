@@ -0,0 +1,67 @@
+"""
+memory per user of the short directory kept as model instances, as short model dicts and as DirectorySnapshot,
+and time to build a UserList page from the database and from the snapshot
+"""
+import random
+import sys
+import tracemalloc
+
+from common import setup_django, measure, print_table
+
+setup_django(database=':memory:')
+
+from users.directory import DirectorySnapshot  # noqa: E402
+from users.models import MyUser  # noqa: E402
+
+USERS = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+FIRST_NAMES = ['Ivan', 'Petr', 'Anna', 'Maria', 'Olga', 'Sergey', 'Dmitry', 'Elena', 'Alexey', 'Natalia']
+LAST_NAMES = ['Ivanov', 'Petrov', 'Sidorov', 'Smirnov', 'Kuznetsov', 'Popov', 'Vasiliev', 'Sokolov']
+
+
+def allocated(build):
+    tracemalloc.start()
+    value = build()
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del value
+    return size
+
+
+def main():
+    random.seed(1)
+    MyUser.objects.bulk_create(
+        [MyUser(first_name=random.choice(FIRST_NAMES), last_name=random.choice(LAST_NAMES),
+                email=f'user{i}@mail.ru', email_normalized=f'user{i}@mail.ru') for i in range(USERS)],
+        batch_size=5000)
+
+    def snapshot():
+        directory = DirectorySnapshot()
+        directory.refresh(0, 0)
+        return directory
+
+    builders = [
+        ('model instances', lambda: list(MyUser.objects.only('id', 'first_name', 'last_name', 'email'))),
+        ('short model dicts', lambda: [user.get_short_user_model() for user in MyUser.objects.all()]),
+        ('DirectorySnapshot', snapshot),
+    ]
+    print_table(['representation', 'bytes per user'],
+                [[name, '%.0f' % (allocated(build) / USERS)] for name, build in builders])
+    print()
+
+    directory = snapshot()
+    start = USERS // 2
+
+    def from_db():
+        return [user.get_short_user_model() for user in MyUser.objects.all()[start:start + 50]]
+
+    def from_snapshot():
+        return directory.page(start, start + 50)
+
+    assert from_db() == from_snapshot()
+    print_table(['page of 50 from', 'us per page'],
+                [[name, '%.1f' % (measure(func, number=200) * 1e6)]
+                 for name, func in [('database', from_db), ('snapshot', from_snapshot)]])
+
+
+if __name__ == '__main__':
+    main()
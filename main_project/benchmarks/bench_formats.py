@@ -0,0 +1,49 @@
+"""
+encode/decode cost of json vs msgpack vs cbor for a UserList page and a PrivateUser detail
+"""
+import datetime
+import json
+
+from common import setup_django, measure, print_table
+
+setup_django()
+
+from django.core.serializers.json import DjangoJSONEncoder  # noqa: E402
+from users.renderers import MessagePackRenderer, CBORRenderer, msgpack, cbor2  # noqa: E402
+
+
+def user_page(size):
+    return {
+        'data': [{'id': i, 'first_name': 'first%d' % i, 'last_name': 'last%d' % i, 'email': '%d@mail.ru' % i}
+                 for i in range(size)],
+        'meta': {'pagination': {'total': size, 'page': 1, 'size': size}},
+    }
+
+
+def private_user():
+    return {'id': 1, 'first_name': 'mario', 'last_name': 'super', 'other_name': 'some_other', 'email': 'a@mail.ru',
+            'phone': '+79990000000', 'birthday': datetime.date(2020, 8, 8), 'is_admin': False, 'city': 3,
+            'additional_info': 'x' * 100}
+
+
+def main():
+    formats = [('json', lambda data: json.dumps(data, cls=DjangoJSONEncoder).encode('utf-8'), json.loads)]
+    if msgpack is not None:
+        formats.append(('msgpack', MessagePackRenderer().render, lambda raw: msgpack.unpackb(raw, raw=False)))
+    if cbor2 is not None:
+        formats.append(('cbor', CBORRenderer().render, cbor2.loads))
+
+    rows = []
+    for payload_name, payload, number in [('UserList page of 100', user_page(100), 200),
+                                          ('PrivateUser', private_user(), 5000)]:
+        for name, encode, decode in formats:
+            raw = encode(payload)
+            rows.append([payload_name, name, len(raw),
+                         '%.2f' % (measure(lambda: encode(payload), number=number) * 1e6),
+                         '%.2f' % (measure(lambda: decode(raw), number=number) * 1e6)])
+
+    print_table(['payload', 'format', 'bytes', 'encode, us', 'decode, us'], rows)
+
+
+if __name__ == '__main__':
+    main()
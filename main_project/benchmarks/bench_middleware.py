@@ -0,0 +1,68 @@
+"""
+requests per second of api endpoints with the full middleware stack and drf session authentication (before)
+and with the lean profile for /users/ (after)
+"""
+from common import setup_django, measure, print_table
+
+setup_django(database=':memory:')
+
+from django.conf import settings  # noqa: E402
+from django.core.handlers.wsgi import WSGIHandler  # noqa: E402
+from django.test import RequestFactory, override_settings  # noqa: E402
+from users.models import MyUser  # noqa: E402
+from users.throttling import get_login_throttle  # noqa: E402
+
+FULL_MIDDLEWARE = [
+    'django.middleware.security.SecurityMiddleware',
+    'users.middleware.CompressionMiddleware',
+    'django.contrib.sessions.middleware.SessionMiddleware',
+    'django.middleware.common.CommonMiddleware',
+    'django.middleware.csrf.CsrfViewMiddleware',
+    'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'django.contrib.messages.middleware.MessageMiddleware',
+    'django.middleware.clickjacking.XFrameOptionsMiddleware',
+]
+FULL_REST_FRAMEWORK = {
+    **settings.REST_FRAMEWORK,
+    'DEFAULT_AUTHENTICATION_CLASSES': ['rest_framework.authentication.SessionAuthentication',
+                                       'rest_framework.authentication.BasicAuthentication'],
+}
+CASES = [
+    ('GET /users/current', lambda factory: factory.get('/users/current')),
+    ('GET /users/users', lambda factory: factory.get('/users/users?page=1&size=10')),
+    ('POST /users/login', lambda factory: factory.post('/users/login', content_type='application/json',
+                                                       data={'login': 'admin@mail.ru', 'password': 'password'})),
+]
+
+
+def main():
+    admin = MyUser.objects.create(email='admin@mail.ru', password='password', first_name='mario', is_admin=True)
+    throttle = {**settings.USERS_LOGIN_THROTTLE, 'IP_RATE': (10 ** 9, 1), 'LOGIN_RATE': (10 ** 9, 1)}
+    factory = RequestFactory(HTTP_HOST='localhost', HTTP_COOKIE=f'userid={admin.id}')
+    profiles = [
+        override_settings(MIDDLEWARE=FULL_MIDDLEWARE, REST_FRAMEWORK=FULL_REST_FRAMEWORK, USERS_LOGIN_THROTTLE=throttle),
+        override_settings(USERS_LOGIN_THROTTLE=throttle),
+    ]
+
+    results = {}
+    for _ in range(3):  # profiles take turns, so both of them see the same machine load
+        for number, profile in enumerate(profiles):
+            with profile:
+                get_login_throttle.cache_clear()  # built from the overridden rates
+                handler = WSGIHandler()  # loads MIDDLEWARE of the profile
+                for name, build in CASES:
+                    def request():
+                        environ = build(factory).environ
+                        return handler(environ, lambda status, headers: None)
+
+                    assert handler.get_response(build(factory)).status_code == 200
+                    best = measure(request, number=300)
+                    results[name, number] = min(results.get((name, number), best), best)
+
+    print_table(['request', 'full stack, us', 'lean, us', 'saved, us'],
+                [[name, '%.0f' % (results[name, 0] * 1e6), '%.0f' % (results[name, 1] * 1e6),
+                  '%.0f' % ((results[name, 0] - results[name, 1]) * 1e6)] for name, _ in CASES])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,40 @@
+"""
+time to get a UserList page at different depths with offset pagination and with the page boundary index
+"""
+import sys
+import tempfile
+from pathlib import Path
+
+from common import setup_django, measure, print_table
+
+setup_django(database=':memory:')
+
+from users.models import MyUser  # noqa: E402
+from users.page_index import PageIndex  # noqa: E402
+from users.utils import QuerysetPages  # noqa: E402
+
+USERS = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+SIZE = 50
+
+
+def main():
+    MyUser.objects.bulk_create([MyUser(first_name='f', last_name='l', email=f'user{i}@mail.ru',
+                                       email_normalized=f'user{i}@mail.ru') for i in range(USERS)], batch_size=5000)
+    offset_pages = QuerysetPages(MyUser.objects.all())
+    with tempfile.TemporaryDirectory() as directory:
+        index = PageIndex(str(Path(directory) / 'index.bin'), step=100, refresh_interval=60)
+        index.rebuild()
+
+        rows = []
+        for depth in [0.0, 0.5, 0.99]:
+            start = int(USERS * depth)
+            assert offset_pages.page(start, start + SIZE) == index.page(start, start + SIZE)
+            results = [measure(lambda: pages.page(start, start + SIZE), number=50) * 1000
+                       for pages in (offset_pages, index)]
+            rows.append([start, '%.2f' % results[0], '%.2f' % results[1], '%.1fx' % (results[0] / results[1])])
+
+    print_table(['offset', 'OFFSET query, ms', 'page index, ms', 'speedup'], rows)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,68 @@
+"""
+validations per second for serializers of write views, with fields built on every instantiation (before)
+and with precompiled fields (after)
+"""
+from common import setup_django, measure, print_table
+
+setup_django(database=':memory:')
+
+from rest_framework import serializers  # noqa: E402
+from users.models import City, MyUser  # noqa: E402
+from users.serialisers import LoginModelSerializer, PrivateCreateUserModelSerializer, \
+    PrivateUpdateUserModelSerializer, UpdateUserModelSerializer, PrecompiledFieldsMixin  # noqa: E402
+
+city = City.objects.create(name='Москва')  # city ids are checked against existing cities
+
+CASES = [
+    (LoginModelSerializer, {'login': 'admin@mail.ru', 'password': 'password'}),
+    (PrivateCreateUserModelSerializer, {'first_name': 'f', 'last_name': 'l', 'email': 'e@m.ru', 'is_admin': True,
+                                        'password': '123', 'phone': '+7999', 'city': city.id}),
+    (PrivateUpdateUserModelSerializer, {'first_name': 'Luigi', 'birthday': '2020-08-08', 'is_admin': False}),
+    (UpdateUserModelSerializer, {'first_name': 'Luigi', 'phone': '+7999'}),
+]
+
+
+class LegacyLoginModelSerializer(LoginModelSerializer, serializers.ModelSerializer):
+    """
+    login serializer as it was: model serializer without fields, validated twice by the view
+    """
+
+    class Meta:
+        model = MyUser
+        fields = []
+
+    def is_valid(self, raise_exception=False):
+        super().is_valid()
+        return super().is_valid()
+
+
+def before(serializer_class):
+    if serializer_class is LoginModelSerializer:
+        return LegacyLoginModelSerializer
+    if not issubclass(serializer_class, PrecompiledFieldsMixin):
+        return serializer_class
+
+    class Uncompiled(serializer_class):
+        def get_fields(self):
+            return super(PrecompiledFieldsMixin, self).get_fields()
+
+    return Uncompiled
+
+
+def main():
+    rows = []
+    for serializer_class, data in CASES:
+        results = []
+        for variant in (before(serializer_class), serializer_class):
+            def validate():
+                assert variant(data=data).is_valid()
+
+            results.append(1 / measure(validate, number=500))
+        rows.append([serializer_class.__name__, '%.0f' % results[0], '%.0f' % results[1],
+                     '%.2fx' % (results[1] / results[0])])
+
+    print_table(['serializer', 'before, validations/s', 'after, validations/s', 'speedup'], rows)
+
+
+if __name__ == '__main__':
+    main()
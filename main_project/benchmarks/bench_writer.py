@@ -0,0 +1,83 @@
+"""
+user creation throughput on a sqlite file with several worker processes of several threads each,
+with and without the single writer (USERS_WRITE_COORDINATOR)
+"""
+import multiprocessing
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+from common import setup_django, print_table
+
+PROCESSES = 4
+THREADS = 8
+WRITES = 50  # per thread
+
+directory = tempfile.TemporaryDirectory()
+setup_django(str(Path(directory.name) / 'bench.sqlite3'))
+
+from django.conf import settings  # noqa: E402
+from django.db import connections  # noqa: E402
+from django.test import Client, override_settings  # noqa: E402
+
+from users.models import MyUser  # noqa: E402
+from users.writer import get_write_coordinator  # noqa: E402
+
+
+def worker(process, admin_id, coordinator, results):
+    get_write_coordinator.cache_clear()
+    config = {**settings.USERS_WRITE_COORDINATOR, 'ENABLED': coordinator,
+              'LOCK_PATH': str(Path(directory.name) / 'writer.lock')}
+    statuses = []
+
+    def run(thread):
+        client = Client(HTTP_HOST='localhost', raise_request_exception=False)
+        client.cookies['userid'] = admin_id
+        for number in range(WRITES):
+            data = {'first_name': 'f', 'last_name': 'l', 'is_admin': False, 'password': '1',
+                    'email': f'{coordinator}-{process}-{thread}-{number}@mail.ru'}
+            statuses.append(client.post('/users/private/users', data=data, content_type='application/json').status_code)
+        connections.close_all()
+
+    with override_settings(USERS_WRITE_COORDINATOR=config):
+        threads = [threading.Thread(target=run, args=(thread,)) for thread in range(THREADS)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    results.put((statuses.count(201), len(statuses) - statuses.count(201)))
+
+
+def run(admin_id, coordinator):
+    context = multiprocessing.get_context('fork')
+    results = context.Queue()
+    connections.close_all()  # children must open their own connections
+    processes = [context.Process(target=worker, args=(process, admin_id, coordinator, results))
+                 for process in range(PROCESSES)]
+    start = time.perf_counter()
+    for process in processes:
+        process.start()
+    counts = [results.get() for _ in processes]
+    elapsed = time.perf_counter() - start
+    for process in processes:
+        process.join()
+
+    created, failed = sum(count[0] for count in counts), sum(count[1] for count in counts)
+    return created / elapsed, failed
+
+
+def main():
+    admin = MyUser.objects.create(email='admin@mail.ru', password='password', first_name='mario', is_admin=True)
+    rows = []
+    for coordinator in [False, True]:
+        writes_per_second, failed = run(admin.id, coordinator)
+        rows.append(['single writer' if coordinator else 'direct', '%.0f' % writes_per_second, failed])
+
+    print(f'{PROCESSES} processes x {THREADS} threads x {WRITES} creates')
+    print_table(['writes', 'created/s', 'failed'], rows)
+
+
+if __name__ == '__main__':
+    main()
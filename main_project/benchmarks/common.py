@@ -0,0 +1,47 @@
+"""
+helpers shared by benchmark scripts, run them from main_project directory:
+    python benchmarks/bench_<name>.py
+"""
+import os
+import sys
+import time
+from pathlib import Path
+
+
+def setup_django(database=None):
+    """
+    database is a path of sqlite file (or ':memory:') to migrate and use instead of db.sqlite3
+    """
+    sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'main_project.settings')
+
+    if database is not None:
+        from main_project import settings
+        settings.DATABASES['default']['NAME'] = database
+
+    import django
+    django.setup()
+
+    if database is not None:
+        from django.core.management import call_command
+        call_command('migrate', verbosity=0)
+
+
+def measure(func, repeat=5, number=1000):
+    """
+    best time of `repeat` runs, in seconds per call
+    """
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(number):
+            func()
+        best = min(best, (time.perf_counter() - start) / number)
+
+    return best
+
+
+def print_table(header, rows):
+    widths = [max(len(str(row[i])) for row in [header, *rows]) for i in range(len(header))]
+    for row in [header, *rows]:
+        print('  '.join(str(cell).ljust(width) for cell, width in zip(row, widths)))
@@ -13,4 +13,16 @@ from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'main_project.settings')
 
-application = get_asgi_application()
+django_application = get_asgi_application()
+
+from users.sse import user_events_app  # noqa: E402 needs configured django
+
+
+async def application(scope, receive, send):
+    """
+    live user events are served by a streaming ASGI app, everything else by django
+    """
+    if scope['type'] == 'http' and scope['path'] == '/users/events':
+        await user_events_app(scope, receive, send)
+    else:
+        await django_application(scope, receive, send)
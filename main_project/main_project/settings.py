@@ -41,15 +41,34 @@ INSTALLED_APPS = [
     'drf_yasg',
 ]
 
+REST_FRAMEWORK = {
+    # msgpack and cbor are used only when the optional packages are installed
+    'DEFAULT_RENDERER_CLASSES': [
+        'rest_framework.renderers.JSONRenderer',
+        'users.renderers.MessagePackRenderer',
+        'users.renderers.CBORRenderer',
+    ],
+    'DEFAULT_PARSER_CLASSES': [
+        'rest_framework.parsers.JSONParser',
+        'users.parsers.MessagePackParser',
+        'users.parsers.CBORParser',
+    ],
+    'DEFAULT_CONTENT_NEGOTIATION_CLASS': 'users.negotiation.AvailableContentNegotiation',
+    # api views authorize by `userid` cookie themselves (users.utils.try_authorization)
+    'DEFAULT_AUTHENTICATION_CLASSES': [],
+}
+
 SESSION_ENGINE = "django.contrib.sessions.backends.signed_cookies"
 
 MIDDLEWARE = [
     'django.middleware.security.SecurityMiddleware',
-    'django.contrib.sessions.middleware.SessionMiddleware',
+    'users.middleware.CompressionMiddleware',
+    # the next four are skipped for USERS_LEAN_MIDDLEWARE_PATHS (api), admin and swagger get them as usual
+    'users.middleware.LeanSessionMiddleware',
     'django.middleware.common.CommonMiddleware',
-    'django.middleware.csrf.CsrfViewMiddleware',
-    'django.contrib.auth.middleware.AuthenticationMiddleware',
-    'django.contrib.messages.middleware.MessageMiddleware',
+    'users.middleware.LeanCsrfViewMiddleware',
+    'users.middleware.LeanAuthenticationMiddleware',
+    'users.middleware.LeanMessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
 
@@ -81,9 +100,11 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': BASE_DIR / 'db.sqlite3',
-    }
+    },
 }
 
+DATABASE_ROUTERS = ['users.routers.UserShardRouter']
+
 
 # Password validation
 # https://docs.djangoproject.com/en/4.0/ref/settings/#auth-password-validators
@@ -125,3 +146,144 @@ STATIC_URL = 'static/'
 # https://docs.djangoproject.com/en/4.0/ref/settings/#default-auto-field
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
+
+
+# Cache
+# https://docs.djangoproject.com/en/4.0/topics/cache/
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    }
+}
+
+
+# Login throttling, rates are (attempts, per seconds)
+# set BACKEND to 'users.throttling.CacheBucketBackend' to share limits between workers through CACHES
+
+USERS_LOGIN_THROTTLE = {
+    'BACKEND': 'users.throttling.LocMemBucketBackend',
+    'OPTIONS': {},
+    'IP_RATE': (30, 60),
+    'LOGIN_RATE': (5, 60),
+}
+
+# seconds to remember logins which don't belong to any user (users.caching). They are kept in CACHES,
+# it must be shared between workers (e.g. redis) when there are several of them: a worker forgets the login
+# when it creates such user, others would refuse it until the timeout. 0 turns remembering off
+USERS_MISSING_LOGIN_TIMEOUT = 60
+
+# Response compression for api (users.middleware.CompressionMiddleware)
+
+USERS_COMPRESSION_PATHS = ['/users/']
+USERS_COMPRESSION_MIN_SIZE = 1024
+
+# bodies of write requests larger than this are rejected with 413 before being read
+USERS_MAX_BODY_SIZE = 64 * 1024
+
+# Change feed (/users/changes) and webhooks (manage.py dispatch_webhooks)
+
+USERS_CHANGES_MAX_LIMIT = 1000
+USERS_CHANGES_MAX_WAIT = 30
+USERS_CHANGES_POLL_INTERVAL = 1.0
+# seconds a missing seq is waited for before readers skip it (see users.changes.committed_changes),
+# must be longer than any transaction writing users
+USERS_CHANGES_SETTLE_TIME = 10
+# `manage.py prune_user_changes` keeps changes for this many seconds, it must be longer than
+# USERS_DETAIL_CACHE timeout as cached details are keyed by the last change of the user
+USERS_CHANGES_RETENTION = 30 * 24 * 60 * 60
+USERS_WEBHOOK_TIMEOUT = 5
+USERS_WEBHOOK_MAX_RETRY_DELAY = 300
+
+# Live user events for admins (/users/events, ASGI only)
+
+USERS_EVENTS_BROKER = 'users.events.LocalBroker'
+USERS_EVENTS_COALESCE_WINDOW = 0.5
+USERS_EVENTS_KEEPALIVE = 15
+
+# Background jobs for admins (/users/private/jobs, manage.py run_jobs)
+
+USERS_JOBS_BATCH_SIZE = 500
+USERS_JOBS_MAX_LIMIT = 1000
+
+# Cache of rendered user details (users.detail_cache): in-process LRU (L1) in front of CACHES (L2).
+# User versions are kept in CACHES, it must be shared between workers (e.g. redis) when there are several of them,
+# otherwise workers notice changes made by others only after TIMEOUT seconds
+
+USERS_DETAIL_CACHE = {
+    'L1_MAX_ENTRIES': 1024,
+    'TIMEOUT': 300,
+    'LOCK_TIMEOUT': 1.0,
+}
+
+# In-process index of cities for /users/cities autocomplete (users.cities), reloaded on city changes
+# and every RELOAD_INTERVAL seconds
+
+USERS_CITY_INDEX = {
+    'RELOAD_INTERVAL': 60,
+}
+
+# most cities returned by one /users/cities request
+USERS_CITIES_MAX_LIMIT = 100
+
+# most users returned by one ?ids= request of user lists
+USERS_BATCH_MAX_IDS = 100
+
+# In-process snapshot of the short user directory serving UserList pages without queries (users.directory).
+# It follows the change outbox every REFRESH_INTERVAL seconds and is rebuilt from the table every RELOAD_INTERVAL
+
+USERS_DIRECTORY_SNAPSHOT = {
+    'ENABLED': False,
+    'REFRESH_INTERVAL': 1.0,
+    'RELOAD_INTERVAL': 600,
+}
+
+# Page boundary index for id ordered UserList pages (users.page_index), a memory-mapped file shared by workers.
+# Used when the directory snapshot is off, rebuild it with manage.py rebuild_page_index after bulk changes
+
+USERS_PAGE_INDEX = {
+    'ENABLED': False,
+    'PATH': BASE_DIR / 'users_page_index.bin',
+    'STEP': 100,
+    'REFRESH_INTERVAL': 1.0,
+}
+
+# Single writer for sqlite deployments (users.writer): user writes of views are committed in batches by one thread
+# per process under a file lock shared by all workers, instead of competing for the database lock.
+# MAX_DELAY is how long (seconds) the writer waits for more writes to join a batch
+
+USERS_WRITE_COORDINATOR = {
+    'ENABLED': False,
+    'LOCK_PATH': BASE_DIR / 'users_writer.lock',
+    'MAX_BATCH': 100,
+    'MAX_DELAY': 0,
+}
+
+# Last activity of users (users.activity): authorized requests are buffered per process and written
+# by one UPDATE per BATCH_SIZE users after a request, once FLUSH_INTERVAL seconds passed since the previous write
+
+USERS_ACTIVITY = {
+    'ENABLED': True,
+    'FLUSH_INTERVAL': 5.0,
+    'BATCH_SIZE': 500,
+}
+
+# url prefixes served without session, csrf, auth and messages middleware
+USERS_LEAN_MIDDLEWARE_PATHS = ['/users/']
+
+# Horizontal sharding of users (users.sharding): users_myuser rows are spread over SHARDS (aliases added
+# to DATABASES, each one migrated with `manage.py migrate --database`), users_usershard in DIRECTORY maps user ids
+# and emails to shards and allocates ids. Run `manage.py rebalance_user_shards` after changing SHARDS.
+# One shard means no sharding, main_project/test_settings.py adds shard databases for the tests
+
+USERS_SHARDING = {
+    'SHARDS': ['default'],
+    'DIRECTORY': 'default',
+}
+
+# Users not seen for INACTIVE_FOR seconds are moved to the archive table by the `archive` job
+# or `manage.py archive_inactive_users` (users.archive)
+
+USERS_ARCHIVE = {
+    'INACTIVE_FOR': 2 * 365 * 24 * 60 * 60,
+}
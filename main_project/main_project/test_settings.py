@@ -0,0 +1,17 @@
+"""
+settings of `manage.py test`: the default ones with two more databases, so users.tests covers sharding.
+Test databases of sqlite are in memory, nothing is written next to db.sqlite3
+"""
+from .settings import *  # noqa: F401,F403
+
+DATABASES = {
+    **DATABASES,  # noqa: F405
+    'users_shard_1': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': BASE_DIR / 'users_shard_1.sqlite3',  # noqa: F405
+    },
+    'users_shard_2': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': BASE_DIR / 'users_shard_2.sqlite3',  # noqa: F405
+    },
+}
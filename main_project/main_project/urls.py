@@ -1,6 +1,7 @@
 from django.contrib import admin
 from django.urls import path, include
 from rest_framework import permissions
+from rest_framework.authentication import SessionAuthentication
 from drf_yasg.views import get_schema_view
 from drf_yasg import openapi
 
@@ -13,7 +14,8 @@ schema_view = get_schema_view(
         contact=openapi.Contact(email='innozokh@yandex.ru')
     ),
     public=True,
-    permission_classes=[permissions.AllowAny]
+    permission_classes=[permissions.AllowAny],
+    authentication_classes=[SessionAuthentication],  # swagger ui shows django login state
 )
 
 urlpatterns = [
@@ -6,7 +6,9 @@ import sys
 
 def main():
     """Run administrative tasks."""
-    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'main_project.settings')
+    # tests run with databases for shards of users as well
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE',
+                          'main_project.test_settings' if sys.argv[1:2] == ['test'] else 'main_project.settings')
     try:
         from django.core.management import execute_from_command_line
     except ImportError as exc:
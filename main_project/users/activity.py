@@ -0,0 +1,104 @@
+"""
+last activity of users (MyUser.last_seen_at). Authorized requests only touch an in-process buffer, which keeps
+the latest timestamp per user. When a request is finished and FLUSH_INTERVAL passed since the last flush,
+the buffer is written out by one UPDATE per BATCH_SIZE users; the rest is written on process exit.
+So the column lags behind by FLUSH_INTERVAL (or more for idle workers)
+"""
+import atexit
+import logging
+import threading
+import time
+from functools import lru_cache
+
+from django.conf import settings
+from django.core.signals import request_finished
+from django.db.models import Case, F, Q, When
+from django.utils import timezone
+
+from .models import MyUser
+from .sharding import get_shards
+from .writer import run_write
+
+logger = logging.getLogger(__name__)
+
+
+class ActivityBuffer:
+    def __init__(self, batch_size):
+        self.batch_size = batch_size
+        self.flushed_at = time.monotonic()
+        self._seen = {}
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+
+    def touch(self, user_id, at=None):
+        at = at or timezone.now()
+        with self._lock:
+            if user_id not in self._seen or self._seen[user_id] < at:
+                self._seen[user_id] = at
+
+    def pending(self):
+        with self._lock:
+            return len(self._seen)
+
+    def flush_if_due(self, flush_interval):
+        """
+        when other thread is flushing already, buffered timestamps wait for the next time
+        """
+        if time.monotonic() - self.flushed_at < flush_interval or not self._flush_lock.acquire(blocking=False):
+            return
+        try:
+            self.flush()
+        finally:
+            self._flush_lock.release()
+
+    def flush(self):
+        """
+        writes buffered timestamps, timestamp of a user never moves back, so flushes of several processes
+        may overlap. Returns number of users in written batches
+        """
+        with self._lock:
+            seen, self._seen = self._seen, {}
+        self.flushed_at = time.monotonic()
+
+        items = list(seen.items())
+        written = 0
+        try:
+            for start in range(0, len(items), self.batch_size):
+                batch = items[start:start + self.batch_size]
+                last_seen_at = Case(*[When(Q(id=user_id) & (Q(last_seen_at__isnull=True) | Q(last_seen_at__lt=at)),
+                                           then=at) for user_id, at in batch],
+                                    default=F('last_seen_at'))
+                for shard in get_shards():  # one shard unless users are sharded
+                    run_write(lambda: MyUser.objects.using(shard).filter(id__in=[user_id for user_id, _ in batch])
+                              .update(last_seen_at=last_seen_at))
+                written += len(batch)
+        except Exception:
+            logger.warning('flushing activity of %s users failed', len(items) - written, exc_info=True)
+            for user_id, at in items[written:]:  # kept for the next flush
+                self.touch(user_id, at)
+
+        return written
+
+
+@lru_cache(maxsize=None)
+def get_activity_buffer():
+    return ActivityBuffer(settings.USERS_ACTIVITY['BATCH_SIZE'])
+
+
+@atexit.register
+def _flush_at_exit():
+    if get_activity_buffer.cache_info().currsize:  # dropped buffers (get_activity_buffer.cache_clear()) are discarded
+        get_activity_buffer().flush()
+
+
+def touch_user(user):
+    if settings.USERS_ACTIVITY['ENABLED']:
+        get_activity_buffer().touch(user.id)
+
+
+def _flush_after_request(**kwargs):
+    if settings.USERS_ACTIVITY['ENABLED']:
+        get_activity_buffer().flush_if_due(settings.USERS_ACTIVITY['FLUSH_INTERVAL'])
+
+
+request_finished.connect(_flush_after_request, dispatch_uid='users.activity')
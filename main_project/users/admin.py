@@ -1,3 +1,13 @@
 from django.contrib import admin
+from .models import Job, WebhookSubscription
 
-# Register your models here.
+
+@admin.register(WebhookSubscription)
+class WebhookSubscriptionAdmin(admin.ModelAdmin):
+    list_display = ('url', 'is_active', 'last_seq', 'failures', 'retry_at')
+
+
+@admin.register(Job)
+class JobAdmin(admin.ModelAdmin):
+    list_display = ('id', 'kind', 'status', 'progress', 'total', 'created_at', 'finished_at')
+    list_filter = ('status', 'kind')
@@ -1,6 +1,21 @@
 from django.apps import AppConfig
+from django.db.models.signals import post_migrate
+
+
+def _install_stat_triggers(using, **kwargs):
+    from django.db import connections
+    from .stats import install_triggers
+
+    install_triggers(connections[using])  # sqlite drops them when a migration remakes users_myuser
 
 
 class UsersConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'users'
+
+    def ready(self):
+        from . import cities  # noqa: F401, connects receivers invalidating the city index
+        from . import city_names  # noqa: F401, connects the receiver clearing names of deleted cities
+        from . import sharding  # noqa: F401, connects receivers copying cities to shards
+
+        post_migrate.connect(_install_stat_triggers, sender=self)
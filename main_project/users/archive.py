@@ -0,0 +1,108 @@
+"""
+hot/cold split of users. Users not seen (MyUser.last_seen_at) for longer than USERS_ARCHIVE['INACTIVE_FOR']
+are moved in batches to users_archiveduser by the `archive` job or `manage.py archive_inactive_users`,
+so users_myuser and its indexes hold active users only. Archived users keep their id and are still counted
+in stats, but are left out of lists and birthdays. /users/private/users/{id} reads them from the archive,
+they are moved back on login or when an admin changes them. Users from before activity tracking count as seen
+when the archive was installed (migration 0015), users never seen since they were created aren't archived.
+An archived user whose email was taken by a new user stays archived until an admin gives it a new email.
+Archiving isn't supported with sharding: archived users and their lookups live in the default database only
+"""
+from django.core.exceptions import ImproperlyConfigured
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+
+from .changes import record_change
+from .models import ArchivedUser, MyUser, UserChange, is_email_conflict, normalize_email
+from .sharding import is_sharded
+
+
+def archive_inactive_users(batch_size, inactive_for, max_batches=None):
+    """
+    moves users inactive for `inactive_for` (timedelta) in small transactions, least recently seen first.
+    Returns number of archived users
+    """
+    if is_sharded():
+        raise ImproperlyConfigured('users aren\'t archived while USERS_SHARDING has several shards')
+
+    cutoff = timezone.now() - inactive_for
+    archived = 0
+    batches = 0
+    while max_batches is None or batches < max_batches:
+        with transaction.atomic():
+            users = list(MyUser.objects.filter(last_seen_at__lt=cutoff).order_by('last_seen_at')
+                         .select_for_update()[:batch_size])
+            if not users:
+                break
+            now = timezone.now()
+            ArchivedUser.objects.bulk_create([ArchivedUser.from_user(user, now) for user in users])
+            MyUser.all_objects.filter(id__in=[user.id for user in users]).delete()
+            for user in users:
+                record_change(UserChange.ARCHIVED, user)
+
+        archived += len(users)
+        batches += 1
+
+    return archived
+
+
+def load_user(users, user_id):
+    """
+    user from `users` loader or from the archive, raises MyUser.DoesNotExist when it's in neither
+    """
+    user = users.load(user_id) or ArchivedUser.objects.filter(id=user_id).first()
+    if user is None:
+        raise MyUser.DoesNotExist(f'MyUser {user_id} doesn\'t exist')
+
+    return user
+
+
+def move_back(archived, email=None):
+    """
+    moves the archived user back to users_myuser as seen now, with `email` instead of its own one if given.
+    Returns the user, None when it was restored concurrently. Raises IntegrityError when the email was taken
+    by a new user
+    """
+    with transaction.atomic():
+        if not ArchivedUser.objects.filter(id=archived.id).delete()[0]:
+            return None
+        user = archived.to_user()
+        if email is not None:
+            user.email = email
+        user.last_seen_at = timezone.now()  # or the next archive run moves it back
+        user.save(force_insert=True)
+        record_change(UserChange.RESTORED, user)
+
+    return user
+
+
+def restore_user(archived):
+    """
+    moves the archived user back, None when its email was taken by a new user or it was restored concurrently
+    """
+    try:
+        return move_back(archived)
+    except IntegrityError as error:
+        if not is_email_conflict(error):
+            raise
+        return None
+
+
+def restore_by_id(user_id):
+    archived = ArchivedUser.objects.filter(id=user_id).first()
+
+    return None if archived is None else restore_user(archived)
+
+
+def get_archived_by_login(login):
+    """
+    the most recently archived user with this login, None if there is none
+    """
+    return ArchivedUser.objects.filter(email_normalized=normalize_email(login)).order_by('-archived_at').first()
+
+
+def delete_archived_user(user_id):
+    """
+    archived users aren't soft-deleted, their rows are removed at once. Returns whether there was one
+    """
+    return bool(ArchivedUser.objects.filter(id=user_id).delete()[0])
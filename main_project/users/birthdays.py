@@ -0,0 +1,61 @@
+"""
+upcoming birthdays. Users are found by MyUser.birthday_day (models.day_of_year), which is the same every year,
+so a window of days is one range scan of users_myuser_birthday_day_idx, or two when it wraps from December
+to January. Birthdays on Feb 29 are celebrated on Feb 28 in non-leap years
+"""
+import calendar
+import datetime
+
+from .models import MyUser, day_of_year
+from .sharding import ShardedPages, is_sharded
+from .utils import ChainPages, QuerysetPages
+
+FEB_29 = 60
+MAX_DAYS = 365  # longer windows would contain some birthdays twice
+
+
+def celebration_dates(start, days):
+    """
+    {birthday_day: date it is celebrated on} for dates start .. start + days - 1, ordered by date.
+    `days` must not exceed MAX_DAYS
+    """
+    dates = {}
+    for offset in range(days):
+        date = start + datetime.timedelta(days=offset)
+        dates[day_of_year(date)] = date
+        if date.month == 2 and date.day == 28 and not calendar.isleap(date.year):
+            dates[FEB_29] = date
+
+    return dates
+
+
+def day_ranges(days):
+    """
+    birthday_day numbers ordered by date -> [(first, last)] ranges of consecutive numbers
+    """
+    ranges = []
+    for day in days:
+        if ranges and ranges[-1][1] + 1 == day:
+            ranges[-1] = (ranges[-1][0], day)
+        else:
+            ranges.append((day, day))
+
+    return ranges
+
+
+def upcoming_birthdays(start, days):
+    """
+    pages of users celebrating birthday in the window ordered by date it's celebrated on, then by id.
+    Rows are short user models with birthday and next_birthday (the date in the window)
+    """
+    dates = celebration_dates(start, days)
+
+    def serialize(user):
+        return {**user.get_short_user_model(), 'birthday': user.birthday, 'next_birthday': dates[user.birthday_day]}
+
+    def pages(users):
+        if is_sharded():
+            return ShardedPages(users, ['birthday_day', 'id'], serialize)  # merged from every shard
+        return QuerysetPages(users.order_by('birthday_day', 'id'), serialize)
+
+    return ChainPages([pages(MyUser.objects.filter(birthday_day__range=day_range)) for day_range in day_ranges(dates)])
@@ -0,0 +1,31 @@
+import hashlib
+
+from django.conf import settings
+from django.core.cache import cache
+
+
+def _login_hash(login):
+    return hashlib.sha1(login.encode('utf-8')).hexdigest()
+
+
+def _missing_login_key(login):
+    return 'users:missing-login:' + _login_hash(login)
+
+
+def is_missing_login(login):
+    """
+    true if we recently looked this login up and there was no such user.
+    All login functions here expect normalized email (see models.normalize_email)
+    """
+    return cache.get(_missing_login_key(login)) is not None
+
+
+def remember_missing_login(login):
+    cache.set(_missing_login_key(login), 1, timeout=settings.USERS_MISSING_LOGIN_TIMEOUT)
+
+
+def forget_missing_login(login):
+    """
+    must be called whenever user with this login appears (creation or email change)
+    """
+    cache.delete(_missing_login_key(login))
@@ -0,0 +1,116 @@
+import datetime
+import threading
+import time
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Max
+from django.utils import timezone
+
+from .caching import forget_missing_login
+from .detail_cache import get_detail_cache
+from .events import publish_event
+from .models import UserChange
+
+_new_changes = threading.Condition()
+
+
+def record_change(action, user):
+    """
+    every user mutation must go through here (or record_deletion) inside the mutating transaction,
+    so the outbox row is committed (or rolled back) together with the change itself
+    """
+    if action == UserChange.DELETED:
+        return record_deletion(user.id)
+
+    change = UserChange.objects.create(user_id=user.id, action=action, data=user.get_privateDetailUserResponseModel())
+    email_normalized = user.email_normalized
+    # after commit, or a login in between would find no user and remember the login as missing again
+    transaction.on_commit(lambda: forget_missing_login(email_normalized))
+    _after_commit(change)
+
+    return change
+
+
+def record_deletion(user_id, archived=False):
+    """
+    deletions only need user id, so callers don't have to load the user. Deleting an archived user is
+    recorded as ERASED: it has left lists on ARCHIVED already
+    """
+    action = UserChange.ERASED if archived else UserChange.DELETED
+    change = UserChange.objects.create(user_id=user_id, action=action, data=None)
+    _after_commit(change)
+
+    return change
+
+
+def _after_commit(change):
+    # cached responses of the user are keyed by its last seq, readers switch to new ones once data is committed
+    transaction.on_commit(lambda: get_detail_cache().bump(change.user_id, change.id))
+    transaction.on_commit(_notify_waiters)
+    transaction.on_commit(lambda: publish_event(change.get_change_model()))
+
+
+def _notify_waiters():
+    with _new_changes:
+        _new_changes.notify_all()
+
+
+def committed_changes(since, limit):
+    """
+    up to `limit` changes with seq greater than `since` in seq order, readers of the feed and webhooks continue
+    from the last one. Seqs are taken on insert but become visible on commit, so on postgres a lower seq may
+    commit after a higher one was read: reading stops before a missing seq until the change following it is
+    USERS_CHANGES_SETTLE_TIME seconds old, then the seq is taken for one of a rolled back transaction
+    """
+    changes = list(UserChange.objects.filter(id__gt=since).order_by('id')[:limit])
+    settled_at = timezone.now() - datetime.timedelta(seconds=settings.USERS_CHANGES_SETTLE_TIME)
+    expected = since + 1
+    for i, change in enumerate(changes):
+        if change.id != expected and change.created_at > settled_at:
+            return changes[:i]
+        expected = change.id + 1
+
+    return changes
+
+
+def get_changes(since, limit, wait=0):
+    """
+    changes with seq greater than `since`. If there are none, waits up to `wait` seconds for new ones:
+    waiters in this process are woken up on commit, changes made by other processes are noticed
+    by re-checking every USERS_CHANGES_POLL_INTERVAL seconds
+    """
+    deadline = time.monotonic() + wait
+    while True:
+        changes = committed_changes(since, limit)
+        remaining = deadline - time.monotonic()
+        if changes or remaining <= 0:
+            return changes
+
+        with _new_changes:
+            _new_changes.wait(min(remaining, settings.USERS_CHANGES_POLL_INTERVAL))
+
+
+def prune_changes(batch_size, older_than, max_batches=None):
+    """
+    removes changes older than `older_than` (timedelta) in small transactions, readers which are further behind
+    continue from the oldest kept one (after the settle time if it's a recent one).
+    The newest change is always kept, so seqs never go back.
+    Returns number of removed changes
+    """
+    cutoff = timezone.now() - older_than
+    newest = UserChange.objects.aggregate(seq=Max('id'))['seq']
+    pruned = 0
+    batches = 0
+    while max_batches is None or batches < max_batches:
+        with transaction.atomic():
+            ids = list(UserChange.objects.filter(created_at__lt=cutoff).exclude(id=newest).order_by('id')
+                       .values_list('id', flat=True)[:batch_size])
+            if not ids:
+                break
+            UserChange.objects.filter(id__in=ids).delete()
+
+        pruned += len(ids)
+        batches += 1
+
+    return pruned
@@ -0,0 +1,113 @@
+"""
+in-process index of cities sorted by name for autocomplete (/users/cities?prefix=) and id lookups.
+Saving or deleting a city through the ORM invalidates the index of this process and bumps the version kept
+in CACHES on commit, so other workers reload theirs too. Besides, the index is reloaded every RELOAD_INTERVAL
+seconds to pick up bulk changes and changes of workers with a not shared cache
+"""
+import bisect
+import threading
+import time
+import uuid
+from functools import lru_cache
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from .models import City
+
+_VERSION_KEY = 'users:cities-version'
+
+
+def _version():
+    version = cache.get(_VERSION_KEY)
+    if version is None:  # never set or evicted, every process reloads once
+        cache.add(_VERSION_KEY, uuid.uuid4().hex, timeout=None)
+        version = cache.get(_VERSION_KEY)
+
+    return version
+
+
+def search_key(name):
+    return name.strip().casefold()
+
+
+class CityIndex:
+    def __init__(self):
+        self.version = None
+        self.loaded_at = 0
+        self._data = ([], [], {})  # sorted search keys, city models in the same order, id -> city model by id
+        self._lock = threading.Lock()
+
+    def refresh(self, reload_interval):
+        version = _version()
+        if version == self.version and time.monotonic() - self.loaded_at < reload_interval:
+            return
+        with self._lock:
+            if version != self.version or time.monotonic() - self.loaded_at >= reload_interval:
+                self._load(version)
+
+    def _load(self, version):
+        cities = sorted(({'id': city_id, 'name': name} for city_id, name in City.objects.values_list('id', 'name')),
+                        key=lambda city: (search_key(city['name']), city['id']))
+        by_id = {city['id']: city for city in sorted(cities, key=lambda city: city['id'])}
+        self._data = ([search_key(city['name']) for city in cities], cities, by_id)  # readers never see a mix
+        self.version = version
+        self.loaded_at = time.monotonic()
+
+    def search(self, prefix, limit):
+        """
+        (number of cities whose name starts with prefix ignoring case, first `limit` of them by name)
+        """
+        keys, cities, _ = self._data
+        prefix = search_key(prefix)
+        start = bisect.bisect_left(keys, prefix)
+        stop = bisect.bisect_left(keys, prefix + '\U0010ffff') if prefix else len(keys)
+
+        return stop - start, cities[start:min(stop, start + limit)]
+
+    def get(self, city_id):
+        return self._data[2].get(city_id)
+
+    def all(self):
+        """
+        every city ordered by id
+        """
+        return list(self._data[2].values())
+
+    def invalidate(self):
+        self.version = None
+
+
+@lru_cache(maxsize=None)
+def _get_index():
+    return CityIndex()
+
+
+def get_city_index():
+    """
+    index of this process, up to date with the cache version
+    """
+    index = _get_index()
+    index.refresh(settings.USERS_CITY_INDEX['RELOAD_INTERVAL'])
+
+    return index
+
+
+def city_exists(city_id):
+    """
+    unknown ids are checked in the database, the city may be created by other worker just now
+    """
+    return get_city_index().get(city_id) is not None or City.objects.filter(id=city_id).exists()
+
+
+def reset_city_index():
+    _get_index.cache_clear()
+
+
+@receiver([post_save, post_delete], sender=City)
+def _city_changed(**kwargs):
+    _get_index().invalidate()  # this connection sees the change at once, others after commit
+    transaction.on_commit(lambda: cache.set(_VERSION_KEY, uuid.uuid4().hex, timeout=None))
@@ -0,0 +1,69 @@
+"""
+MyUser.city_name is a copy of the name of user's city, so user lists render it without a join.
+MyUser.save() copies it when user's city changes, renaming a city queues a `rename_city` job (users.jobs)
+which updates its users in batches, and deleting a city clears it together with city_id.
+`manage.py repair_city_names` finds and fixes names which differ anyway, e.g. after bulk updates
+"""
+from django.db import transaction
+from django.db.models import F, Value
+from django.db.models.functions import Coalesce
+from django.db.models.signals import pre_delete
+from django.dispatch import receiver
+
+from .models import City, MyUser
+from .sharding import get_shards
+
+
+def city_name_of(city_id):
+    if city_id is None:
+        return ''
+
+    return City.objects.filter(id=city_id).values_list('name', flat=True).first() or ''
+
+
+def sync_city_names(city_id, batch_size, report=None):
+    """
+    copies the current name of the city to its users (tombstoned ones too) on every shard in batches
+    of separate transactions, returns the number of updated users. The name is read again for every batch,
+    so a job for an older rename never overwrites a newer name
+    """
+    updated = 0
+    for shard in get_shards():
+        users = MyUser.all_objects.using(shard).filter(city_id=city_id)
+        while True:
+            with transaction.atomic(using=shard):  # updated users don't match the filter anymore
+                name = city_name_of(city_id)
+                ids = list(users.exclude(city_name=name).order_by('id').values_list('id', flat=True)[:batch_size])
+                if not ids:
+                    break
+                MyUser.all_objects.using(shard).filter(id__in=ids).update(city_name=name)
+
+            updated += len(ids)
+            if report is not None:
+                report(updated)
+
+    return updated
+
+
+def stale_cities():
+    """
+    ids of cities (None for no city) having users whose city_name differs from the name of the city
+    """
+    cities = set()
+    for shard in get_shards():
+        cities.update(MyUser.all_objects.using(shard).exclude(city_name=Coalesce(F('city__name'), Value('')))
+                      .order_by().values_list('city_id', flat=True).distinct())
+
+    return sorted(cities, key=lambda city_id: city_id or 0)
+
+
+def repair_city_names(batch_size):
+    """
+    {city id: number of users fixed}
+    """
+    return {city_id: sync_city_names(city_id, batch_size) for city_id in stale_cities()}
+
+
+@receiver(pre_delete, sender=City)
+def _clear_city_name(instance, using, **kwargs):
+    MyUser.all_objects.using(using).filter(city_id=instance.id).update(city_name='')  # city_id is set to null next
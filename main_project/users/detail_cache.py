@@ -0,0 +1,167 @@
+"""
+two-level cache of rendered user detail responses (PrivateUser.get, CurrentUser.get)
+"""
+import threading
+import time
+from collections import OrderedDict
+from functools import lru_cache
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Max
+
+from .models import UserChange
+
+
+class LRUCache:
+    """
+    bounded in-process mapping, least recently used entries are dropped first.
+    Entries older than `timeout` seconds (if it's given) are missing
+    """
+
+    def __init__(self, max_entries, timeout=None):
+        self.max_entries = max_entries
+        self.timeout = timeout
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            value, expires_at = entry
+            if expires_at is not None and expires_at <= time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        expires_at = None if self.timeout is None else time.monotonic() + self.timeout
+        with self._lock:
+            self._entries[key] = (value, expires_at)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class _Flight:
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+
+
+class SingleFlight:
+    """
+    concurrent calls with the same key in this process run `func` once and all get its result (or exception)
+    """
+
+    def __init__(self):
+        self._flights = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, func):
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.value
+
+        try:
+            flight.value = func()
+            return flight.value
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.done.set()
+
+
+class DetailCache:
+    """
+    rendered user responses keyed by user id, version and format: L1 is a bounded LRU of this process,
+    L2 is CACHES. Version of a user is seq of its last change in the outbox, it is bumped on commit
+    by record_change, so stale entries are never read again and just expire. Both levels expire entries
+    after `timeout`: pruned changes (users.changes.prune_changes) take the version back to an older one,
+    entries of that version are gone by then as changes are kept longer than the timeout.
+    Misses of the same key are loaded once: by one thread in process (single-flight) and,
+    while L2 lock is held, by one process
+    """
+
+    def __init__(self, l1_max_entries, timeout, lock_timeout):
+        self.local = LRUCache(l1_max_entries, timeout)
+        self.timeout = timeout
+        self.lock_timeout = lock_timeout
+        self._flights = SingleFlight()
+
+    def get(self, kind, user_id, fmt, load):
+        """
+        bytes returned by load() (which may raise, nothing is cached then)
+        """
+        key = f'users:detail:{kind}:{user_id}:{self.version(user_id)}:{fmt}'
+        body = self.local.get(key)
+        if body is None:
+            body = self._flights.do(key, lambda: self._get_shared(key, load))
+            self.local.set(key, body)
+
+        return body
+
+    def version(self, user_id):
+        version = cache.get(_version_key(user_id))
+        if version is None:
+            version = UserChange.objects.filter(user_id=user_id).aggregate(seq=Max('id'))['seq'] or 0
+            cache.add(_version_key(user_id), version, timeout=self.timeout)  # concurrent bump wins
+
+        return version
+
+    def bump(self, user_id, version):
+        cache.set(_version_key(user_id), version, timeout=self.timeout)
+
+    def _get_shared(self, key, load):
+        body = cache.get(key)
+        if body is not None:
+            return body
+
+        lock_key = key + ':lock'
+        deadline = time.monotonic() + self.lock_timeout
+        while not cache.add(lock_key, 1, timeout=self.lock_timeout):
+            time.sleep(0.01)  # other process is loading the same entry
+            body = cache.get(key)
+            if body is not None:
+                return body
+            if time.monotonic() > deadline:
+                break
+        try:
+            body = load()
+            cache.set(key, body, timeout=self.timeout)
+        finally:
+            cache.delete(lock_key)
+
+        return body
+
+    def clear(self):
+        self.local.clear()
+
+
+def _version_key(user_id):
+    return f'users:detail-version:{user_id}'
+
+
+@lru_cache(maxsize=None)
+def get_detail_cache():
+    options = settings.USERS_DETAIL_CACHE
+    return DetailCache(options['L1_MAX_ENTRIES'], options['TIMEOUT'], options['LOCK_TIMEOUT'])
@@ -0,0 +1,186 @@
+"""
+compact in-process snapshot of the short user directory (id, first name, last name, email) serving UserList pages.
+It follows the change outbox, so a page costs no queries unless there are new changes
+"""
+import sys
+import threading
+import time
+from array import array
+from bisect import bisect_left
+from functools import lru_cache
+
+from django.conf import settings
+from django.db.models import Max
+
+from .changes import committed_changes
+from .models import MyUser, UserChange
+
+
+class BlobColumn:
+    """
+    strings packed as utf-8 into one bytearray, row i is data[starts[i]:starts[i] + lengths[i]].
+    Replaced and deleted values stay in data as garbage until it's more than half of it
+    """
+    __slots__ = ('data', 'starts', 'lengths', 'garbage')
+
+    def __init__(self):
+        self.data = bytearray()
+        self.starts = array('Q')
+        self.lengths = array('I')
+        self.garbage = 0
+
+    def __len__(self):
+        return len(self.starts)
+
+    def _pack(self, value):
+        encoded = value.encode('utf-8')
+        start = len(self.data)
+        self.data += encoded
+        return start, len(encoded)
+
+    def get(self, index):
+        start = self.starts[index]
+        return self.data[start:start + self.lengths[index]].decode('utf-8')
+
+    def append(self, value):
+        self.insert(len(self), value)
+
+    def insert(self, index, value):
+        start, length = self._pack(value)
+        self.starts.insert(index, start)
+        self.lengths.insert(index, length)
+
+    def set(self, index, value):
+        self.garbage += self.lengths[index]
+        self.starts[index], self.lengths[index] = self._pack(value)
+        self._compact()
+
+    def delete(self, index):
+        self.garbage += self.lengths[index]
+        del self.starts[index]
+        del self.lengths[index]
+        self._compact()
+
+    def _compact(self):
+        if self.garbage * 2 <= len(self.data):
+            return
+        values = [self.get(index) for index in range(len(self))]
+        self.data, self.starts, self.lengths, self.garbage = bytearray(), array('Q'), array('I'), 0
+        for value in values:
+            self.append(value)
+
+
+class DirectorySnapshot:
+    """
+    columns ordered by id: ids in an array, names as lists of interned strings (names repeat a lot),
+    emails in a BlobColumn. `seq` is the last outbox change applied
+    """
+    __slots__ = ('ids', 'first_names', 'last_names', 'emails', 'seq', 'loaded_at', 'refreshed_at',
+                 '_lock', '_refresh_lock')
+
+    def __init__(self):
+        self.ids = array('q')
+        self.first_names = []
+        self.last_names = []
+        self.emails = BlobColumn()
+        self.seq = 0
+        self.loaded_at = self.refreshed_at = float('-inf')
+        self._lock = threading.Lock()  # held by readers and while changes are applied
+        self._refresh_lock = threading.Lock()  # only one thread talks to the database
+
+    def __len__(self):
+        return len(self.ids)
+
+    def page(self, start, stop):
+        with self._lock:
+            return [{'id': self.ids[index], 'first_name': self.first_names[index],
+                     'last_name': self.last_names[index], 'email': self.emails.get(index)}
+                    for index in range(start, min(stop, len(self.ids)))]
+
+    def refresh(self, refresh_interval, reload_interval):
+        """
+        applies new outbox changes if refresh_interval passed since the last check, rebuilds everything from
+        the table if reload_interval passed (it picks up changes made around the outbox, e.g. in django admin).
+        When other thread is refreshing already, current data is used
+        """
+        now = time.monotonic()
+        if now - self.refreshed_at < refresh_interval or not self._refresh_lock.acquire(blocking=False):
+            return
+        try:
+            if now - self.loaded_at >= reload_interval:
+                self._load()
+            else:
+                self._apply_changes()
+            self.refreshed_at = now
+        finally:
+            self._refresh_lock.release()
+
+    def _load(self):
+        # seq is read first: changes committed while rows are read are applied once more, which is harmless
+        seq = UserChange.objects.aggregate(seq=Max('id'))['seq'] or 0
+        ids, first_names, last_names, emails = array('q'), [], [], BlobColumn()
+        rows = MyUser.objects.order_by('id').values_list('id', 'first_name', 'last_name', 'email')
+        for user_id, first_name, last_name, email in rows.iterator(chunk_size=2000):
+            ids.append(user_id)
+            first_names.append(sys.intern(first_name))
+            last_names.append(sys.intern(last_name))
+            emails.append(email)
+
+        with self._lock:
+            self.ids, self.first_names, self.last_names, self.emails = ids, first_names, last_names, emails
+            self.seq = seq
+        self.loaded_at = time.monotonic()
+
+    def _apply_changes(self):
+        while True:
+            changes = committed_changes(self.seq, 1000)  # seqs not committed yet are waited for
+            if not changes:
+                return
+            with self._lock:
+                for change in changes:
+                    if change.action in (UserChange.DELETED, UserChange.ARCHIVED, UserChange.ERASED):
+                        self._remove(change.user_id)
+                    else:
+                        data = change.data
+                        self._upsert(change.user_id, data['first_name'], data['last_name'], data['email'])
+                    self.seq = change.id
+
+    def _upsert(self, user_id, first_name, last_name, email):
+        index = bisect_left(self.ids, user_id)
+        if index < len(self.ids) and self.ids[index] == user_id:
+            self.first_names[index] = sys.intern(first_name)
+            self.last_names[index] = sys.intern(last_name)
+            self.emails.set(index, email)
+        else:
+            self.ids.insert(index, user_id)
+            self.first_names.insert(index, sys.intern(first_name))
+            self.last_names.insert(index, sys.intern(last_name))
+            self.emails.insert(index, email)
+
+    def _remove(self, user_id):
+        index = bisect_left(self.ids, user_id)
+        if index < len(self.ids) and self.ids[index] == user_id:
+            del self.ids[index]
+            del self.first_names[index]
+            del self.last_names[index]
+            self.emails.delete(index)
+
+
+@lru_cache(maxsize=None)
+def _get_snapshot():
+    return DirectorySnapshot()
+
+
+def get_directory():
+    """
+    snapshot of this process, up to date within USERS_DIRECTORY_SNAPSHOT['REFRESH_INTERVAL']
+    """
+    options = settings.USERS_DIRECTORY_SNAPSHOT
+    snapshot = _get_snapshot()
+    snapshot.refresh(options['REFRESH_INTERVAL'], options['RELOAD_INTERVAL'])
+
+    return snapshot
+
+
+def reset_directory():
+    _get_snapshot.cache_clear()
@@ -0,0 +1,127 @@
+import asyncio
+import threading
+from functools import lru_cache
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+
+class LocalBroker:
+    """
+    in-process broker, events reach subscribers of the same process only.
+    Other brokers (e.g. redis pub/sub) have to provide the same publish/subscribe/unsubscribe methods,
+    callbacks may be called from any thread
+    """
+
+    def __init__(self):
+        self._callbacks = []
+        self._lock = threading.Lock()
+
+    def publish(self, event):
+        with self._lock:
+            callbacks = list(self._callbacks)
+        for callback in callbacks:
+            callback(event)
+
+    def subscribe(self, callback):
+        with self._lock:
+            self._callbacks.append(callback)
+
+    def unsubscribe(self, callback):
+        with self._lock:
+            self._callbacks.remove(callback)
+
+
+def coalesce(previous, event):
+    """
+    merges two not yet sent events of the same user, None means there is nothing to send
+    """
+    if previous is None:
+        return event
+    if previous['action'] == 'created':
+        if event['action'] == 'deleted':
+            return None  # subscriber has never seen this user
+        return {**event, 'action': 'created'}
+
+    return event
+
+
+class Subscription:
+    """
+    events of one subscriber waiting to be sent, only the latest event per user is kept.
+    Must be used from the event loop it was created in
+    """
+
+    def __init__(self, loop):
+        self.loop = loop
+        self.pending = {}
+        self.ready = asyncio.Event()
+
+    def push(self, event):
+        merged = coalesce(self.pending.pop(event['user_id'], None), event)
+        if merged is not None:
+            self.pending[event['user_id']] = merged
+        if self.pending:
+            self.ready.set()
+
+    async def next_batch(self, window, timeout):
+        """
+        waits up to `timeout` seconds for events, then `window` seconds more to collect the rest of a burst.
+        Returns events ordered by seq, empty list on timeout
+        """
+        try:
+            await asyncio.wait_for(self.ready.wait(), timeout)
+        except asyncio.TimeoutError:
+            return []
+
+        await asyncio.sleep(window)
+        events = sorted(self.pending.values(), key=lambda event: event['seq'])
+        self.pending.clear()
+        self.ready.clear()
+
+        return events
+
+
+class EventHub:
+    """
+    fans events from broker out to subscriptions of this process
+    """
+
+    def __init__(self, broker):
+        self._subscriptions = set()
+        self._lock = threading.Lock()
+        broker.subscribe(self._dispatch)
+
+    def _dispatch(self, event):
+        with self._lock:
+            subscriptions = list(self._subscriptions)
+        for subscription in subscriptions:
+            try:
+                subscription.loop.call_soon_threadsafe(subscription.push, event)
+            except RuntimeError:  # loop is already closed, subscription will be removed by its owner
+                pass
+
+    def subscribe(self):
+        subscription = Subscription(asyncio.get_running_loop())
+        with self._lock:
+            self._subscriptions.add(subscription)
+
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            self._subscriptions.discard(subscription)
+
+
+@lru_cache(maxsize=None)
+def get_broker():
+    return import_string(settings.USERS_EVENTS_BROKER)()
+
+
+@lru_cache(maxsize=None)
+def get_hub():
+    return EventHub(get_broker())
+
+
+def publish_event(event):
+    get_broker().publish(event)
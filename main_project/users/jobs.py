@@ -0,0 +1,193 @@
+"""
+background jobs for slow admin operations. Jobs are rows of users.models.Job created by
+/users/private/jobs and executed by `manage.py run_jobs`, no broker besides the database is needed
+"""
+import datetime
+import logging
+
+from django.conf import settings
+from django.db import IntegrityError
+from django.utils import timezone
+
+from .changes import record_change
+from .city_names import city_name_of, sync_city_names
+from .models import Job, JobOutput, MyUser, UserChange, EMAIL_TAKEN, is_email_conflict
+from .purge import purge_deleted_users
+from .archive import archive_inactive_users
+from .serialisers import PrivateCreateUserModelSerializer
+from . import sharding
+
+logger = logging.getLogger(__name__)
+
+
+def reassign_city(job, report):
+    shards = sharding.get_shards()
+    total = sum(MyUser.objects.using(shard).filter(city_id=job.params['from_city']).count() for shard in shards)
+    report(0, total)
+    city_name = city_name_of(job.params['to_city'])
+    updated = 0
+    for shard in shards:
+        users = MyUser.objects.using(shard).filter(city_id=job.params['from_city'])
+        while True:
+            with sharding.atomic():  # updated users don't match the filter anymore, so next batch is next users
+                batch = list(users.order_by('id')[:settings.USERS_JOBS_BATCH_SIZE])
+                if not batch:
+                    break
+                MyUser.objects.using(shard).filter(id__in=[user.id for user in batch]).update(
+                    city_id=job.params['to_city'], city_name=city_name)
+                for user in batch:
+                    user.city_id, user.city_name = job.params['to_city'], city_name
+                    record_change(UserChange.UPDATED, user)
+
+            updated += len(batch)
+            report(updated, total)
+
+    return {'updated': updated}
+
+
+def rename_city(job, report):
+    """
+    copies the new name of the city to its users, queued by PATCH /users/cities/{id}
+    """
+    return {'updated': sync_city_names(job.params['city'], settings.USERS_JOBS_BATCH_SIZE, report)}
+
+
+def export_users(job, report):
+    """
+    details of live users, written as parts of USERS_JOBS_BATCH_SIZE users to users_joboutput,
+    so the job row stays small. They are read by /users/private/jobs/{id}/output. With sharding
+    users are exported shard after shard, ordered by id within a shard
+    """
+    shards = sharding.get_shards()
+    total = sum(MyUser.objects.using(shard).count() for shard in shards)
+    report(0, total)
+    JobOutput.objects.filter(job_id=job.id).delete()  # parts of an interrupted run
+    exported = 0
+    parts = 0
+    for shard in shards:
+        users = MyUser.objects.using(shard).order_by('id')
+        last_id = 0
+        while True:
+            batch = list(users.filter(id__gt=last_id)[:settings.USERS_JOBS_BATCH_SIZE])
+            if not batch:
+                break
+            JobOutput.objects.create(job_id=job.id, part=parts,
+                                     data=[user.get_privateDetailUserResponseModel() for user in batch])
+            exported += len(batch)
+            parts += 1
+            last_id = batch[-1].id
+            report(exported, total)
+
+    return {'exported': exported, 'parts': parts}
+
+
+def import_users(job, report):
+    """
+    rows are validated one by one, invalid rows are reported in result and don't stop the import
+    """
+    rows = job.params['users']
+    report(0, len(rows))
+    created = 0
+    errors = []
+    for index, row in enumerate(rows, 1):
+        ser = PrivateCreateUserModelSerializer(data=row)
+        if ser.is_valid():
+            try:
+                with sharding.atomic():  # savepoint per row, a taken email doesn't roll back other rows
+                    record_change(UserChange.CREATED, ser.save())
+            except IntegrityError as error:
+                if not is_email_conflict(error):
+                    raise
+                errors.append({'index': index - 1, 'msg': {'email': [EMAIL_TAKEN]}})
+            else:
+                created += 1
+        else:
+            errors.append({'index': index - 1, 'msg': ser.errors})
+
+        if index % settings.USERS_JOBS_BATCH_SIZE == 0 or index == len(rows):
+            report(index, len(rows))
+
+    return {'created': created, 'errors': errors}
+
+
+def purge_users(job, report):
+    older_than = datetime.timedelta(seconds=job.params['older_than'])
+    purged = 0
+    while True:
+        batch = purge_deleted_users(settings.USERS_JOBS_BATCH_SIZE, older_than, max_batches=1)
+        if not batch:
+            break
+        purged += batch
+        report(purged)
+
+    return {'purged': purged}
+
+
+def archive_users(job, report):
+    inactive_for = datetime.timedelta(seconds=job.params['inactive_for'])
+    archived = 0
+    while True:
+        batch = archive_inactive_users(settings.USERS_JOBS_BATCH_SIZE, inactive_for, max_batches=1)
+        if not batch:
+            break
+        archived += batch
+        report(archived)
+
+    return {'archived': archived}
+
+
+# kind -> handler(job, report), job.params are validated by serialisers.JOB_PARAMS_SERIALIZERS[kind]
+HANDLERS = {
+    'reassign_city': reassign_city,
+    'rename_city': rename_city,
+    'export': export_users,
+    'import': import_users,
+    'purge': purge_users,
+    'archive': archive_users,
+}
+
+
+def claim_jobs(limit):
+    """
+    marks up to `limit` oldest queued jobs as running and returns their ids.
+    Every job is claimed by a conditional UPDATE, so the same job is never claimed twice
+    """
+    claimed = []
+    for job_id in Job.objects.filter(status=Job.QUEUED).order_by('id').values_list('id', flat=True)[:limit]:
+        if Job.objects.filter(id=job_id, status=Job.QUEUED).update(status=Job.RUNNING, started_at=timezone.now()):
+            claimed.append(job_id)
+
+    return claimed
+
+
+def requeue_interrupted():
+    """
+    jobs left running by a stopped worker are started again from scratch, returns their number
+    """
+    return Job.objects.filter(status=Job.RUNNING).update(status=Job.QUEUED, progress=0, started_at=None)
+
+
+def finish_job(job_id, result=None, error=None):
+    Job.objects.filter(id=job_id).update(status=Job.SUCCEEDED if error is None else Job.FAILED,
+                                         result=result, error=error or '', finished_at=timezone.now())
+
+
+def run_job(job_id):
+    """
+    executes a claimed job, called in worker processes. Errors are stored in the job, not raised
+    """
+    job = Job.objects.get(id=job_id)
+
+    def report(progress, total=None):
+        fields = {'progress': progress}
+        if total is not None:
+            fields['total'] = total
+        Job.objects.filter(id=job_id).update(**fields)
+
+    try:
+        result = HANDLERS[job.kind](job, report)
+    except Exception as e:
+        logger.exception('job %s (%s) failed', job_id, job.kind)
+        finish_job(job_id, error=f'{type(e).__name__}: {e}')
+    else:
+        finish_job(job_id, result=result)
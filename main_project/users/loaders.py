@@ -0,0 +1,55 @@
+"""
+request-scoped loaders: objects are looked up by id in batches and memoized until the end of the request,
+so the same user (e.g. authorized one and the one from url) is never fetched twice
+"""
+from .models import MyUser, City
+from .sharding import ShardedUsers, is_sharded
+
+
+class Loader:
+    """
+    ids of one load_many() not loaded yet are fetched with one IN query. Missing objects are memoized as None
+    """
+
+    def __init__(self, queryset):
+        self.queryset = queryset
+        self._objects = {}
+
+    def load(self, obj_id):
+        return self.load_many([obj_id])[0]
+
+    def get(self, obj_id):
+        """
+        like load(), but raises DoesNotExist of the model for missing objects
+        """
+        obj = self.load(obj_id)
+        if obj is None:
+            raise self.queryset.model.DoesNotExist(f'{self.queryset.model.__name__} {obj_id} doesn\'t exist')
+
+        return obj
+
+    def load_many(self, ids):
+        pending = {obj_id for obj_id in ids if obj_id not in self._objects}
+        if pending:
+            found = self.queryset.in_bulk(pending)
+            for obj_id in pending:
+                self._objects[obj_id] = found.get(obj_id)
+
+        return [self._objects[obj_id] for obj_id in ids]
+
+
+class RequestLoaders:
+    def __init__(self):
+        self.users = Loader(ShardedUsers() if is_sharded() else MyUser.objects.all())
+        self.cities = Loader(City.objects.all())
+
+
+def get_loaders(request):
+    """
+    loaders of this request, created on first use
+    """
+    loaders = getattr(request, '_users_loaders', None)
+    if loaders is None:
+        loaders = request._users_loaders = RequestLoaders()
+
+    return loaders
@@ -0,0 +1,29 @@
+import datetime
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from users.archive import archive_inactive_users
+
+
+class Command(BaseCommand):
+    help = 'Moves users inactive for a long time to the archive table in small batches'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500)
+        parser.add_argument('--inactive-for', type=int, default=settings.USERS_ARCHIVE['INACTIVE_FOR'],
+                            help='archive users not seen for this many seconds')
+        parser.add_argument('--pause', type=float, default=0.0, help='seconds to sleep between batches')
+
+    def handle(self, *args, **options):
+        inactive_for = datetime.timedelta(seconds=options['inactive_for'])
+        archived = 0
+        while True:
+            batch = archive_inactive_users(options['batch_size'], inactive_for, max_batches=1)
+            if not batch:
+                break
+            archived += batch
+            time.sleep(options['pause'])
+
+        self.stdout.write(f'archived {archived} users')
@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from users.stats import check_stats
+
+
+class Command(BaseCommand):
+    help = 'Compares aggregate statistics of users (users_userstat) with counts from the table'
+
+    def handle(self, *args, **options):
+        differences = check_stats()
+        for dimension, key, stored, actual in differences:
+            self.stdout.write(f'{dimension} {key!r}: stored {stored}, actual {actual}')
+        if differences:
+            raise CommandError(f'{len(differences)} counts differ, run manage.py rebuild_user_stats')
+
+        self.stdout.write('stats are consistent')
@@ -0,0 +1,23 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from users.webhooks import deliver_pending
+
+
+class Command(BaseCommand):
+    help = 'Delivers user changes from the outbox to webhook subscriptions, retrying failed endpoints with backoff'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=100, help='changes sent in one request')
+        parser.add_argument('--interval', type=float, default=1.0, help='seconds to sleep when nothing was sent')
+        parser.add_argument('--once', action='store_true', help='send one round of batches and exit')
+
+    def handle(self, *args, **options):
+        while True:
+            delivered = deliver_pending(options['batch_size'])
+            if options['once']:
+                self.stdout.write(f'delivered {delivered} changes')
+                return
+            if not delivered:
+                time.sleep(options['interval'])
@@ -0,0 +1,29 @@
+import datetime
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from users.changes import prune_changes
+
+
+class Command(BaseCommand):
+    help = 'Removes old changes of the change feed in small batches'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500)
+        parser.add_argument('--older-than', type=int, default=settings.USERS_CHANGES_RETENTION,
+                            help='prune changes made this many seconds ago')
+        parser.add_argument('--pause', type=float, default=0.0, help='seconds to sleep between batches')
+
+    def handle(self, *args, **options):
+        older_than = datetime.timedelta(seconds=options['older_than'])
+        pruned = 0
+        while True:
+            batch = prune_changes(options['batch_size'], older_than, max_batches=1)
+            if not batch:
+                break
+            pruned += batch
+            time.sleep(options['pause'])
+
+        self.stdout.write(f'pruned {pruned} changes')
@@ -0,0 +1,27 @@
+import datetime
+import time
+
+from django.core.management.base import BaseCommand
+
+from users.purge import purge_deleted_users
+
+
+class Command(BaseCommand):
+    help = 'Removes soft-deleted users in small batches'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500)
+        parser.add_argument('--older-than', type=int, default=0, help='purge only users deleted this many seconds ago')
+        parser.add_argument('--pause', type=float, default=0.0, help='seconds to sleep between batches')
+
+    def handle(self, *args, **options):
+        older_than = datetime.timedelta(seconds=options['older_than'])
+        purged = 0
+        while True:
+            batch = purge_deleted_users(options['batch_size'], older_than, max_batches=1)
+            if not batch:
+                break
+            purged += batch
+            time.sleep(options['pause'])
+
+        self.stdout.write(f'purged {purged} users')
@@ -0,0 +1,25 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from users.sharding import get_shards, rebalance, replicate_cities, sync_directory
+
+
+class Command(BaseCommand):
+    help = 'Copies cities to every shard of users, indexes users missing in the shard directory, ' \
+           'removes copies left by interrupted moves and evens out numbers of users on shards'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=settings.USERS_JOBS_BATCH_SIZE,
+                            help='users moved in one transaction')
+
+    def handle(self, *args, **options):
+        self.stdout.write(f'{replicate_cities()} cities copied')
+        for shard in get_shards():
+            indexed, removed = sync_directory(shard, options['batch_size'])
+            self.stdout.write(f'{shard}: {indexed} users indexed, {removed} stale copies removed')
+
+        moves = rebalance(options['batch_size'])
+        for (source, target), moved in moves.items():
+            self.stdout.write(f'{moved} users moved from {source} to {target}')
+        if not moves:
+            self.stdout.write('shards are balanced')
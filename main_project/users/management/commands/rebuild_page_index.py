@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from users.page_index import get_page_index
+
+
+class Command(BaseCommand):
+    help = 'Builds page boundary index of UserList (USERS_PAGE_INDEX) from the table, evening out its segments'
+
+    def handle(self, *args, **options):
+        total = get_page_index().rebuild()
+        self.stdout.write(f'indexed {total} users')
@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+from django.db import connections
+
+from users.sharding import get_shards
+from users.stats import install_triggers, rebuild_stats, stored_stats
+
+
+class Command(BaseCommand):
+    help = 'Recomputes aggregate statistics of users (users_userstat) from the tables of every shard and reinstalls their triggers'
+
+    def handle(self, *args, **options):
+        for shard in get_shards():
+            install_triggers(connections[shard])
+            rebuild_stats(connections[shard])
+        self.stdout.write(f'stored {len(stored_stats())} counts')
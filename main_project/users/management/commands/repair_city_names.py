@@ -0,0 +1,23 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from users.city_names import repair_city_names, stale_cities
+
+
+class Command(BaseCommand):
+    help = 'Copies names of cities to users (MyUser.city_name) wherever they differ'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--check', action='store_true', help='only report cities with stale names, fail if any')
+
+    def handle(self, *args, **options):
+        if options['check']:
+            cities = stale_cities()
+            if cities:
+                raise CommandError(f'users of {len(cities)} cities have stale city names: '
+                                   f'{", ".join(str(city_id) for city_id in cities)}')
+            self.stdout.write('city names are consistent')
+            return
+
+        repaired = repair_city_names(settings.USERS_JOBS_BATCH_SIZE)
+        self.stdout.write(f'repaired {sum(repaired.values())} users of {len(repaired)} cities')
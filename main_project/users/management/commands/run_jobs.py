@@ -0,0 +1,61 @@
+import multiprocessing
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+from django.core.management.base import BaseCommand
+from django.db import connections
+
+from users.jobs import claim_jobs, finish_job, requeue_interrupted, run_job
+
+
+class Command(BaseCommand):
+    help = 'Runs queued admin jobs in a pool of worker processes. Run one such command per database: ' \
+           'jobs which are still running at its start are considered interrupted and are started again'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--processes', type=int, default=2,
+                            help='jobs running at the same time, 0 runs jobs one by one in this process')
+        parser.add_argument('--interval', type=float, default=1.0, help='seconds to sleep when queue is empty')
+        parser.add_argument('--once', action='store_true', help='run jobs which are queued and exit')
+
+    def handle(self, *args, **options):
+        requeued = requeue_interrupted()
+        if requeued:
+            self.stdout.write(f'requeued {requeued} interrupted jobs')
+
+        if options['processes'] == 0:
+            self.run_inline(options)
+        else:
+            # workers are forked, so django is already set up in them
+            with ProcessPoolExecutor(options['processes'], mp_context=multiprocessing.get_context('fork')) as pool:
+                self.run_pool(pool, options)
+
+    def run_inline(self, options):
+        while True:
+            job_ids = claim_jobs(1)
+            if not job_ids:
+                if options['once']:
+                    return
+                time.sleep(options['interval'])
+                continue
+            run_job(job_ids[0])
+
+    def run_pool(self, pool, options):
+        running = {}
+        while True:
+            job_ids = claim_jobs(options['processes'] - len(running))
+            connections.close_all()  # workers are forked on submit and must not share parent's connection
+            for job_id in job_ids:
+                running[pool.submit(run_job, job_id)] = job_id
+
+            if not running:
+                if options['once']:
+                    return
+                time.sleep(options['interval'])
+                continue
+
+            done, _ = wait(running, timeout=options['interval'], return_when=FIRST_COMPLETED)
+            for future in done:
+                job_id = running.pop(future)
+                if future.exception() is not None:  # worker process died, run_job itself doesn't raise
+                    finish_job(job_id, error=repr(future.exception()))
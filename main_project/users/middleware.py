@@ -0,0 +1,180 @@
+import zlib
+
+from django.conf import settings
+from django.contrib.auth.middleware import AuthenticationMiddleware
+from django.contrib.messages.middleware import MessageMiddleware
+from django.contrib.sessions.middleware import SessionMiddleware
+from django.middleware.csrf import CsrfViewMiddleware
+from django.utils.cache import patch_vary_headers
+from django.utils.deprecation import MiddlewareMixin
+
+try:
+    import brotli
+except ImportError:  # brotli is optional, such clients will get gzip
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:  # zstandard is optional, such clients will get gzip
+    zstandard = None
+
+
+class GzipCodec:
+    name = 'gzip'
+
+    @staticmethod
+    def compress(data):
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 31)  # wbits=31 means gzip container
+        return compressor.compress(data) + compressor.flush()
+
+    @staticmethod
+    def compress_stream(chunks):
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+        for chunk in chunks:
+            data = compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+            if data:
+                yield data
+        yield compressor.flush()
+
+
+class BrotliCodec:
+    name = 'br'
+
+    @staticmethod
+    def compress(data):
+        return brotli.compress(data, quality=5)
+
+    @staticmethod
+    def compress_stream(chunks):
+        compressor = brotli.Compressor(quality=5)
+        for chunk in chunks:
+            data = compressor.process(chunk) + compressor.flush()
+            if data:
+                yield data
+        yield compressor.finish()
+
+
+class ZstdCodec:
+    name = 'zstd'
+
+    @staticmethod
+    def compress(data):
+        return zstandard.ZstdCompressor(level=3).compress(data)
+
+    @staticmethod
+    def compress_stream(chunks):
+        compressor = zstandard.ZstdCompressor(level=3).compressobj()
+        for chunk in chunks:
+            data = compressor.compress(chunk) + compressor.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK)
+            if data:
+                yield data
+        yield compressor.flush()
+
+
+# server preference when client accepts several encodings with the same quality
+CODECS = [codec for codec, available in ((ZstdCodec, zstandard is not None),
+                                         (BrotliCodec, brotli is not None),
+                                         (GzipCodec, True)) if available]
+
+
+def parse_accept_encoding(header):
+    """
+    returns {encoding: quality} for Accept-Encoding header value
+    """
+    qualities = {}
+    for item in header.split(','):
+        name, _, params = item.strip().partition(';')
+        if not name:
+            continue
+        quality = 1.0
+        params = params.strip()
+        if params.startswith('q='):
+            try:
+                quality = float(params[2:])
+            except ValueError:
+                quality = 0.0
+        qualities[name.strip().lower()] = quality
+
+    return qualities
+
+
+def choose_codec(header):
+    qualities = parse_accept_encoding(header)
+    best, best_quality = None, 0.0
+    for codec in CODECS:
+        quality = qualities.get(codec.name, qualities.get('*', 0.0))
+        if quality > best_quality:
+            best, best_quality = codec, quality
+
+    return best
+
+
+class CompressionMiddleware(MiddlewareMixin):
+    """
+    compresses api responses with the best encoding client accepts (zstd, br or gzip).
+    Responses smaller than USERS_COMPRESSION_MIN_SIZE are sent as is, streaming responses
+    are compressed chunk by chunk so they are never buffered as a whole
+    """
+
+    def process_response(self, request, response):
+        if not request.path_info.startswith(tuple(settings.USERS_COMPRESSION_PATHS)):
+            return response
+        if response.has_header('Content-Encoding'):
+            return response
+
+        patch_vary_headers(response, ('Accept-Encoding',))
+
+        if not response.streaming and len(response.content) < settings.USERS_COMPRESSION_MIN_SIZE:
+            return response
+
+        codec = choose_codec(request.META.get('HTTP_ACCEPT_ENCODING', ''))
+        if codec is None:
+            return response
+
+        if response.streaming:
+            response.streaming_content = codec.compress_stream(response.streaming_content)
+            del response['Content-Length']
+        else:
+            compressed = codec.compress(response.content)
+            if len(compressed) >= len(response.content):
+                return response
+            response.content = compressed
+            response['Content-Length'] = str(len(compressed))
+
+        response['Content-Encoding'] = codec.name
+        return response
+
+
+def is_lean_path(request):
+    return request.path_info.startswith(tuple(settings.USERS_LEAN_MIDDLEWARE_PATHS))
+
+
+class LeanPathsMixin:
+    """
+    requests to USERS_LEAN_MIDDLEWARE_PATHS bypass the middleware: api views authorize by their own
+    `userid` cookie and need neither sessions, nor django users, nor messages, nor csrf cookies
+    """
+
+    def __call__(self, request):
+        if is_lean_path(request):
+            return self.get_response(request)
+        return super().__call__(request)
+
+
+class LeanSessionMiddleware(LeanPathsMixin, SessionMiddleware):
+    pass
+
+
+class LeanCsrfViewMiddleware(LeanPathsMixin, CsrfViewMiddleware):
+    def process_view(self, request, callback, callback_args, callback_kwargs):
+        if is_lean_path(request):
+            return None
+        return super().process_view(request, callback, callback_args, callback_kwargs)
+
+
+class LeanAuthenticationMiddleware(LeanPathsMixin, AuthenticationMiddleware):
+    pass
+
+
+class LeanMessageMiddleware(LeanPathsMixin, MessageMiddleware):
+    pass
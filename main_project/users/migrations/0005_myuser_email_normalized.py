@@ -0,0 +1,43 @@
+# Generated by Django 4.0.2 on 2026-10-19 10:12
+
+from collections import defaultdict
+
+from django.db import migrations, models
+
+
+def populate_email_normalized(apps, schema_editor):
+    MyUser = apps.get_model('users', 'MyUser')
+
+    ids_by_email = defaultdict(list)
+    for user_id, email in MyUser.objects.values_list('id', 'email'):
+        ids_by_email[email.strip().lower()].append(user_id)
+
+    duplicates = {email: ids for email, ids in ids_by_email.items() if len(ids) > 1}
+    if duplicates:
+        raise RuntimeError(f'users share the same email ignoring case, resolve them manually: {duplicates}')
+
+    users = []
+    for email, (user_id,) in ids_by_email.items():
+        users.append(MyUser(id=user_id, email_normalized=email))
+    MyUser.objects.bulk_update(users, ['email_normalized'], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0004_alter_myuser_birthday'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='myuser',
+            name='email_normalized',
+            field=models.CharField(editable=False, max_length=254, null=True),
+        ),
+        migrations.RunPython(populate_email_normalized, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='myuser',
+            name='email_normalized',
+            field=models.CharField(editable=False, max_length=254, unique=True),
+        ),
+    ]
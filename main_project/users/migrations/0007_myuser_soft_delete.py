@@ -0,0 +1,40 @@
+# Generated by Django 4.0.2 on 2026-10-19 18:13
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0006_userchange_webhooksubscription'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='myuser',
+            name='deleted_at',
+            field=models.DateTimeField(blank=True, editable=False, null=True),
+        ),
+        migrations.AlterField(
+            model_name='myuser',
+            name='email',
+            field=models.EmailField(max_length=254),
+        ),
+        migrations.AlterField(
+            model_name='myuser',
+            name='email_normalized',
+            field=models.CharField(editable=False, max_length=254),
+        ),
+        migrations.AddIndex(
+            model_name='myuser',
+            index=models.Index(condition=models.Q(('deleted_at__isnull', True)), fields=['id'], name='users_myuser_live_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='myuser',
+            index=models.Index(condition=models.Q(('deleted_at__isnull', False)), fields=['deleted_at'], name='users_myuser_tombstone_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='myuser',
+            constraint=models.UniqueConstraint(condition=models.Q(('deleted_at__isnull', True)), fields=('email_normalized',), name='users_myuser_live_email_normalized_uniq'),
+        ),
+    ]
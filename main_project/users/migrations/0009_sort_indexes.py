@@ -0,0 +1,37 @@
+# Generated by Django 4.0.2 on 2026-10-19 18:27
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0008_job'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='myuser',
+            index=models.Index(condition=models.Q(('deleted_at__isnull', True)), fields=['first_name', 'id'], name='users_sort_first_name_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='myuser',
+            index=models.Index(condition=models.Q(('deleted_at__isnull', True)), fields=['last_name', 'id'], name='users_sort_last_name_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='myuser',
+            index=models.Index(condition=models.Q(('deleted_at__isnull', True)), fields=['email', 'id'], name='users_sort_email_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='myuser',
+            index=models.Index(condition=models.Q(('deleted_at__isnull', True)), fields=['birthday', 'id'], name='users_sort_birthday_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='myuser',
+            index=models.Index(condition=models.Q(('deleted_at__isnull', True)), fields=['last_name', 'first_name', 'id'], name='users_sort_full_name_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='myuser',
+            index=models.Index(condition=models.Q(('deleted_at__isnull', True)), fields=['last_name', '-birthday', 'id'], name='users_sort_name_birthday_idx'),
+        ),
+    ]
@@ -0,0 +1,22 @@
+# Generated by Django 4.0.2 on 2026-10-19 18:34
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0009_sort_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='myuser',
+            name='last_seen_at',
+            field=models.DateTimeField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='myuser',
+            index=models.Index(condition=models.Q(('deleted_at__isnull', True)), fields=['last_seen_at'], name='users_myuser_last_seen_idx'),
+        ),
+    ]
@@ -0,0 +1,40 @@
+# Generated by Django 4.0.2 on 2026-10-19 18:38
+
+from django.db import migrations, models
+
+
+def install_triggers(apps, schema_editor):
+    from users.stats import install_triggers, rebuild_stats
+
+    install_triggers(schema_editor.connection)
+    rebuild_stats(schema_editor.connection)  # current numbers, triggers keep them from now on
+
+
+def drop_triggers(apps, schema_editor):
+    from users.stats import drop_triggers
+
+    drop_triggers(schema_editor.connection)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0010_last_seen_at'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UserStat',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('dimension', models.CharField(max_length=20)),
+                ('key', models.CharField(blank=True, max_length=20)),
+                ('count', models.IntegerField(default=0)),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='userstat',
+            constraint=models.UniqueConstraint(fields=('dimension', 'key'), name='users_userstat_dimension_key_uniq'),
+        ),
+        migrations.RunPython(install_triggers, drop_triggers),
+    ]
@@ -0,0 +1,35 @@
+# Generated by Django 4.0.2 on 2026-10-19 18:40
+
+import datetime
+
+from django.db import migrations, models
+
+
+def populate_birthday_day(apps, schema_editor):
+    MyUser = apps.get_model('users', 'MyUser')
+
+    users = []
+    for user_id, birthday in MyUser.objects.filter(birthday__isnull=False).values_list('id', 'birthday').iterator():
+        day = datetime.date(2000, birthday.month, birthday.day).timetuple().tm_yday  # models.day_of_year
+        users.append(MyUser(id=user_id, birthday_day=day))
+    MyUser.objects.bulk_update(users, ['birthday_day'], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0011_userstat'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='myuser',
+            name='birthday_day',
+            field=models.SmallIntegerField(editable=False, null=True),
+        ),
+        migrations.RunPython(populate_birthday_day, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='myuser',
+            index=models.Index(condition=models.Q(('birthday_day__isnull', False), ('deleted_at__isnull', True)), fields=['birthday_day', 'id'], name='users_myuser_birthday_day_idx'),
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 4.0.2 on 2026-10-19 18:49
+
+from django.db import migrations, models
+from django.db.models import OuterRef, Subquery
+
+
+def populate_city_name(apps, schema_editor):
+    MyUser = apps.get_model('users', 'MyUser')
+    City = apps.get_model('users', 'City')
+
+    MyUser.objects.filter(city__isnull=False).update(
+        city_name=Subquery(City.objects.filter(id=OuterRef('city_id')).values('name')))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0012_birthday_day'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='myuser',
+            name='city_name',
+            field=models.CharField(blank=True, editable=False, max_length=50),
+        ),
+        migrations.RunPython(populate_city_name, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 4.0.2 on 2026-10-19 18:54
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0013_city_name'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UserShard',
+            fields=[
+                ('id', models.BigAutoField(primary_key=True, serialize=False)),
+                ('shard', models.CharField(max_length=100)),
+                ('email_normalized', models.CharField(max_length=254, null=True, unique=True)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='usershard',
+            index=models.Index(fields=['shard', 'id'], name='users_usershard_shard_idx'),
+        ),
+    ]
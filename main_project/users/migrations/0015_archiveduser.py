@@ -0,0 +1,54 @@
+# Generated by Django 4.0.2 on 2026-10-19 18:57
+
+from django.db import migrations, models
+import django.db.models.deletion
+from django.utils import timezone
+
+
+def backfill_last_seen_at(apps, schema_editor):
+    # users from before activity tracking have never been seen, they become archivable after INACTIVE_FOR from now
+    MyUser = apps.get_model('users', 'MyUser')
+
+    MyUser.objects.filter(last_seen_at__isnull=True).update(last_seen_at=timezone.now())
+
+
+def install_triggers(apps, schema_editor):
+    from users.stats import install_triggers
+
+    install_triggers(schema_editor.connection)  # archived users are counted too, the archive starts empty
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0014_usershard'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='userchange',
+            name='action',
+            field=models.CharField(choices=[('created', 'Created'), ('updated', 'Updated'), ('deleted', 'Deleted'), ('archived', 'Archived'), ('restored', 'Restored'), ('erased', 'Erased')], max_length=10),
+        ),
+        migrations.CreateModel(
+            name='ArchivedUser',
+            fields=[
+                ('id', models.BigIntegerField(primary_key=True, serialize=False)),
+                ('first_name', models.CharField(max_length=30)),
+                ('last_name', models.CharField(max_length=30)),
+                ('other_name', models.CharField(max_length=30)),
+                ('password', models.CharField(max_length=100)),
+                ('email', models.EmailField(max_length=254)),
+                ('email_normalized', models.CharField(db_index=True, max_length=254)),
+                ('phone', models.CharField(max_length=14)),
+                ('birthday', models.DateField(null=True)),
+                ('is_admin', models.BooleanField(default=False)),
+                ('additional_info', models.CharField(max_length=300)),
+                ('last_seen_at', models.DateTimeField(null=True)),
+                ('archived_at', models.DateTimeField()),
+                ('city', models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='users.city')),
+            ],
+        ),
+        migrations.RunPython(install_triggers, migrations.RunPython.noop),
+        migrations.RunPython(backfill_last_seen_at, migrations.RunPython.noop),
+    ]
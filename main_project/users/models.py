@@ -1,21 +1,152 @@
+import datetime
+
+from django.core.serializers.json import DjangoJSONEncoder
 from django.db import models
+from django.utils.dateparse import parse_date
+
+
+def normalize_email(email):
+    """
+    logins are matched case-insensitively and without surrounding spaces
+    """
+    return str(email).strip().lower()
+
+
+def day_of_year(birthday):
+    """
+    number of the day in a leap year (1..366, Feb 29 is 60), so a date has the same number every year.
+    Birthday may be a date or its ISO string, None for missing or invalid ones
+    """
+    if isinstance(birthday, str):
+        try:
+            birthday = parse_date(birthday)
+        except ValueError:
+            birthday = None
+    if birthday is None:
+        return None
+
+    return datetime.date(2000, birthday.month, birthday.day).timetuple().tm_yday
+
+
+EMAIL_TAKEN = 'my user with this email already exists.'
+
+
+def is_email_conflict(error):
+    """
+    live emails are unique by users_myuser_live_email_normalized_uniq, so instead of checking before every write
+    callers catch IntegrityError and ask whether it was this constraint. It's the only unique constraint
+    on emails of users (equal emails have equal normalized ones), sqlite names its column in the message,
+    postgres the constraint and the column
+    """
+    return 'email_normalized' in str(error)
 
 
 class City(models.Model):
     name = models.CharField(max_length=50)
 
 
+SHORT_USER_FIELDS = ('id', 'first_name', 'last_name', 'email')
+
+# orderings user lists can be sorted by (as given or with every direction reversed), each one has an index
+# of live users on its fields followed by id, which breaks ties, see utils.parse_sort
+USER_SORT_INDEXES = {
+    'users_sort_first_name_idx': ('first_name',),
+    'users_sort_last_name_idx': ('last_name',),
+    'users_sort_email_idx': ('email',),
+    'users_sort_birthday_idx': ('birthday',),
+    'users_sort_full_name_idx': ('last_name', 'first_name'),
+    'users_sort_name_birthday_idx': ('last_name', '-birthday'),
+}
+
+
+class MyUserManager(models.Manager):
+    def get_by_login(self, login):
+        """
+        finds user by login with one lookup on the email_normalized index. Raises MyUser.DoesNotExist like get()
+        """
+        return self.get(email_normalized=normalize_email(login))
+
+
+class LiveUserManager(MyUserManager):
+    """
+    soft-deleted (tombstoned) users are invisible through default manager
+    """
+
+    def get_queryset(self):
+        return super().get_queryset().filter(deleted_at__isnull=True)
+
+
 class MyUser(models.Model):
     first_name = models.CharField(max_length=30)
     last_name = models.CharField(max_length=30)
     other_name = models.CharField(max_length=30)
     password = models.CharField(max_length=100)
-    email = models.EmailField(unique=True)  # considering this as login
+    email = models.EmailField()  # considering this as login, unique among live users by email_normalized
+    email_normalized = models.CharField(max_length=254, editable=False)
     phone = models.CharField(max_length=14)
     birthday = models.DateField(null=True)
     is_admin = models.BooleanField(default=False)
     city = models.ForeignKey(City, null=True, on_delete=models.SET_NULL)
     additional_info = models.CharField(max_length=300)
+    deleted_at = models.DateTimeField(null=True, blank=True, editable=False)  # tombstone, purged later
+    last_seen_at = models.DateTimeField(null=True, blank=True, editable=False)  # written by users.activity
+    birthday_day = models.SmallIntegerField(null=True, editable=False)  # day_of_year(birthday), for users.birthdays
+    city_name = models.CharField(max_length=50, blank=True, editable=False)  # copy of city.name, see users.city_names
+
+    objects = LiveUserManager()
+    all_objects = MyUserManager()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['email_normalized'], condition=models.Q(deleted_at__isnull=True),
+                                    name='users_myuser_live_email_normalized_uniq'),
+        ]
+        indexes = [
+            models.Index(fields=['id'], condition=models.Q(deleted_at__isnull=True), name='users_myuser_live_idx'),
+            models.Index(fields=['deleted_at'], condition=models.Q(deleted_at__isnull=False),
+                         name='users_myuser_tombstone_idx'),
+            models.Index(fields=['last_seen_at'], condition=models.Q(deleted_at__isnull=True),
+                         name='users_myuser_last_seen_idx'),
+            models.Index(fields=['birthday_day', 'id'],
+                         condition=models.Q(deleted_at__isnull=True, birthday_day__isnull=False),
+                         name='users_myuser_birthday_day_idx'),
+            *[models.Index(fields=[*fields, 'id'], condition=models.Q(deleted_at__isnull=True), name=name)
+              for name, fields in USER_SORT_INDEXES.items()],
+        ]
+
+    _city_name_for = ...  # city_id city_name was read or written for, ... when unknown
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        user = super().from_db(db, field_names, values)
+        if 'city_id' in field_names and 'city_name' in field_names:
+            user._city_name_for = user.city_id
+
+        return user
+
+    def _get_city_name(self):
+        if self.city_id is None:
+            return ''
+        field = self._meta.get_field('city')
+        if field.is_cached(self) and field.get_cached_value(self).id == self.city_id:
+            return field.get_cached_value(self).name
+
+        return City.objects.filter(id=self.city_id).values_list('name', flat=True).first() or ''
+
+    def save(self, *args, **kwargs):
+        self.email_normalized = normalize_email(self.email)
+        self.birthday_day = day_of_year(self.birthday)
+        if self.city_id != self._city_name_for:  # only a changed city is looked up
+            self.city_name = self._get_city_name()
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None and 'email' in update_fields:
+            update_fields = kwargs['update_fields'] = {*update_fields, 'email_normalized'}
+        if update_fields is not None and 'birthday' in update_fields:
+            update_fields = kwargs['update_fields'] = {*update_fields, 'birthday_day'}
+        if update_fields is not None and {'city', 'city_id'} & set(update_fields):
+            kwargs['update_fields'] = {*update_fields, 'city_name'}
+        super().save(*args, **kwargs)
+        self._city_name_for = self.city_id
 
     def check_password(self, password):
         return self.password == password
@@ -29,6 +160,11 @@ class MyUser(models.Model):
         }
         return data
 
+    def get_short_user_model_with_city_name(self):
+        data = self.get_short_user_model()
+        data['city_name'] = self.city_name
+        return data
+
     def get_current_user_response_model(self):
         data = {
             "first_name": self.first_name,
@@ -52,7 +188,196 @@ class MyUser(models.Model):
             "phone": self.phone,
             "birthday": self.birthday,
             "is_admin": self.is_admin,
-            "city": self.city,
+            "city": self.city_id,
             "additional_info": self.additional_info,
         }
         return data
+
+
+# columns moved to the archive and back, the rest of MyUser columns are derived from them
+ARCHIVED_USER_FIELDS = ('id', 'first_name', 'last_name', 'other_name', 'password', 'email', 'email_normalized', 'phone',
+                        'birthday', 'is_admin', 'city_id', 'additional_info', 'last_seen_at')
+
+
+class ArchivedUser(models.Model):
+    """
+    live user moved out of users_myuser after long inactivity by users.archive, so the hot table and its indexes
+    hold active users only. The id stays the same, email_normalized is indexed for restoring on login
+    """
+    id = models.BigIntegerField(primary_key=True)
+    first_name = models.CharField(max_length=30)
+    last_name = models.CharField(max_length=30)
+    other_name = models.CharField(max_length=30)
+    password = models.CharField(max_length=100)
+    email = models.EmailField()
+    email_normalized = models.CharField(max_length=254, db_index=True)
+    phone = models.CharField(max_length=14)
+    birthday = models.DateField(null=True)
+    is_admin = models.BooleanField(default=False)
+    city = models.ForeignKey(City, null=True, on_delete=models.SET_NULL, related_name='+')
+    additional_info = models.CharField(max_length=300)
+    last_seen_at = models.DateTimeField(null=True)
+    archived_at = models.DateTimeField()
+
+    @classmethod
+    def from_user(cls, user, archived_at):
+        return cls(archived_at=archived_at, **{field: getattr(user, field) for field in ARCHIVED_USER_FIELDS})
+
+    def to_user(self):
+        return MyUser(**{field: getattr(self, field) for field in ARCHIVED_USER_FIELDS})
+
+    def check_password(self, password):
+        return self.to_user().check_password(password)
+
+    def get_privateDetailUserResponseModel(self):
+        return self.to_user().get_privateDetailUserResponseModel()
+
+
+class UserShard(models.Model):
+    """
+    directory of sharded users (users.sharding), kept in USERS_SHARDING['DIRECTORY'] database:
+    id is allocated here and used as id of the user on its shard, email_normalized of live users
+    is unique among all shards
+    """
+    id = models.BigAutoField(primary_key=True)
+    shard = models.CharField(max_length=100)
+    email_normalized = models.CharField(max_length=254, null=True, unique=True)  # null for deleted users
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['shard', 'id'], name='users_usershard_shard_idx'),
+        ]
+
+
+class UserChange(models.Model):
+    """
+    transactional outbox: a row is written in the same transaction as every user mutation,
+    id is the sequence number readers of the change feed and webhooks continue from
+    """
+    CREATED = 'created'
+    UPDATED = 'updated'
+    DELETED = 'deleted'
+    ARCHIVED = 'archived'  # moved to users_archiveduser, still readable by id
+    RESTORED = 'restored'
+    ERASED = 'erased'  # archived user deleted, it's out of lists since it was archived
+    ACTIONS = [(CREATED, 'Created'), (UPDATED, 'Updated'), (DELETED, 'Deleted'), (ARCHIVED, 'Archived'),
+               (RESTORED, 'Restored'), (ERASED, 'Erased')]
+
+    user_id = models.BigIntegerField()
+    action = models.CharField(max_length=10, choices=ACTIONS)
+    data = models.JSONField(null=True, encoder=DjangoJSONEncoder)  # private detail model, null for deletes
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            # last change of a user is the version of its cached detail responses (users.detail_cache)
+            models.Index(fields=['user_id', 'id'], name='users_userchange_user_idx'),
+        ]
+
+    def get_change_model(self):
+        data = {
+            'seq': self.id,
+            'user_id': self.user_id,
+            'action': self.action,
+            'data': self.data,
+            'created_at': self.created_at,
+        }
+        return data
+
+
+class WebhookSubscription(models.Model):
+    """
+    endpoint receiving batches of UserChange, last_seq is the last change it has acknowledged
+    """
+    url = models.URLField()
+    last_seq = models.BigIntegerField(default=0)
+    failures = models.IntegerField(default=0)
+    retry_at = models.DateTimeField(null=True, blank=True)
+    is_active = models.BooleanField(default=True)
+
+    def __str__(self):
+        return self.url
+
+
+class UserStat(models.Model):
+    """
+    number of live users per value (key) of a dimension, kept up to date by database triggers on users_myuser
+    created in migration 0011_userstat, so every write path (including bulk updates and django admin) is counted.
+    Keys are strings: city id, 'admin'/'user', birthday month, '' for users without city or birthday
+    """
+    TOTAL = 'total'
+    CITY = 'city'
+    ROLE = 'role'
+    BIRTHDAY_MONTH = 'birthday_month'
+
+    dimension = models.CharField(max_length=20)
+    key = models.CharField(max_length=20, blank=True)
+    count = models.IntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['dimension', 'key'], name='users_userstat_dimension_key_uniq'),
+        ]
+
+
+class Job(models.Model):
+    """
+    slow admin operation executed by `manage.py run_jobs` outside of the request,
+    kind is a name from users.jobs.HANDLERS
+    """
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    SUCCEEDED = 'succeeded'
+    FAILED = 'failed'
+    STATUSES = [(QUEUED, 'Queued'), (RUNNING, 'Running'), (SUCCEEDED, 'Succeeded'), (FAILED, 'Failed')]
+
+    kind = models.CharField(max_length=30)
+    params = models.JSONField(default=dict, encoder=DjangoJSONEncoder)
+    status = models.CharField(max_length=10, choices=STATUSES, default=QUEUED)
+    progress = models.IntegerField(default=0)
+    total = models.IntegerField(null=True)
+    result = models.JSONField(null=True, encoder=DjangoJSONEncoder)
+    error = models.TextField(blank=True)
+    idempotency_key = models.CharField(max_length=255, null=True, blank=True, unique=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['id'], condition=models.Q(status='queued'), name='users_job_queued_idx'),
+        ]
+
+    def get_job_model(self):
+        data = self.get_job_list_element_model()
+        data['result'] = self.result
+        return data
+
+    def get_job_list_element_model(self):
+        data = {
+            'id': self.id,
+            'kind': self.kind,
+            'params': self.params,
+            'status': self.status,
+            'progress': self.progress,
+            'total': self.total,
+            'error': self.error,
+            'created_at': self.created_at,
+            'started_at': self.started_at,
+            'finished_at': self.finished_at,
+        }
+        return data
+
+
+class JobOutput(models.Model):
+    """
+    part of a large job output (export), kept out of Job.result so job rows stay small
+    """
+    job = models.ForeignKey(Job, on_delete=models.CASCADE, related_name='+')
+    part = models.IntegerField()
+    data = models.JSONField(encoder=DjangoJSONEncoder)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['job', 'part'], name='users_joboutput_job_part_uniq'),
+        ]
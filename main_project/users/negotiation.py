@@ -0,0 +1,18 @@
+from rest_framework.negotiation import DefaultContentNegotiation
+
+
+def _available(classes):
+    return [item for item in classes if getattr(item, 'available', True)]
+
+
+class AvailableContentNegotiation(DefaultContentNegotiation):
+    """
+    binary formats depend on optional packages, renderers and parsers for missing ones are skipped,
+    so such requests get 406/415 instead of 500
+    """
+
+    def select_parser(self, request, parsers):
+        return super().select_parser(request, _available(parsers))
+
+    def select_renderer(self, request, renderers, format_suffix=None):
+        return super().select_renderer(request, _available(renderers), format_suffix)
@@ -0,0 +1,268 @@
+"""
+page boundary index for id ordered user pages, kept in a memory-mapped file shared by worker processes.
+Live users in id order are split into segments of about USERS_PAGE_INDEX['STEP'] users, the file keeps first id
+and number of users of every segment, so page/size resolves to a keyset query `id >= boundary` which skips
+less than a segment of rows, however deep the page is
+"""
+import fcntl
+import mmap
+import os
+import struct
+import threading
+import time
+from array import array
+from bisect import bisect_right
+from contextlib import contextmanager
+from functools import lru_cache
+
+from django.conf import settings
+from django.db.models import Subquery
+
+from .changes import committed_changes
+from .models import MyUser, UserChange
+
+MAGIC = b'USRPIDX1'
+# magic, step, capacity, segments, total users, last id, last applied outbox seq
+HEADER = struct.Struct('=8s6q')
+ITEM_SIZE = 8
+CHANGES_BATCH_SIZE = 1000  # outbox changes applied under one exclusive lock
+
+
+class Fenwick:
+    """
+    prefix sums of segment counts, `tree` is any int64 sequence of capacity + 1 items (capacity is power of two)
+    """
+
+    def __init__(self, tree):
+        self.tree = tree
+        self.capacity = len(tree) - 1
+
+    @staticmethod
+    def build(counts, capacity):
+        tree = [0] + list(counts) + [0] * (capacity - len(counts))
+        for index in range(1, capacity + 1):
+            parent = index + (index & -index)
+            if parent <= capacity:
+                tree[parent] += tree[index]
+        return tree
+
+    def add(self, segment, delta):
+        index = segment + 1
+        while index <= self.capacity:
+            self.tree[index] += delta
+            index += index & -index
+
+    def find(self, offset):
+        """
+        (segment containing the row with this offset, rows of that segment before it)
+        """
+        segment = 0
+        step = self.capacity
+        while step:
+            if segment + step <= self.capacity and self.tree[segment + step] <= offset:
+                segment += step
+                offset -= self.tree[segment]
+            step >>= 1
+        return segment, offset
+
+
+class PageIndex:
+    """
+    the file is changed under exclusive flock and read under shared one, every process maps it
+    and remaps when its size changes. Users created after the last rebuild are appended to the last segment
+    (or start a new one), deleted ones decrease count of their segment, so segments drift from STEP
+    until `manage.py rebuild_page_index` evens them out
+    """
+
+    def __init__(self, path, step, refresh_interval):
+        self.path = path
+        self.step = step
+        self.refresh_interval = refresh_interval
+        self.synced_at = float('-inf')
+        self._file = None
+        self._map = None
+        self._items = None
+        self._lock = threading.Lock()  # threads of this process share the file and the mapping
+
+    @contextmanager
+    def _locked(self, exclusive):
+        with self._lock:
+            if self._file is None:
+                self._file = os.fdopen(os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644), 'r+b')
+            fcntl.flock(self._file.fileno(), fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            try:
+                self._remap()
+                yield
+            finally:
+                fcntl.flock(self._file.fileno(), fcntl.LOCK_UN)
+
+    def _remap(self):
+        size = os.fstat(self._file.fileno()).st_size
+        if self._map is not None and len(self._map) == size:
+            return
+        self._unmap()
+        if size >= HEADER.size:
+            self._map = mmap.mmap(self._file.fileno(), size)
+            self._items = memoryview(self._map)[HEADER.size:].cast('q')
+
+    def _unmap(self):
+        # not closed explicitly: column views may still be referenced, the old mapping goes away with them
+        self._items = None
+        self._map = None
+
+    def _header(self):
+        if self._map is None:
+            return None
+        magic, step, capacity, segments, total, last_id, seq = HEADER.unpack_from(self._map)
+        if magic != MAGIC or step != self.step:
+            return None
+        return {'capacity': capacity, 'segments': segments, 'total': total, 'last_id': last_id, 'seq': seq}
+
+    def _columns(self, capacity):
+        # boundaries, counts and fenwick tree of counts
+        return (self._items[:capacity], self._items[capacity:2 * capacity],
+                self._items[2 * capacity:3 * capacity + 1])
+
+    def _write(self, boundaries, counts, total, last_id, seq, capacity=None):
+        capacity = capacity or max(16, 1 << (len(boundaries) - 1).bit_length())
+        padding = array('q', bytes(ITEM_SIZE * (capacity - len(boundaries))))
+        data = b''.join([HEADER.pack(MAGIC, self.step, capacity, len(boundaries), total, last_id, seq),
+                         (array('q', boundaries) + padding).tobytes(), (array('q', counts) + padding).tobytes(),
+                         array('q', Fenwick.build(counts, capacity)).tobytes()])
+
+        self._unmap()
+        self._file.seek(0)
+        self._file.write(data)
+        self._file.truncate(len(data))
+        self._file.flush()
+        self._remap()
+
+    def rebuild(self):
+        """
+        builds the index from the table, returns number of users in it
+        """
+        # outbox seq is read by the same statement as ids, so changes are either in the rows or after seq
+        last_seq = Subquery(UserChange.objects.order_by('-id').values('id')[:1])
+        seq_before = UserChange.objects.order_by('-id').values_list('id', flat=True).first() or 0
+        boundaries, counts, total, last_id, seq = [], [], 0, 0, None
+        rows = MyUser.objects.order_by('id').annotate(last_seq=last_seq).values_list('id', 'last_seq')
+        for user_id, row_seq in rows.iterator(chunk_size=5000):
+            if total % self.step == 0:
+                boundaries.append(user_id)
+                counts.append(0)
+            counts[-1] += 1
+            total += 1
+            last_id = user_id
+            seq = row_seq or 0
+        if seq is None:  # no users, nothing can be counted twice
+            seq = seq_before
+
+        with self._locked(exclusive=True):
+            self._write(boundaries, counts, total, last_id, seq)
+        self.synced_at = time.monotonic()
+
+        return total
+
+    def sync(self):
+        """
+        applies committed outbox changes made since the index was written in batches, builds it when there is
+        no valid file yet.
+        Does nothing if it was done less than refresh_interval seconds ago in this process
+        """
+        if time.monotonic() - self.synced_at < self.refresh_interval:
+            return
+        with self._locked(exclusive=False):
+            header = self._header()
+        if header is None:
+            self.rebuild()
+            return
+
+        while True:
+            # every change is read to notice seqs not committed yet, see committed_changes
+            changes = committed_changes(header['seq'], CHANGES_BATCH_SIZE)
+            if not changes:
+                break
+            with self._locked(exclusive=True):
+                for change in changes:
+                    header = self._header()
+                    if change.id <= header['seq']:  # applied by other process meanwhile
+                        continue
+                    if change.action in (UserChange.CREATED, UserChange.RESTORED):
+                        if header['segments'] == header['capacity']:
+                            self._grow(header)
+                        self._insert(header, change.user_id)
+                    elif change.action in (UserChange.DELETED, UserChange.ARCHIVED):
+                        self._delete(header, change.user_id)
+                    HEADER.pack_into(self._map, 0, MAGIC, self.step, header['capacity'], header['segments'],
+                                     header['total'], header['last_id'], change.id)
+                header = self._header()
+            if len(changes) < CHANGES_BATCH_SIZE:
+                break
+        self.synced_at = time.monotonic()
+
+    def _insert(self, header, user_id):
+        capacity, segments = header['capacity'], header['segments']
+        boundaries, counts, tree = self._columns(capacity)
+        if segments and user_id <= header['last_id']:  # explicit id in the middle, its segment just grows
+            segment = max(bisect_right(boundaries[:segments], user_id) - 1, 0)
+            boundaries[segment] = min(boundaries[segment], user_id)
+        elif segments and counts[segments - 1] < self.step:
+            segment = segments - 1
+        else:
+            segment = segments
+            boundaries[segment] = user_id
+            header['segments'] += 1
+        counts[segment] += 1
+        Fenwick(tree).add(segment, 1)
+        header['total'] += 1
+        header['last_id'] = max(header['last_id'], user_id)
+
+    def _delete(self, header, user_id):
+        if user_id > header['last_id']:  # never inserted
+            return
+        boundaries, counts, tree = self._columns(header['capacity'])
+        segment = bisect_right(boundaries[:header['segments']], user_id) - 1
+        if segment < 0 or counts[segment] == 0:
+            return
+        counts[segment] -= 1
+        Fenwick(tree).add(segment, -1)
+        header['total'] -= 1
+
+    def _grow(self, header):
+        boundaries, counts, _ = self._columns(header['capacity'])
+        self._write(boundaries[:header['segments']].tolist(), counts[:header['segments']].tolist(),
+                    header['total'], header['last_id'], header['seq'], capacity=header['capacity'] * 2)
+        header['capacity'] *= 2
+
+    def __len__(self):
+        self.sync()
+        with self._locked(exclusive=False):
+            return self._header()['total']
+
+    def locate(self, offset):
+        """
+        (first id of the segment containing the row with this offset, rows of the segment to skip),
+        None when offset is past the last user
+        """
+        self.sync()
+        with self._locked(exclusive=False):
+            header = self._header()
+            if offset >= header['total']:
+                return None
+            boundaries, _, tree = self._columns(header['capacity'])
+            segment, skip = Fenwick(tree).find(offset)
+            return boundaries[segment], skip
+
+    def page(self, start, stop):
+        location = self.locate(start)
+        if location is None:
+            return []
+        boundary, skip = location
+        users = MyUser.objects.filter(id__gte=boundary).order_by('id')[skip:skip + stop - start]
+        return [user.get_short_user_model() for user in users]
+
+
+@lru_cache(maxsize=None)
+def get_page_index():
+    options = settings.USERS_PAGE_INDEX
+    return PageIndex(str(options['PATH']), options['STEP'], options['REFRESH_INTERVAL'])
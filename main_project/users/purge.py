@@ -0,0 +1,31 @@
+import datetime
+
+from django.utils import timezone
+
+from . import sharding
+from .models import MyUser
+
+
+def purge_deleted_users(batch_size, older_than=datetime.timedelta(0), max_batches=None):
+    """
+    removes soft-deleted users of every shard (and their directory rows) in small transactions,
+    so the table is never locked for long. Returns number of removed users
+    """
+    cutoff = timezone.now() - older_than
+    purged = 0
+    batches = 0
+    for shard in sharding.get_shards():
+        while max_batches is None or batches < max_batches:
+            with sharding.atomic():
+                ids = list(MyUser.all_objects.using(shard).filter(deleted_at__isnull=False, deleted_at__lte=cutoff)
+                           .values_list('id', flat=True)[:batch_size])
+                if not ids:
+                    break
+                MyUser.all_objects.using(shard).filter(id__in=ids).delete()
+                if sharding.is_sharded():
+                    sharding.directory().filter(id__in=ids).delete()
+
+            purged += len(ids)
+            batches += 1
+
+    return purged
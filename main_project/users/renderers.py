@@ -0,0 +1,59 @@
+import datetime
+
+from rest_framework.renderers import BaseRenderer
+
+try:
+    import msgpack
+except ImportError:  # msgpack is optional, without it only json is served
+    msgpack = None
+
+try:
+    import cbor2
+except ImportError:  # cbor2 is optional, without it only json is served
+    cbor2 = None
+
+
+def _encode_default(value):
+    """
+    dates are sent as iso strings, the same way as in json responses
+    """
+    if isinstance(value, (datetime.date, datetime.datetime)):
+        return value.isoformat()
+    raise TypeError(f'Object of type {type(value).__name__} is not serializable')
+
+
+def _with_plain_dates(value):
+    if isinstance(value, dict):
+        return {key: _with_plain_dates(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_with_plain_dates(item) for item in value]
+    if isinstance(value, (datetime.date, datetime.datetime)):
+        return value.isoformat()
+    return value
+
+
+class MessagePackRenderer(BaseRenderer):
+    media_type = 'application/msgpack'
+    format = 'msgpack'
+    charset = None
+    render_style = 'binary'
+    available = msgpack is not None
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+        return msgpack.packb(data, default=_encode_default, use_bin_type=True)
+
+
+class CBORRenderer(BaseRenderer):
+    media_type = 'application/cbor'
+    format = 'cbor'
+    charset = None
+    render_style = 'binary'
+    available = cbor2 is not None
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+        # cbor2 knows dates itself, but tags them, which is not what json clients of the same schema expect
+        return cbor2.dumps(_with_plain_dates(data))
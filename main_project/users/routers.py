@@ -0,0 +1,32 @@
+from django.conf import settings
+
+from .sharding import is_sharded, shard_of
+
+
+class UserShardRouter:
+    """
+    database router for users.sharding. Instances of users are read and written on the database they were
+    loaded from (django's default for instances), new ones with an id go to the shard the directory
+    allocated it on. The directory is migrated only in its database, cities may be related to users of any
+    shard since they are copied to every shard. Does nothing while there is one shard
+    """
+
+    def db_for_write(self, model, **hints):
+        instance = hints.get('instance')
+        if (model._meta.label == 'users.MyUser' and instance is not None and instance._state.db is None
+                and instance.id is not None and is_sharded()):
+            return shard_of(instance.id)
+
+        return None
+
+    def allow_relation(self, obj1, obj2, **hints):
+        if is_sharded() and obj1._meta.app_label == obj2._meta.app_label == 'users':
+            return True
+
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        if app_label == 'users' and model_name == 'usershard':
+            return db == settings.USERS_SHARDING['DIRECTORY']
+
+        return None
@@ -86,7 +86,9 @@ UsersListElementModel = openapi.Schema(
     properties={"id": openapi.Schema(title="Id", type=openapi.TYPE_INTEGER),
                 "first_name": openapi.Schema(title="First Name", type=openapi.TYPE_STRING),
                 "last_name": openapi.Schema(title="Last Name", type=openapi.TYPE_STRING),
-                "email": openapi.Schema(title="Email", type=openapi.TYPE_STRING)}
+                "email": openapi.Schema(title="Email", type=openapi.TYPE_STRING),
+                "city_name": openapi.Schema(title="City Name", type=openapi.TYPE_STRING,
+                                            description='only with include=city_name, empty for users without city')}
 )
 
 PaginatedMetaDataModel = openapi.Schema(
@@ -144,6 +146,37 @@ PrivateUpdateUserModel = openapi.Schema(
                 "additional_info": openapi.Schema(title="Additional Info", type=openapi.TYPE_STRING)}
 )
 
+LayoutParameter = openapi.Parameter(
+    name='layout', type=openapi.TYPE_STRING, in_=openapi.IN_QUERY, enum=['rows', 'columnar'],
+    description='columnar returns data as {"id": [...], "first_name": [...], ...} instead of array of objects'
+)
+
+SortParameter = openapi.Parameter(
+    name='sort', type=openapi.TYPE_STRING, in_=openapi.IN_QUERY,
+    description='comma separated fields, "-" before a field sorts it descending, e.g. last_name,-birthday. '
+                'Supported: id, first_name, last_name, email, birthday, last_name,first_name, last_name,-birthday '
+                'and the same with every direction reversed. Ties are broken by id, default is id'
+)
+
+ActiveSinceParameter = openapi.Parameter(
+    name='active_since', type=openapi.TYPE_STRING, in_=openapi.IN_QUERY,
+    description='ISO 8601 date or datetime (UTC if no offset is given), only users active since then are listed. '
+                'Activity is written in batches, so it lags behind by a few seconds'
+)
+
+IncludeParameter = openapi.Parameter(
+    name='include', type=openapi.TYPE_STRING, in_=openapi.IN_QUERY, enum=['city_name'],
+    description='comma separated optional fields added to every user. city_name is stored with the user, '
+                'so it costs no join; after a city is renamed it is updated in background'
+)
+
+IdsParameter = openapi.Parameter(
+    name='ids', type=openapi.TYPE_STRING, in_=openapi.IN_QUERY,
+    description='comma separated user ids (up to USERS_BATCH_MAX_IDS) to get instead of a page: users are returned '
+                'in the same order, response meta is {"missing": [ids of users which don\'t exist]} then, '
+                'page and size are ignored'
+)
+
 UsersListMetaDataModel = openapi.Schema(
     title="UsersListMetaDataModel",
     required=["pagination"],
@@ -182,3 +215,205 @@ UpdateUserResponseModel = openapi.Schema(
                 "phone": openapi.Schema(title="Phone", type=openapi.TYPE_STRING),
                 "birthday": openapi.Schema(title="Last Name", type=openapi.TYPE_STRING, format=openapi.FORMAT_DATE)}
 )
+
+UserChangeModel = openapi.Schema(
+    title="UserChangeModel",
+    required=["seq", "user_id", "action", "data", "created_at"],
+    type=openapi.TYPE_OBJECT,
+    properties={"seq": openapi.Schema(title='Seq', type=openapi.TYPE_INTEGER),
+                "user_id": openapi.Schema(title='User Id', type=openapi.TYPE_INTEGER),
+                "action": openapi.Schema(title='Action', type=openapi.TYPE_STRING,
+                                         enum=['created', 'updated', 'deleted', 'archived', 'restored', 'erased'],
+                                         description='archived users are moved out of lists but still readable '
+                                                     'by id, restored ones are back, erased ones are deleted '
+                                                     'from the archive'),
+                "data": PrivateDetailUserResponseModel,
+                "created_at": openapi.Schema(title='Created At', type=openapi.TYPE_STRING,
+                                             format=openapi.FORMAT_DATETIME)}
+)
+
+UserChangesResponseModel = openapi.Schema(
+    title="UserChangesResponseModel",
+    required=["data", "meta"],
+    type=openapi.TYPE_OBJECT,
+    properties={"data": openapi.Schema(title='Data', type=openapi.TYPE_ARRAY, items=UserChangeModel),
+                "meta": openapi.Schema(title='Meta', type=openapi.TYPE_OBJECT,
+                                       properties={"last_seq": openapi.Schema(title='Last Seq',
+                                                                              type=openapi.TYPE_INTEGER)})}
+)
+
+CreateJobModel = openapi.Schema(
+    title="CreateJobModel",
+    required=["kind"],
+    type=openapi.TYPE_OBJECT,
+    properties={"kind": openapi.Schema(title='Kind', type=openapi.TYPE_STRING,
+                                       enum=['reassign_city', 'rename_city', 'export', 'import', 'purge', 'archive']),
+                "params": openapi.Schema(title='Params', type=openapi.TYPE_OBJECT,
+                                         description='reassign_city: {"from_city": id, "to_city": id}, '
+                                                     'rename_city: {"city": id}, '
+                                                     'import: {"users": [PrivateCreateUserModel, ...]}, '
+                                                     'purge: {"older_than": seconds}, '
+                                                     'archive: {"inactive_for": seconds}, export: {}')}
+)
+
+JobModel = openapi.Schema(
+    title="JobModel",
+    required=["id", "kind", "params", "status", "progress", "total", "result", "error", "created_at",
+              "started_at", "finished_at"],
+    type=openapi.TYPE_OBJECT,
+    properties={"id": openapi.Schema(title='Id', type=openapi.TYPE_INTEGER),
+                "kind": openapi.Schema(title='Kind', type=openapi.TYPE_STRING),
+                "params": openapi.Schema(title='Params', type=openapi.TYPE_OBJECT),
+                "status": openapi.Schema(title='Status', type=openapi.TYPE_STRING,
+                                         enum=['queued', 'running', 'succeeded', 'failed']),
+                "progress": openapi.Schema(title='Progress', type=openapi.TYPE_INTEGER),
+                "total": openapi.Schema(title='Total', type=openapi.TYPE_INTEGER),
+                "result": openapi.Schema(title='Result', type=openapi.TYPE_OBJECT,
+                                         description='export: {"exported": n, "parts": n}, '
+                                                     'parts are read from /private/jobs/{id}/output'),
+                "error": openapi.Schema(title='Error', type=openapi.TYPE_STRING),
+                "created_at": openapi.Schema(title='Created At', type=openapi.TYPE_STRING,
+                                             format=openapi.FORMAT_DATETIME),
+                "started_at": openapi.Schema(title='Started At', type=openapi.TYPE_STRING,
+                                             format=openapi.FORMAT_DATETIME),
+                "finished_at": openapi.Schema(title='Finished At', type=openapi.TYPE_STRING,
+                                              format=openapi.FORMAT_DATETIME)}
+)
+
+JobModel = openapi.Schema(
+    title="CreateJobModel",
+    required=["kind"],
+    type=openapi.TYPE_OBJECT,
+    properties={"kind": openapi.Schema(title='Kind', type=openapi.TYPE_STRING,
+                                       enum=['reassign_city', 'rename_city', 'export', 'import', 'purge', 'archive']),
+                "params": openapi.Schema(title='Params', type=openapi.TYPE_OBJECT,
+                                         description='reassign_city: {"from_city": id, "to_city": id}, '
+                                                     'rename_city: {"city": id}, '
+                                                     'import: {"users": [PrivateCreateUserModel, ...]}, '
+                                                     'purge: {"older_than": seconds}, '
+                                                     'archive: {"inactive_for": seconds}, export: {}')}
+)
+
+JobListElementModel = openapi.Schema(
+    title="JobListElementModel",
+    required=["id", "kind", "params", "status", "progress", "total", "error", "created_at",
+              "started_at", "finished_at"],
+    type=openapi.TYPE_OBJECT,
+    properties={"id": openapi.Schema(title='Id', type=openapi.TYPE_INTEGER),
+                "kind": openapi.Schema(title='Kind', type=openapi.TYPE_STRING),
+                "params": openapi.Schema(title='Params', type=openapi.TYPE_OBJECT),
+                "status": openapi.Schema(title='Status', type=openapi.TYPE_STRING,
+                                         enum=['queued', 'running', 'succeeded', 'failed']),
+                "progress": openapi.Schema(title='Progress', type=openapi.TYPE_INTEGER),
+                "total": openapi.Schema(title='Total', type=openapi.TYPE_INTEGER),
+                "error": openapi.Schema(title='Error', type=openapi.TYPE_STRING),
+                "created_at": openapi.Schema(title='Created At', type=openapi.TYPE_STRING,
+                                             format=openapi.FORMAT_DATETIME),
+                "started_at": openapi.Schema(title='Started At', type=openapi.TYPE_STRING,
+                                             format=openapi.FORMAT_DATETIME),
+                "finished_at": openapi.Schema(title='Finished At', type=openapi.TYPE_STRING,
+                                              format=openapi.FORMAT_DATETIME)}
+)
+
+JobsListResponseModel = openapi.Schema(
+    title="JobsListResponseModel",
+    required=["data"],
+    type=openapi.TYPE_OBJECT,
+    properties={"data": openapi.Schema(title='Data', type=openapi.TYPE_ARRAY, items=JobListElementModel)}
+)
+
+JobOutputResponseModel = openapi.Schema(
+    title="JobOutputResponseModel",
+    required=["data", "meta"],
+    type=openapi.TYPE_OBJECT,
+    properties={"data": openapi.Schema(title='Data', type=openapi.TYPE_ARRAY, items=PrivateDetailUserResponseModel),
+                "meta": openapi.Schema(title='Meta', type=openapi.TYPE_OBJECT,
+                                       properties={"part": openapi.Schema(title='Part', type=openapi.TYPE_INTEGER)})}
+)
+
+StatsResponseModel = openapi.Schema(
+    title="StatsResponseModel",
+    required=["total", "roles", "cities", "birthday_months"],
+    type=openapi.TYPE_OBJECT,
+    properties={"total": openapi.Schema(title='Total', type=openapi.TYPE_INTEGER),
+                "roles": openapi.Schema(title='Roles', type=openapi.TYPE_OBJECT,
+                                        properties={"admin": openapi.Schema(title='Admin', type=openapi.TYPE_INTEGER),
+                                                    "user": openapi.Schema(title='User', type=openapi.TYPE_INTEGER)}),
+                "cities": openapi.Schema(
+                    title='Cities', type=openapi.TYPE_ARRAY,
+                    description='cities having users, most populated first, id and name are null for users without city',
+                    items=openapi.Schema(type=openapi.TYPE_OBJECT,
+                                         properties={"id": openapi.Schema(title='Id', type=openapi.TYPE_INTEGER),
+                                                     "name": openapi.Schema(title='Name', type=openapi.TYPE_STRING),
+                                                     "count": openapi.Schema(title='Count',
+                                                                             type=openapi.TYPE_INTEGER)})),
+                "birthday_months": openapi.Schema(
+                    title='Birthday Months', type=openapi.TYPE_ARRAY,
+                    description='months having birthdays, month is null for users without birthday',
+                    items=openapi.Schema(type=openapi.TYPE_OBJECT,
+                                         properties={"month": openapi.Schema(title='Month', type=openapi.TYPE_INTEGER),
+                                                     "count": openapi.Schema(title='Count',
+                                                                             type=openapi.TYPE_INTEGER)}))}
+)
+
+BirthdayUserModel = openapi.Schema(
+    title="BirthdayUserModel",
+    required=["id", "first_name", "last_name", "email", "birthday", "next_birthday"],
+    type=openapi.TYPE_OBJECT,
+    properties={"id": openapi.Schema(title='Id', type=openapi.TYPE_INTEGER),
+                "first_name": openapi.Schema(title='First Name', type=openapi.TYPE_STRING),
+                "last_name": openapi.Schema(title='Last Name', type=openapi.TYPE_STRING),
+                "email": openapi.Schema(title='Email', type=openapi.TYPE_STRING),
+                "birthday": openapi.Schema(title='Birthday', type=openapi.TYPE_STRING, format=openapi.FORMAT_DATE),
+                "next_birthday": openapi.Schema(title='Next Birthday', type=openapi.TYPE_STRING,
+                                                format=openapi.FORMAT_DATE,
+                                                description='date in the window birthday is celebrated on, '
+                                                            'Feb 28 for Feb 29 birthdays in non-leap years')}
+)
+
+BirthdaysResponseModel = openapi.Schema(
+    title="BirthdaysResponseModel",
+    required=["data", "meta"],
+    type=openapi.TYPE_OBJECT,
+    properties={"data": openapi.Schema(title='Data', type=openapi.TYPE_ARRAY, items=BirthdayUserModel),
+                "meta": openapi.Schema(title='Meta', type=openapi.TYPE_OBJECT,
+                                       properties={"pagination": PaginatedMetaDataModel,
+                                                   "from": openapi.Schema(title='From', type=openapi.TYPE_STRING,
+                                                                          format=openapi.FORMAT_DATE),
+                                                   "days": openapi.Schema(title='Days', type=openapi.TYPE_INTEGER)})}
+)
+
+CityModel = openapi.Schema(
+    title="CityModel",
+    required=["id", "name"],
+    type=openapi.TYPE_OBJECT,
+    properties={"id": openapi.Schema(title='Id', type=openapi.TYPE_INTEGER),
+                "name": openapi.Schema(title='Name', type=openapi.TYPE_STRING)}
+)
+
+CreateCityModel = openapi.Schema(
+    title="CreateCityModel",
+    required=["name"],
+    type=openapi.TYPE_OBJECT,
+    properties={"name": openapi.Schema(title='Name', type=openapi.TYPE_STRING, max_length=50)}
+)
+
+CitiesListResponseModel = openapi.Schema(
+    title="CitiesListResponseModel",
+    required=["data", "meta"],
+    type=openapi.TYPE_OBJECT,
+    properties={"data": openapi.Schema(title='Data', type=openapi.TYPE_ARRAY, items=CityModel),
+                "meta": openapi.Schema(title='Meta', type=openapi.TYPE_OBJECT,
+                                       properties={"total": openapi.Schema(title='Total', type=openapi.TYPE_INTEGER,
+                                                                           description='number of matching cities')})}
+)
+
+RenameCityResponseModel = openapi.Schema(
+    title="RenameCityResponseModel",
+    required=["id", "name", "job"],
+    type=openapi.TYPE_OBJECT,
+    properties={"id": openapi.Schema(title='Id', type=openapi.TYPE_INTEGER),
+                "name": openapi.Schema(title='Name', type=openapi.TYPE_STRING),
+                "job": openapi.Schema(title='Job', type=openapi.TYPE_INTEGER,
+                                      description='id of the rename_city job copying the name to users')}
+)
@@ -1,13 +1,28 @@
+import copy
+
+from django.conf import settings
 from rest_framework import serializers
-from .models import MyUser
+from .models import MyUser, City
+from .cities import city_exists
+from .sharding import create_user, get_by_login, is_sharded
 from django.core.validators import EmailValidator
 
 
-class LoginModelSerializer(serializers.ModelSerializer):
-    class Meta:
-        model = MyUser
-        fields = []
+class PrecompiledFieldsMixin:
+    """
+    fields (with their validators) are built once per serializer class and instances get copies of them,
+    otherwise ModelSerializer introspects the model on every instantiation
+    """
+
+    def get_fields(self):
+        cls = type(self)
+        if '_precompiled_fields' not in cls.__dict__:
+            cls._precompiled_fields = super().get_fields()
+
+        return copy.deepcopy(cls._precompiled_fields)
 
+
+class LoginModelSerializer(serializers.Serializer):
     def is_valid(self, raise_exception=False):
         valid = super(LoginModelSerializer, self).is_valid()
         temp_errors = {}
@@ -27,26 +42,44 @@ class LoginModelSerializer(serializers.ModelSerializer):
 
     def get_instance(self):
         login = self.validated_data['login']
-        return MyUser.objects.get(email=login)
+        return get_by_login(login)  # on the shard of the user
+
+
+class CityIdMixin:
+    """
+    city is given by id, which is checked against the city index instead of loading the city
+    """
+
+    def validate_city(self, value):
+        if value is not None and not city_exists(value):
+            raise serializers.ValidationError('city with such id doesn\'t exist')
 
+        return value
+
+
+class PrivateCreateUserModelSerializer(CityIdMixin, PrecompiledFieldsMixin, serializers.ModelSerializer):
+    city = serializers.IntegerField(required=False, allow_null=True, source='city_id')
 
-class PrivateCreateUserModelSerializer(serializers.ModelSerializer):
     class Meta:
         model = MyUser
-        fields = ["first_name", "last_name", "email", "is_admin", "password"]
+        fields = ["first_name", "last_name", "email", "is_admin", "password", "city"]
+        extra_kwargs = {'email': {'validators': []}}  # no UniqueValidator SELECT, the database enforces uniqueness
 
     def is_valid(self, raise_exception=False):
         temp_data = self.initial_data.copy()
         valid = super(PrivateCreateUserModelSerializer, self).is_valid()
 
-        for field in ['other_name', 'phone', 'birthday', 'city', 'additional_info']:
+        for field in ['other_name', 'phone', 'birthday', 'additional_info']:
             if field in temp_data:
                 self.validated_data[field] = temp_data[field]
 
         return valid
 
+    def create(self, validated_data):
+        return create_user(**validated_data)  # on a shard allocated by the directory
 
-class PrivateUpdateUserModelSerializer(serializers.Serializer):
+
+class PrivateUpdateUserModelSerializer(CityIdMixin, PrecompiledFieldsMixin, serializers.Serializer):
     first_name = serializers.CharField(required=False)
     last_name = serializers.CharField(required=False)
     other_name = serializers.CharField(required=False)
@@ -86,9 +119,71 @@ class PrivateUpdateUserModelSerializer(serializers.Serializer):
 #         self.fields = ['first_name', 'last_name', 'other_name', 'phone', 'birthday', 'email']
 
 
-class UpdateUserModelSerializer(serializers.Serializer):
+class UpdateUserModelSerializer(PrecompiledFieldsMixin, serializers.Serializer):
     first_name = serializers.CharField(required=False)
     last_name = serializers.CharField(required=False)
     other_name = serializers.CharField(required=False)
     phone = serializers.CharField(required=False)
     email = serializers.EmailField(required=False)
+
+
+class ReassignCityJobParamsSerializer(serializers.Serializer):
+    from_city = serializers.IntegerField(allow_null=True)  # null means users without city
+    to_city = serializers.IntegerField(allow_null=True)
+
+    def validate(self, attrs):
+        if attrs['from_city'] == attrs['to_city']:
+            raise serializers.ValidationError('from_city and to_city must differ')
+        if attrs['to_city'] is not None and not City.objects.filter(id=attrs['to_city']).exists():
+            raise serializers.ValidationError('city with such id doesn\'t exist')
+
+        return attrs
+
+
+class CreateCitySerializer(PrecompiledFieldsMixin, serializers.ModelSerializer):
+    class Meta:
+        model = City
+        fields = ['name']
+
+
+class RenameCityJobParamsSerializer(serializers.Serializer):
+    city = serializers.IntegerField()
+
+
+class ImportJobParamsSerializer(serializers.Serializer):
+    users = serializers.ListField(child=serializers.DictField(), allow_empty=False)  # validated row by row in job
+
+
+class PurgeJobParamsSerializer(serializers.Serializer):
+    older_than = serializers.IntegerField(min_value=0, default=0)  # seconds since deletion
+
+
+class ArchiveJobParamsSerializer(serializers.Serializer):
+    inactive_for = serializers.IntegerField(min_value=0, required=False)  # seconds since last activity
+
+    def validate(self, attrs):
+        if is_sharded():
+            raise serializers.ValidationError('users aren\'t archived while they are sharded')
+        return {'inactive_for': attrs.get('inactive_for', settings.USERS_ARCHIVE['INACTIVE_FOR'])}
+
+
+JOB_PARAMS_SERIALIZERS = {
+    'reassign_city': ReassignCityJobParamsSerializer,
+    'rename_city': RenameCityJobParamsSerializer,
+    'export': serializers.Serializer,
+    'import': ImportJobParamsSerializer,
+    'purge': PurgeJobParamsSerializer,
+    'archive': ArchiveJobParamsSerializer,
+}
+
+
+class CreateJobSerializer(serializers.Serializer):
+    kind = serializers.ChoiceField(choices=list(JOB_PARAMS_SERIALIZERS))
+    params = serializers.DictField(required=False, default=dict)
+
+    def validate(self, attrs):
+        params = JOB_PARAMS_SERIALIZERS[attrs['kind']](data=attrs['params'])
+        if not params.is_valid():
+            raise serializers.ValidationError({'params': params.errors})
+
+        return {'kind': attrs['kind'], 'params': dict(params.validated_data)}
@@ -0,0 +1,313 @@
+"""
+horizontal sharding of users. Rows of users_myuser are spread over USERS_SHARDING['SHARDS'] databases,
+users_usershard in USERS_SHARDING['DIRECTORY'] database maps every user id to its shard, allocates ids
+of new users and keeps emails of live users unique among shards, so login finds the shard by email.
+Single-user reads and writes go to the shard of the user (users_by_id(), loaders use ShardedUsers),
+lists are scatter-gather: every shard returns its first rows in the same ordering and they are k-way merged.
+Cities are copied to every shard, so users keep their foreign key. With one shard (default) nothing
+here touches the directory and users are queried as before.
+
+Stats are counted on every shard and summed up, birthdays are merged like lists, purge and the export and
+reassign_city jobs go shard after shard. User lists bypass the page index and the directory snapshot,
+which index the default database only, and archiving (users.archive) refuses to run.
+`manage.py rebalance_user_shards` indexes users which aren't in the directory yet (run it once after
+adding shards, before new users are created), removes copies left by interrupted moves and evens out shards
+"""
+import heapq
+import itertools
+import math
+import random
+from contextlib import ExitStack, contextmanager
+
+from django.conf import settings
+from django.core.management.color import no_style
+from django.db import DEFAULT_DB_ALIAS, connections, transaction
+from django.db.models import Count
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from .models import City, MyUser, UserShard, normalize_email
+
+
+def get_shards():
+    return settings.USERS_SHARDING['SHARDS']
+
+
+def is_sharded():
+    return len(get_shards()) > 1
+
+
+def directory():
+    return UserShard.objects.using(settings.USERS_SHARDING['DIRECTORY'])
+
+
+@contextmanager
+def atomic():
+    """
+    transaction.atomic() for writes of users: transactions (or savepoints) of the directory and every shard are
+    nested in the one of the default database, so a user row commits or rolls back together with its outbox row
+    (users.changes) and directory row. Shards commit just before the default database, there is no two-phase commit
+    """
+    with ExitStack() as stack:
+        for alias in dict.fromkeys([DEFAULT_DB_ALIAS, settings.USERS_SHARDING['DIRECTORY'], *get_shards()]):
+            stack.enter_context(transaction.atomic(using=alias))
+        yield
+
+
+def shard_of(user_id):
+    """
+    database alias of the user's shard, None for unknown users
+    """
+    if not is_sharded():
+        return DEFAULT_DB_ALIAS
+
+    return directory().filter(id=user_id).values_list('shard', flat=True).first()
+
+
+def group_by_shard(ids):
+    """
+    {shard: [ids of its users]} with one directory query, unknown ids are left out
+    """
+    shards = {}
+    for user_id, shard in directory().filter(id__in=ids).values_list('id', 'shard'):
+        shards.setdefault(shard, []).append(user_id)
+
+    return shards
+
+
+def users_by_id(user_id, manager=MyUser.objects):
+    """
+    queryset of the user on its shard, empty for unknown users
+    """
+    if not is_sharded():
+        return manager.filter(id=user_id)
+    shard = shard_of(user_id)
+
+    return manager.none() if shard is None else manager.using(shard).filter(id=user_id)
+
+
+def get_by_login(login):
+    """
+    MyUserManager.get_by_login() on the shard found by email in the directory
+    """
+    if not is_sharded():
+        return MyUser.objects.get_by_login(login)
+    shard = directory().filter(email_normalized=normalize_email(login)).values_list('shard', flat=True).first()
+    if shard is None:
+        raise MyUser.DoesNotExist('MyUser matching query does not exist.')
+
+    return MyUser.objects.db_manager(shard).get_by_login(login)
+
+
+def create_user(**fields):
+    """
+    MyUser.objects.create() placing the user on a random shard. Its directory row is written first,
+    so a taken email raises IntegrityError on email_normalized before the user is stored
+    """
+    if not is_sharded():
+        return MyUser.objects.create(**fields)
+
+    with atomic():
+        entry = directory().create(shard=random.choice(get_shards()),
+                                   email_normalized=normalize_email(fields['email']))
+        user = MyUser(id=entry.id, **fields)
+        user.save(force_insert=True, using=entry.shard)
+
+    return user
+
+
+def set_directory_email(user_id, email):
+    """
+    follows email change of the user, None releases the email of a deleted user.
+    Raises IntegrityError on email_normalized when the email is taken on another shard
+    """
+    if is_sharded():
+        directory().filter(id=user_id).update(email_normalized=None if email is None else normalize_email(email))
+
+
+class ShardedUsers:
+    """
+    in_bulk() for loaders.Loader: ids are grouped by the directory, then one IN query per shard
+    """
+    model = MyUser
+
+    def __init__(self, manager=MyUser.objects):
+        self.manager = manager
+
+    def in_bulk(self, ids):
+        found = {}
+        for shard, shard_ids in group_by_shard(ids).items():
+            found.update(self.manager.using(shard).in_bulk(shard_ids))
+
+        return found
+
+
+class _SortKey:
+    """
+    position of a row in order_by(*ordering) of the shards, nulls are ordered as the database orders them
+    """
+    __slots__ = ('values', 'descending', 'nulls_first')
+
+    def __init__(self, values, descending, nulls_first):
+        self.values = values
+        self.descending = descending
+        self.nulls_first = nulls_first
+
+    def __lt__(self, other):
+        for value, other_value, descending in zip(self.values, other.values, self.descending):
+            if value == other_value:
+                continue
+            if value is None or other_value is None:
+                less = (value is None) == self.nulls_first
+            else:
+                less = value < other_value
+            return less != descending
+
+        return False
+
+
+class ShardedPages:
+    """
+    offset pages of `queryset` over every shard, the same interface as utils.QuerysetPages has.
+    Each shard returns its first `stop` users in the ordering (which must end with id) and the streams are
+    k-way merged, so a deep page costs `stop` rows per shard
+    """
+
+    def __init__(self, queryset, ordering, serialize=MyUser.get_short_user_model):
+        self.queryset = queryset
+        self.ordering = ordering
+        self.serialize = serialize
+        self._length = None
+
+    def __len__(self):
+        if self._length is None:
+            self._length = sum(self.queryset.using(shard).count() for shard in get_shards())
+
+        return self._length
+
+    def page(self, start, stop):
+        fields = [key.lstrip('-') for key in self.ordering]
+        descending = [key.startswith('-') for key in self.ordering]
+        nulls_first = connections[get_shards()[0]].vendor != 'postgresql'  # sqlite puts nulls first
+
+        def sort_key(user):
+            return _SortKey([getattr(user, field) for field in fields], descending, nulls_first)
+
+        streams = [self.queryset.using(shard).order_by(*self.ordering)[:stop] for shard in get_shards()]
+
+        return [self.serialize(user) for user in itertools.islice(heapq.merge(*streams, key=sort_key), start, stop)]
+
+
+def replicate_cities():
+    """
+    makes cities of every shard the same as cities of the default database, returns number of changed rows
+    """
+    cities = dict(City.objects.using(DEFAULT_DB_ALIAS).values_list('id', 'name'))
+    changed = 0
+    for shard in get_shards():
+        if shard == DEFAULT_DB_ALIAS:
+            continue
+        copies = dict(City.objects.using(shard).values_list('id', 'name'))
+        for city_id, name in cities.items():
+            if copies.get(city_id) != name:
+                City.objects.using(shard).update_or_create(id=city_id, defaults={'name': name})
+                changed += 1
+        for city in City.objects.using(shard).exclude(id__in=list(cities)):
+            city.delete()
+            changed += 1
+
+    return changed
+
+
+@receiver(post_save, sender=City)
+def _replicate_saved_city(instance, using, raw=False, **kwargs):
+    if using == DEFAULT_DB_ALIAS and not raw and is_sharded():
+        for shard in get_shards():
+            if shard != DEFAULT_DB_ALIAS:
+                City.objects.using(shard).update_or_create(id=instance.id, defaults={'name': instance.name})
+
+
+@receiver(post_delete, sender=City)
+def _replicate_deleted_city(instance, using, **kwargs):
+    if using == DEFAULT_DB_ALIAS and is_sharded():
+        for shard in get_shards():
+            if shard != DEFAULT_DB_ALIAS:
+                for city in City.objects.using(shard).filter(id=instance.id):
+                    city.delete()  # users of the city on the shard lose it as well
+
+
+def sync_directory(shard, batch_size):
+    """
+    adds users of the shard which aren't in the directory (created before sharding was enabled) and removes
+    copies left on it by interrupted moves (users the directory places on another shard).
+    Returns (indexed, removed)
+    """
+    users = MyUser.all_objects.using(shard).order_by('id')
+    indexed = removed = 0
+    last_id = 0
+    while True:
+        batch = list(users.filter(id__gt=last_id).values_list('id', 'email_normalized', 'deleted_at')[:batch_size])
+        if not batch:
+            break
+        last_id = batch[-1][0]
+
+        shards = dict(directory().filter(id__in=[user_id for user_id, _, _ in batch]).values_list('id', 'shard'))
+        UserShard.objects.db_manager(directory().db).bulk_create([
+            UserShard(id=user_id, shard=shard, email_normalized=email if deleted_at is None else None)
+            for user_id, email, deleted_at in batch if user_id not in shards])
+        strays = [user_id for user_id, user_shard in shards.items() if user_shard != shard]
+        MyUser.all_objects.using(shard).filter(id__in=strays).delete()
+        indexed += len(batch) - len(shards)
+        removed += len(strays)
+
+    connection = connections[directory().db]
+    with connection.cursor() as cursor:  # ids allocated later must follow the indexed ones
+        for sql in connection.ops.sequence_reset_sql(no_style(), [UserShard]):
+            cursor.execute(sql)
+
+    return indexed, removed
+
+
+def move_users(ids, source, target):
+    """
+    copies users to the target shard, points the directory to it and removes them from the source,
+    writers of the source wait until it's done. Returns number of moved users
+    """
+    with transaction.atomic(using=source):
+        users = list(MyUser.all_objects.using(source).select_for_update().filter(id__in=ids))
+        with transaction.atomic(using=target):
+            MyUser.all_objects.using(target).filter(id__in=ids).delete()  # copies left by an interrupted move
+            MyUser.all_objects.db_manager(target).bulk_create(users)
+        directory().filter(id__in=ids).update(shard=target)
+        MyUser.all_objects.using(source).filter(id__in=ids).delete()
+
+    return len(users)
+
+
+def rebalance(batch_size):
+    """
+    moves batches of users from the fullest shard to the emptiest one until no shard has more than its share.
+    Shards removed from SHARDS are emptied. Returns {(source, target): number of moved users}
+    """
+    shards = get_shards()
+    counts = dict.fromkeys(shards, 0)
+    counts.update(directory().order_by().values_list('shard').annotate(count=Count('id')))
+    share = math.ceil(sum(counts.values()) / len(shards))
+
+    def excess(shard):
+        return counts[shard] - (share if shard in shards else 0)
+
+    moves = {}
+    while True:
+        source = max(counts, key=excess)
+        target = min(shards, key=counts.get)
+        size = min(excess(source), share - counts[target], batch_size)
+        if size <= 0:
+            break
+        ids = list(directory().filter(shard=source).order_by('-id').values_list('id', flat=True)[:size])
+        move_users(ids, source, target)
+        counts[source] -= len(ids)
+        counts[target] += len(ids)
+        moves[source, target] = moves.get((source, target), 0) + len(ids)
+
+    return moves
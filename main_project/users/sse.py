@@ -0,0 +1,92 @@
+"""
+server-sent events stream of user changes for admin dashboards, mounted at /users/events in asgi.py.
+It is a plain ASGI app because django 4.0 can't stream responses asynchronously
+"""
+import asyncio
+import json
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import close_old_connections
+from django.http.cookie import parse_cookie
+
+from .changes import get_changes
+from .events import get_hub
+from .utils import get_session_user
+
+
+def _authorize(cookies):
+    close_old_connections()
+    try:
+        user, error = get_session_user(cookies)
+        if error is None and not user.is_admin:
+            error = (403, {'code': 10, 'msg': 'only admins can access this info'})
+        return error
+    finally:
+        close_old_connections()
+
+
+def _missed_changes(since):
+    close_old_connections()
+    try:
+        return [change.get_change_model() for change in get_changes(since, settings.USERS_CHANGES_MAX_LIMIT)]
+    finally:
+        close_old_connections()
+
+
+def format_event(event):
+    data = json.dumps(event, cls=DjangoJSONEncoder)
+    return f'id: {event["seq"]}\nevent: {event["action"]}\ndata: {data}\n\n'.encode('utf-8')
+
+
+async def _send_error(send, status, data):
+    await send({'type': 'http.response.start', 'status': status,
+                'headers': [(b'content-type', b'application/json')]})
+    await send({'type': 'http.response.body', 'body': json.dumps(data).encode('utf-8')})
+
+
+async def user_events_app(scope, receive, send):
+    headers = {name.decode('latin-1').lower(): value.decode('latin-1') for name, value in scope['headers']}
+    if scope['method'] != 'GET':
+        await _send_error(send, 405, {'detail': 'Method not allowed'})
+        return
+
+    error = await sync_to_async(_authorize)(parse_cookie(headers.get('cookie', '')))
+    if error is not None:
+        await _send_error(send, *error)
+        return
+
+    hub = get_hub()
+    subscription = hub.subscribe()  # before reading missed changes, so nothing falls in between
+    disconnected = asyncio.ensure_future(_wait_disconnect(receive))
+    try:
+        await send({'type': 'http.response.start', 'status': 200,
+                    'headers': [(b'content-type', b'text/event-stream'), (b'cache-control', b'no-cache'),
+                                (b'x-accel-buffering', b'no')]})
+
+        last_seq = 0
+        if headers.get('last-event-id', '').isdigit():  # reconnecting client, resend what it missed
+            for event in await sync_to_async(_missed_changes)(int(headers['last-event-id'])):
+                await send({'type': 'http.response.body', 'body': format_event(event), 'more_body': True})
+                last_seq = event['seq']
+
+        while not disconnected.done():
+            batch = asyncio.ensure_future(subscription.next_batch(settings.USERS_EVENTS_COALESCE_WINDOW,
+                                                                  settings.USERS_EVENTS_KEEPALIVE))
+            await asyncio.wait([batch, disconnected], return_when=asyncio.FIRST_COMPLETED)
+            if not batch.done():
+                batch.cancel()
+                break
+
+            events = [event for event in batch.result() if event['seq'] > last_seq]
+            body = b''.join(format_event(event) for event in events) or b': keepalive\n\n'
+            await send({'type': 'http.response.body', 'body': body, 'more_body': True})
+    finally:
+        hub.unsubscribe(subscription)
+        disconnected.cancel()
+
+
+async def _wait_disconnect(receive):
+    while (await receive())['type'] != 'http.disconnect':
+        pass
@@ -0,0 +1,251 @@
+"""
+aggregate statistics of live users served by /users/private/stats. Counts live in users_userstat and are changed
+by database triggers on users_myuser and users_archiveduser (archived users are live too) in the same transaction
+as users themselves, so serving them doesn't depend on the number of users. Sqlite drops triggers of a table when
+django remakes it in a migration (e.g. on AddField), so they are reinstalled after every migrate.
+`manage.py check_user_stats` compares counts with the users tables, `manage.py rebuild_user_stats` recomputes them.
+
+Triggers exist for sqlite and postgresql only. Other backends get no triggers, and there counts are only as fresh
+as the last rebuild_user_stats. With sharding every shard counts its own users, reads sum them up.
+On postgresql every insert or delete of a live user updates the same total
+and role rows, so concurrent writers of users serialize on their row locks until commit. Exact counts cost that.
+If it ever limits write throughput, the rows need to be split into several slots per key, summed on read
+"""
+import logging
+
+from django.db import DEFAULT_DB_ALIAS, connection as default_connection, connections, transaction
+from django.db.models import Count
+from django.db.models.functions import ExtractMonth
+
+from .models import ArchivedUser, MyUser, UserStat
+from .sharding import get_shards
+
+logger = logging.getLogger(__name__)
+
+TRIGGER_VENDORS = ('sqlite', 'postgresql')
+
+# dimension -> (columns of users_myuser it depends on, key of a row in sqlite, the same in postgresql).
+# compute_stats() must produce the same keys with the ORM
+DIMENSIONS = {
+    UserStat.TOTAL: ([], "''", "''"),
+    UserStat.CITY: (['city_id'], "COALESCE(CAST({row}.city_id AS TEXT), '')", "COALESCE({row}.city_id::text, '')"),
+    UserStat.ROLE: (['is_admin'], "CASE WHEN {row}.is_admin THEN 'admin' ELSE 'user' END",
+                    "CASE WHEN {row}.is_admin THEN 'admin' ELSE 'user' END"),
+    UserStat.BIRTHDAY_MONTH: (['birthday'],
+                              "COALESCE(CAST(CAST(strftime('%m', {row}.birthday) AS INTEGER) AS TEXT), '')",
+                              "COALESCE(EXTRACT(MONTH FROM {row}.birthday)::int::text, '')"),
+}
+
+# table of users -> (prefix of names of its triggers, condition of a counted row)
+TABLES = {
+    'users_myuser': ('users_userstat', '{row}.deleted_at IS NULL'),
+    'users_archiveduser': ('users_userstat_archive', 'true'),
+}
+
+_SQLITE_ADD = '''
+    INSERT INTO users_userstat (dimension, "key", "count") SELECT '{dimension}', {key}, {delta} WHERE {condition}
+    ON CONFLICT (dimension, "key") DO UPDATE SET "count" = "count" + excluded."count";'''
+
+
+def _key_sql(vendor, dimension, row):
+    columns, sqlite_key, postgresql_key = DIMENSIONS[dimension]
+    return (postgresql_key if vendor == 'postgresql' else sqlite_key).format(row=row)
+
+
+def _sqlite_triggers(table):
+    prefix, live = TABLES[table]
+
+    def add(row, delta, dimensions, condition='true'):
+        return ''.join(_SQLITE_ADD.format(dimension=dimension, key=_key_sql('sqlite', dimension, row), delta=delta,
+                                          condition=condition) for dimension in dimensions)
+
+    yield f'''CREATE TRIGGER IF NOT EXISTS {prefix}_insert AFTER INSERT ON {table}
+              WHEN {live.format(row='NEW')} BEGIN {add('NEW', 1, DIMENSIONS)} END'''
+    yield f'''CREATE TRIGGER IF NOT EXISTS {prefix}_delete AFTER DELETE ON {table}
+              WHEN {live.format(row='OLD')} BEGIN {add('OLD', -1, DIMENSIONS)} END'''
+    for dimension, (columns, _, _) in DIMENSIONS.items():  # saves not changing the dimension don't touch its rows
+        changed = ' OR '.join([f'({live.format(row="OLD")}) != ({live.format(row="NEW")})',
+                               *(f'OLD.{column} IS NOT NEW.{column}' for column in columns)])
+        yield f'''CREATE TRIGGER IF NOT EXISTS {prefix}_update_{dimension} AFTER UPDATE ON {table}
+                  WHEN {changed} BEGIN {add('OLD', -1, [dimension], live.format(row='OLD'))}
+                                       {add('NEW', 1, [dimension], live.format(row='NEW'))} END'''
+
+
+def _postgresql_triggers(table):
+    prefix, live = TABLES[table]
+    yield '''CREATE OR REPLACE FUNCTION users_userstat_add(dimension_ text, key_ text, delta integer) RETURNS void AS $$
+             INSERT INTO users_userstat (dimension, "key", "count") VALUES (dimension_, key_, delta)
+             ON CONFLICT (dimension, "key") DO UPDATE SET "count" = users_userstat."count" + excluded."count"
+             $$ LANGUAGE sql'''
+
+    removed, added = [], []
+    for dimension, (columns, _, _) in DIMENSIONS.items():
+        changed = ' OR '.join(f'OLD.{column} IS DISTINCT FROM NEW.{column}' for column in columns) or 'false'
+        removed.append(f'''IF TG_OP = 'DELETE' OR NOT ({live.format(row='NEW')}) OR {changed} THEN
+                               PERFORM users_userstat_add('{dimension}', {_key_sql('postgresql', dimension, 'OLD')}, -1);
+                           END IF;''')
+        added.append(f'''IF TG_OP = 'INSERT' OR NOT ({live.format(row='OLD')}) OR {changed} THEN
+                             PERFORM users_userstat_add('{dimension}', {_key_sql('postgresql', dimension, 'NEW')}, 1);
+                         END IF;''')
+
+    yield f'''CREATE OR REPLACE FUNCTION {prefix}_track() RETURNS trigger AS $$
+              BEGIN
+                  IF TG_OP <> 'INSERT' AND {live.format(row='OLD')} THEN {''.join(removed)} END IF;
+                  IF TG_OP <> 'DELETE' AND {live.format(row='NEW')} THEN {''.join(added)} END IF;
+                  RETURN NULL;
+              END
+              $$ LANGUAGE plpgsql'''
+    yield f'DROP TRIGGER IF EXISTS {prefix}_track ON {table}'
+    yield f'''CREATE TRIGGER {prefix}_track AFTER INSERT OR DELETE OR UPDATE ON {table}
+              FOR EACH ROW EXECUTE PROCEDURE {prefix}_track()'''
+
+
+def _tables(connection):
+    """
+    users tables created by migrations so far
+    """
+    return [table for table in TABLES if table in connection.introspection.table_names()]
+
+
+def install_triggers(connection=default_connection):
+    """
+    idempotent, does nothing until users_userstat is created by its migration and on backends without triggers
+    """
+    if connection.vendor not in TRIGGER_VENDORS:
+        logger.warning('users_userstat triggers are not implemented for %s, stats are updated only by '
+                       '`manage.py rebuild_user_stats`', connection.vendor)
+        return
+    if 'users_userstat' not in connection.introspection.table_names():
+        return
+    if connection.vendor == 'sqlite':
+        statements = [statement for table in _tables(connection) for statement in _sqlite_triggers(table)]
+    else:
+        statements = [statement for table in _tables(connection) for statement in _postgresql_triggers(table)]
+
+    with connection.cursor() as cursor:
+        for statement in statements:
+            cursor.execute(statement)
+
+
+def drop_triggers(connection=default_connection):
+    if connection.vendor not in TRIGGER_VENDORS:
+        return
+
+    with connection.cursor() as cursor:
+        for table, (prefix, _) in TABLES.items():
+            if connection.vendor == 'postgresql':
+                if table in connection.introspection.table_names():
+                    cursor.execute(f'DROP TRIGGER IF EXISTS {prefix}_track ON {table}')
+                cursor.execute(f'DROP FUNCTION IF EXISTS {prefix}_track()')
+            else:
+                for name in ['insert', 'delete', *(f'update_{dimension}' for dimension in DIMENSIONS)]:
+                    cursor.execute(f'DROP TRIGGER IF EXISTS {prefix}_{name}')
+        if connection.vendor == 'postgresql':
+            cursor.execute('DROP FUNCTION IF EXISTS users_userstat_add(text, text, integer)')
+
+
+def rebuild_stats(connection=default_connection):
+    """
+    recomputes every count from users tables in one transaction, writers wait for it to finish
+    (on backends without triggers the counts are taken with the ORM and writers aren't locked out)
+    """
+    if connection.vendor not in TRIGGER_VENDORS:
+        with transaction.atomic(using=connection.alias):
+            UserStat.objects.using(connection.alias).all().delete()
+            UserStat.objects.using(connection.alias).bulk_create([UserStat(dimension=dimension, key=key, count=count)
+                                                                  for (dimension, key), count
+                                                                  in compute_stats(connection.alias).items()])
+        return
+
+    tables = _tables(connection)
+    columns = ', '.join(sorted({column for columns, _, _ in DIMENSIONS.values() for column in columns}))
+    users = ' UNION ALL '.join(f'SELECT {columns} FROM {table} WHERE {TABLES[table][1].format(row=table)}'
+                               for table in tables)
+    with transaction.atomic(using=connection.alias), connection.cursor() as cursor:
+        if connection.vendor == 'postgresql':
+            cursor.execute(f'LOCK TABLE {", ".join(tables)} IN SHARE MODE')
+        cursor.execute('DELETE FROM users_userstat')
+        for dimension in DIMENSIONS:
+            cursor.execute(f'''INSERT INTO users_userstat (dimension, "key", "count")
+                               SELECT '{dimension}', {_key_sql(connection.vendor, dimension, 'users')}, COUNT(*)
+                               FROM ({users}) users GROUP BY 2''')
+
+
+def stored_stats(using=None):
+    """
+    {(dimension, key): count} without zero counts of the database, summed over every shard of users by default
+    """
+    stats = {}
+    for alias in get_shards() if using is None else [using]:
+        for dimension, key, count in UserStat.objects.using(alias).exclude(count=0).values_list('dimension', 'key',
+                                                                                                'count'):
+            stats[dimension, key] = stats.get((dimension, key), 0) + count
+
+    return {key: count for key, count in stats.items() if count}
+
+
+def compute_stats(using=DEFAULT_DB_ALIAS):
+    """
+    the same as stored_stats(using), but counted from users tables with the ORM, independently of the triggers
+    """
+    stats = {}
+
+    def add(key, count):
+        stats[key] = stats.get(key, 0) + count
+
+    for users in [MyUser.objects.using(using).order_by(), ArchivedUser.objects.using(using).order_by()]:
+        add((UserStat.TOTAL, ''), users.count())
+        for city_id, count in users.values_list('city_id').annotate(count=Count('id')):
+            add((UserStat.CITY, '' if city_id is None else str(city_id)), count)
+        for is_admin, count in users.values_list('is_admin').annotate(count=Count('id')):
+            add((UserStat.ROLE, 'admin' if is_admin else 'user'), count)
+        for month, count in users.values_list(ExtractMonth('birthday')).annotate(count=Count('id')):
+            add((UserStat.BIRTHDAY_MONTH, '' if month is None else str(month)), count)
+
+    return {key: count for key, count in stats.items() if count}
+
+
+def check_stats():
+    """
+    [(dimension, key, stored count, actual count)] for every difference (summed over shards having one),
+    both are read in one transaction of a shard
+    """
+    differences = {}
+    for alias in get_shards():
+        connection = connections[alias]
+        with transaction.atomic(using=alias):
+            if connection.vendor == 'postgresql':
+                with connection.cursor() as cursor:
+                    cursor.execute('SET TRANSACTION ISOLATION LEVEL REPEATABLE READ')
+            stored, actual = stored_stats(alias), compute_stats(alias)
+
+        for key in stored.keys() | actual.keys():
+            if stored.get(key, 0) != actual.get(key, 0):
+                other_stored, other_actual = differences.get(key, (0, 0))
+                differences[key] = (other_stored + stored.get(key, 0), other_actual + actual.get(key, 0))
+
+    return sorted((dimension, key, stored, actual) for (dimension, key), (stored, actual) in differences.items())
+
+
+def _optional_int(key):
+    return int(key) if key else None
+
+
+def get_stats_model(cities):
+    """
+    `cities` is a Loader of cities, names are looked up for cities having users
+    """
+    stats = stored_stats()
+    city_counts = {_optional_int(key): count for (dimension, key), count in stats.items() if dimension == UserStat.CITY}
+    names = dict(zip(city_counts, (city and city.name for city in cities.load_many(list(city_counts)))))
+    months = {_optional_int(key): count for (dimension, key), count in stats.items()
+              if dimension == UserStat.BIRTHDAY_MONTH}
+
+    return {
+        'total': stats.get((UserStat.TOTAL, ''), 0),
+        'roles': {role: stats.get((UserStat.ROLE, role), 0) for role in ['admin', 'user']},
+        'cities': [{'id': city_id, 'name': names[city_id], 'count': count}
+                   for city_id, count in sorted(city_counts.items(), key=lambda item: (-item[1], item[0] or 0))],
+        'birthday_months': [{'month': month, 'count': months[month]}
+                            for month in sorted(months, key=lambda month: month or 13)],
+    }
@@ -1,21 +1,84 @@
+import asyncio
 import datetime
-
-from django.test import TestCase, Client, runner
+import gzip
+import os
+import random
+import tempfile
+import threading
+import time
+import unittest
+from io import BytesIO, StringIO
+
+from django.core.handlers.asgi import ASGIRequest
+from django.test import TestCase, TransactionTestCase, Client, runner, override_settings, RequestFactory
+from django.test.utils import CaptureQueriesContext
+from django.db import connection, transaction, IntegrityError
+from django.http import StreamingHttpResponse
+from django.contrib.auth import get_user_model
 from django.contrib.auth.models import User
+from django.conf import settings
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management import call_command, CommandError
+from django.urls import resolve
+from django.utils import timezone
 import json
-from .models import MyUser, City
+from .models import MyUser, City, UserChange, WebhookSubscription, Job, UserStat, UserShard, ArchivedUser, \
+    day_of_year, is_email_conflict, EMAIL_TAKEN
+from .caching import is_missing_login
+from .throttling import get_login_throttle, TokenBucket
+from .middleware import CompressionMiddleware, choose_codec, GzipCodec
+from .renderers import msgpack, cbor2
+from .serialisers import PrivateCreateUserModelSerializer, JOB_PARAMS_SERIALIZERS
+from .webhooks import deliver_pending
+from .events import coalesce, EventHub, LocalBroker, Subscription
+from .sse import user_events_app
+from .purge import purge_deleted_users
+from .jobs import HANDLERS, claim_jobs, run_job
+from .detail_cache import get_detail_cache, LRUCache, SingleFlight
+from .loaders import Loader
+from .directory import BlobColumn, reset_directory
+from .page_index import Fenwick, get_page_index
+from .utils import QuerysetPages, parse_sort, SORTS
+from .writer import WriteCoordinator, get_write_coordinator, run_write
+from .activity import ActivityBuffer, get_activity_buffer
+from .stats import check_stats, stored_stats, install_triggers, drop_triggers, rebuild_stats
+from .birthdays import celebration_dates, day_ranges, FEB_29
+from .cities import get_city_index, reset_city_index, search_key
+from .city_names import stale_cities
+from .sharding import create_user, get_by_login, move_users, users_by_id, ShardedPages
+from .archive import restore_by_id
 
 
 def authentication_settings(testcase_class: TestCase):
     """
     this will be used in many test to send authorized request
     """
+    reset_login_state()  # ids are reused between tests, so responses cached by other tests must go
     MyUser.objects.create(email='admin@mail.ru', password='password', birthday='2020-08-08', first_name='mario',
                           last_name='super', other_name='some_other')
     testcase_class.client.cookies['userid'] = MyUser.objects.all()[0].id
 
 
+def reset_login_state():
+    """
+    throttling buckets and cached lookups live longer than test transactions
+    """
+    get_login_throttle.cache_clear()
+    get_detail_cache().clear()
+    get_activity_buffer.cache_clear()
+    reset_city_index()
+    cache.clear()
+
+
+def tearDownModule():
+    get_activity_buffer.cache_clear()  # activity of test users must not be flushed to real database at exit
+
+
 class LoginTest(TestCase):
+    def setUp(self):
+        reset_login_state()
+
     def test_no_login_and_pass(self):
         """
         if no login and password in session params, 422 error should be returned as response with corresponding data
@@ -79,6 +142,36 @@ class LoginTest(TestCase):
         self.assertEqual(content['code'], 2)
         self.assertEqual(content['message'], "Incorrect password for such user")
 
+    def test_invalid_body(self):
+        response = self.client.post('/users/login', data='{login', content_type='application/json')
+        self.assertEqual(response.status_code, 422)
+        content = json.loads(response.content.decode('utf-8'))
+        self.assertEqual(content['detail'][0]['loc'][0], "LoginView.post")
+        self.assertEqual(content['detail'][0]['type'], "ParamsParseError")
+
+    @override_settings(USERS_MAX_BODY_SIZE=100)
+    def test_body_too_large(self):
+        response = self.client.post('/users/login', content_type='application/json',
+                                    data={'login': 'a' * 100, 'password': 'password'})
+        self.assertEqual(response.status_code, 413)
+        self.assertEqual(json.loads(response.content)['code'], 12)
+
+    @override_settings(USERS_MAX_BODY_SIZE=100)
+    def test_body_without_length_too_large(self):
+        body = json.dumps({'login': 'a' * 100, 'password': 'password'}).encode('utf-8')
+        request = ASGIRequest({'type': 'http', 'method': 'POST', 'path': '/users/login', 'query_string': b'',
+                               'headers': [(b'content-type', b'application/json')]}, BytesIO(body))
+        response = resolve('/users/login').func(request)
+        self.assertEqual(response.status_code, 413)
+
+    def test_body_without_length(self):
+        authentication_settings(self)
+        body = json.dumps({'login': 'admin@mail.ru', 'password': 'password'}).encode('utf-8')
+        request = ASGIRequest({'type': 'http', 'method': 'POST', 'path': '/users/login', 'query_string': b'',
+                               'headers': [(b'content-type', b'application/json')]}, BytesIO(body))
+        response = resolve('/users/login').func(request)
+        self.assertEqual(response.status_code, 200)
+
     def test_get_request_not_allowed(self):
         """
         there should be only post request to path /users/login
@@ -108,6 +201,115 @@ class LoginTest(TestCase):
 
         self.assertIn('userid', self.client.cookies)
 
+    def test_login_ignores_case_and_spaces(self):
+        MyUser.objects.create(email='Admin@Mail.ru', password='password', birthday='2020-08-08')
+
+        response = self.client.post('/users/login', {'login': ' admin@MAIL.ru ', 'password': 'password'},
+                                    content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.content)['email'], 'Admin@Mail.ru')
+
+    def test_login_is_one_lookup_by_normalized_email(self):
+        user = MyUser.objects.create(email='admin@mail.ru', password='password', birthday='2020-08-08')
+
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(MyUser.objects.get_by_login('ADMIN@mail.ru').id, user.id)
+        self.assertEqual(len(queries), 1)
+        self.assertIn('"email_normalized" =', queries[0]['sql'])
+
+        user.email = 'other@mail.ru'
+        user.save()
+        MyUser.objects.create(email='admin@mail.ru', password='password')
+        self.assertNotEqual(MyUser.objects.get_by_login('admin@mail.ru').id, user.id)
+
+
+class LoginThrottleTest(TestCase):
+    def setUp(self):
+        reset_login_state()
+
+    def test_token_bucket_refills(self):
+        bucket = TokenBucket(2, 10)
+        state, wait = bucket.take(None, 0)
+        self.assertEqual(wait, 0)
+        state, wait = bucket.take(state, 0)
+        self.assertEqual(wait, 0)
+        state, wait = bucket.take(state, 0)
+        self.assertAlmostEqual(wait, 5)
+        state, wait = bucket.take(state, 5)
+        self.assertEqual(wait, 0)
+
+    @override_settings(USERS_LOGIN_THROTTLE={'BACKEND': 'users.throttling.LocMemBucketBackend',
+                                             'IP_RATE': (100, 60), 'LOGIN_RATE': (2, 60)})
+    def test_too_many_attempts_for_login(self):
+        """
+        after login limit is exhausted 429 is returned without looking for the user
+        """
+        get_login_throttle.cache_clear()
+        self.addCleanup(get_login_throttle.cache_clear)
+        MyUser.objects.create(email='opa@mail.ru', password='123', birthday='2020-08-08')
+
+        for _ in range(2):
+            response = self.client.post('/users/login', content_type='application/json',
+                                        data={'login': 'opa@mail.ru', 'password': 'password'})
+            self.assertEqual(response.status_code, 400)
+
+        with self.assertNumQueries(0):
+            response = self.client.post('/users/login', content_type='application/json',
+                                        data={'login': 'opa@mail.ru', 'password': '123'})
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response.reason_phrase, 'Too Many Requests')
+        self.assertEqual(response['Retry-After'], '30')
+        self.assertEqual(json.loads(response.content)['code'], 11)
+
+        response = self.client.post('/users/login', content_type='application/json',
+                                    data={'login': 'other@mail.ru', 'password': '123'})
+        self.assertEqual(response.status_code, 400)  # other logins aren't affected
+
+    @override_settings(USERS_LOGIN_THROTTLE={'BACKEND': 'users.throttling.CacheBucketBackend',
+                                             'IP_RATE': (1, 60), 'LOGIN_RATE': (5, 60)})
+    def test_too_many_attempts_from_ip(self):
+        get_login_throttle.cache_clear()
+        self.addCleanup(get_login_throttle.cache_clear)
+
+        response = self.client.post('/users/login', content_type='application/json',
+                                    data={'login': 'a@mail.ru', 'password': 'password'})
+        self.assertEqual(response.status_code, 400)
+        response = self.client.post('/users/login', content_type='application/json',
+                                    data={'login': 'b@mail.ru', 'password': 'password'})
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response['Retry-After'], '60')
+
+    def test_missing_login_is_cached(self):
+        """
+        second attempt with unknown login doesn't hit db, creating such user makes login possible
+        """
+        authentication_settings(self)
+        admin = MyUser.objects.get(email='admin@mail.ru')
+        admin.is_admin = True
+        admin.save()
+
+        response = self.client.post('/users/login', content_type='application/json',
+                                    data={'login': 'new@mail.ru', 'password': 'password'})
+        self.assertEqual(response.status_code, 400)
+
+        with self.assertNumQueries(0):
+            response = self.client.post('/users/login', content_type='application/json',
+                                        data={'login': 'new@mail.ru', 'password': 'password'})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(json.loads(response.content)['code'], 1)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post('/users/private/users',
+                                        data={"first_name": 'f', "last_name": 'l', "email": 'new@mail.ru',
+                                              "is_admin": False, 'password': 'password'},
+                                        content_type='application/json')
+            self.assertTrue(is_missing_login('new@mail.ru'))  # forgotten once the user is committed
+        self.assertEqual(response.status_code, 201)
+
+        response = self.client.post('/users/login', content_type='application/json',
+                                    data={'login': 'new@mail.ru', 'password': 'password'})
+        self.assertEqual(response.status_code, 200)
+
 
 class LogoutTest(TestCase):
     """
@@ -197,6 +399,112 @@ class UsersListTest(TestCase):
         self.assertEqual(meta['pagination']['size'], 2)
 
 
+    def test_columnar_layout(self):
+        authentication_settings(self)
+        MyUser.objects.create(email='2@mail.ru', first_name='luigi')
+
+        response = self.client.get('/users/users?page=1&size=2&layout=columnar')
+        self.assertEqual(response.status_code, 200)
+        content = json.loads(response.content)['data']
+        self.assertEqual(content, {'id': [1, 2], 'first_name': ['mario', 'luigi'], 'last_name': ['super', ''],
+                                   'email': ['admin@mail.ru', '2@mail.ru']})
+
+
+class CompressionTest(TestCase):
+    def test_large_list_is_compressed(self):
+        authentication_settings(self)
+        for i in range(50):
+            MyUser.objects.create(email=f'{i}@mail.ru', first_name='first name', last_name='last name')
+
+        response = self.client.get('/users/users?page=1&size=50', HTTP_ACCEPT_ENCODING='gzip, deflate')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertIn('Accept-Encoding', response['Vary'])
+        content = json.loads(gzip.decompress(response.content))
+        self.assertEqual(len(content['data']), 50)
+
+    def test_small_response_is_not_compressed(self):
+        authentication_settings(self)
+
+        response = self.client.get('/users/current', HTTP_ACCEPT_ENCODING='gzip')
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(response.has_header('Content-Encoding'))
+        self.assertEqual(json.loads(response.content)['email'], 'admin@mail.ru')
+
+    def test_codec_negotiation(self):
+        self.assertIsNone(choose_codec(''))
+        self.assertIsNone(choose_codec('identity'))
+        self.assertIs(choose_codec('gzip;q=0.5, br;q=0'), GzipCodec)
+        self.assertIsNot(choose_codec('*'), None)
+
+    def test_streaming_response_is_compressed(self):
+        request = RequestFactory().get('/users/export', HTTP_ACCEPT_ENCODING='gzip')
+        chunks = [b'{"id": %d}\n' % i for i in range(1000)]
+        middleware = CompressionMiddleware(lambda request: StreamingHttpResponse(iter(chunks)))
+
+        response = middleware(request)
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertEqual(gzip.decompress(b''.join(response.streaming_content)), b''.join(chunks))
+
+
+@unittest.skipIf(msgpack is None or cbor2 is None, 'msgpack and cbor2 are optional')
+class BinaryFormatsTest(TestCase):
+    def test_msgpack_response(self):
+        authentication_settings(self)
+
+        response = self.client.get('/users/current', HTTP_ACCEPT='application/msgpack')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'application/msgpack')
+        content = msgpack.unpackb(response.content)
+        self.assertEqual(content['email'], 'admin@mail.ru')
+        self.assertEqual(content['birthday'], '2020-08-08')
+
+    def test_cbor_error_response(self):
+        response = self.client.get('/users/users', HTTP_ACCEPT='application/cbor')
+        self.assertEqual(response.status_code, 401)
+        self.assertEqual(cbor2.loads(response.content)['code'], 4)
+
+    def test_json_is_default(self):
+        authentication_settings(self)
+
+        response = self.client.get('/users/current', HTTP_ACCEPT='*/*')
+        self.assertEqual(response['Content-Type'], 'application/json')
+
+    def test_unknown_format_not_acceptable(self):
+        authentication_settings(self)
+
+        response = self.client.get('/users/current', HTTP_ACCEPT='application/xml')
+        self.assertEqual(response.status_code, 406)
+
+    def test_msgpack_request_body(self):
+        authentication_settings(self)
+
+        response = self.client.patch('/users/users/1', data=msgpack.packb({'first_name': 'Luigi'}),
+                                     content_type='application/msgpack', HTTP_ACCEPT='application/cbor')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(cbor2.loads(response.content)['first_name'], 'Luigi')
+        self.assertEqual(MyUser.objects.get(id=1).first_name, 'Luigi')
+
+    def test_broken_body(self):
+        authentication_settings(self)
+
+        response = self.client.patch('/users/users/1', data=b'\xc1', content_type='application/msgpack')
+        self.assertEqual(response.status_code, 422)
+        self.assertEqual(json.loads(response.content)['detail'][0]['type'], 'ParamsParseError')
+
+    def test_json_body_without_content_type(self):
+        authentication_settings(self)
+
+        for name, content_type in [('Luigi', ''), ('Peach', 'text/plain'), ('Toad', 'application/x-www-form-urlencoded')]:
+            response = self.client.patch('/users/users/1', data=json.dumps({'first_name': name}),
+                                         content_type=content_type)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(MyUser.objects.get(id=1).first_name, name)
+
+        response = self.client.patch('/users/users/1', data='first_name=Mario', content_type='text/plain')
+        self.assertEqual(json.loads(response.content)['detail'][0]['type'], 'ParamsParseError')
+
+
 class UsersCurrent(TestCase):
     def test_unauthorized(self):
         response = self.client.get('/users/current')
@@ -281,6 +589,25 @@ class User(TestCase):
 
         self.assertEqual(MyUser.objects.get(id=1).first_name, 'Luigi')
 
+    def test_validation_error_location(self):
+        authentication_settings(self)
+
+        response = self.client.patch('/users/users/1', data={'email': 'wrong'}, content_type='application/json')
+        self.assertEqual(response.status_code, 422)
+        content = json.loads(response.content)['detail'][0]
+        self.assertEqual(content['loc'][0], 'User.patch')
+        self.assertEqual(content['type'], 'UserValidationError')
+
+
+class SerializerFieldsTest(TestCase):
+    def test_fields_are_built_once_and_copied(self):
+        first = PrivateCreateUserModelSerializer(data={})
+        second = PrivateCreateUserModelSerializer(data={})
+        self.assertEqual(list(first.fields), ['first_name', 'last_name', 'email', 'is_admin', 'password', 'city'])
+        self.assertIsNot(first.fields['email'], second.fields['email'])
+        self.assertIs(first.fields['email'].parent, first)
+        self.assertIn('_precompiled_fields', PrivateCreateUserModelSerializer.__dict__)
+
 
 class PrivateUserList(TestCase):
     def test_unauthorized(self):
@@ -395,6 +722,20 @@ class PrivateUserList(TestCase):
 
         self.assertEqual(len(MyUser.objects.all()), 2)  # new one created
 
+    def test_create_user_email_taken_ignoring_case(self):
+        authentication_settings(self)
+        user = MyUser.objects.all()[0]
+        user.is_admin = True
+        user.save()
+
+        response = self.client.post('/users/private/users',
+                                    data={"first_name": 'f', "last_name": 'l', "email": 'ADMIN@mail.ru',
+                                          "is_admin": True, 'password': 123}, content_type='application/json')
+        self.assertEqual(response.status_code, 422)
+        content = json.loads(response.content)['detail'][0]
+        self.assertEqual(content['msg']['email'][0], 'my user with this email already exists.')
+        self.assertEqual(len(MyUser.objects.all()), 1)
+
 
 class PrivateUser(TestCase):
     """
@@ -434,6 +775,15 @@ class PrivateUser(TestCase):
         self.assertEqual(content['city'], None)
         self.assertEqual(content['additional_info'], '')
 
+    def test_get_city_as_id(self):
+        authentication_settings(self)
+        city = City.objects.create(name='Moscow')
+        MyUser.objects.filter(id=1).update(is_admin=True, city=city)
+
+        response = self.client.get('/users/private/users/1')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.content)['city'], city.id)
+
     def test_delete_successful(self):
         authentication_settings(self)
         user = MyUser.objects.all()[0]
@@ -467,3 +817,1427 @@ class PrivateUser(TestCase):
         self.assertEqual(content['additional_info'], '')
 
         self.assertEqual(MyUser.objects.get(id=1).first_name, 'Luigi')
+
+    def test_patch_email_taken(self):
+        admin_settings(self)
+        MyUser.objects.create(email='luigi@mail.ru', password='1', first_name='luigi')
+
+        response = self.client.patch('/users/private/users/1', data={'first_name': 'Luigi', 'email': ' LUIGI@mail.ru'},
+                                     content_type='application/json')
+        self.assertEqual(response.status_code, 422)
+        content = json.loads(response.content)['detail'][0]
+        self.assertEqual(content['loc'], ['PrivateUser.patch'])
+        self.assertEqual(content['msg']['email'][0], 'my user with this email already exists.')
+
+        user = MyUser.objects.get(id=1)  # whole update is rolled back
+        self.assertEqual((user.first_name, user.email), ('mario', 'admin@mail.ru'))
+        self.assertFalse(UserChange.objects.filter(action=UserChange.UPDATED).exists())
+
+    def test_create_doesnt_check_email_beforehand(self):
+        admin_settings(self)
+        data = {'first_name': 'f', 'last_name': 'l', 'email': 'e@m.ru', 'is_admin': False, 'password': '1'}
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post('/users/private/users', data=data, content_type='application/json')
+        self.assertEqual(response.status_code, 201)
+        self.assertFalse([query for query in queries if query['sql'].startswith('SELECT')
+                          and 'email' in query['sql'].split('WHERE')[-1]])
+
+    def test_same_email_is_conflict_of_normalized_email(self):
+        MyUser.objects.create(email='luigi@mail.ru', password='1')
+        with self.assertRaises(IntegrityError) as raised, transaction.atomic():
+            MyUser.objects.create(email='luigi@mail.ru', password='2')
+        self.assertTrue(is_email_conflict(raised.exception))
+        self.assertTrue(is_email_conflict(IntegrityError(  # postgres
+            'duplicate key value violates unique constraint "users_myuser_live_email_normalized_uniq"\n'
+            'DETAIL:  Key (email_normalized)=(luigi@mail.ru) already exists.')))
+
+
+def admin_settings(testcase_class: TestCase):
+    authentication_settings(testcase_class)
+    MyUser.objects.filter(email='admin@mail.ru').update(is_admin=True)
+
+
+class UserChangesTest(TestCase):
+    def test_mutations_are_recorded(self):
+        admin_settings(self)
+
+        response = self.client.post('/users/private/users',
+                                    data={"first_name": 'f', "last_name": 'l', "email": 'e@m.ru',
+                                          "is_admin": False, 'password': 123}, content_type='application/json')
+        self.assertEqual(response.status_code, 201)
+        self.client.patch('/users/private/users/2', data={'first_name': 'Luigi'}, content_type='application/json')
+        self.client.patch('/users/users/1', data={'last_name': 'Mario'}, content_type='application/json')
+        self.client.delete('/users/private/users/2')
+
+        changes = [(change.user_id, change.action) for change in UserChange.objects.order_by('id')]
+        self.assertEqual(changes, [(2, 'created'), (2, 'updated'), (1, 'updated'), (2, 'deleted')])
+        self.assertEqual(UserChange.objects.get(action='updated', user_id=2).data['first_name'], 'Luigi')
+
+    def test_feed_since(self):
+        admin_settings(self)
+        for name in ['a', 'b', 'c']:
+            self.client.patch('/users/users/1', data={'first_name': name}, content_type='application/json')
+        first = UserChange.objects.order_by('id')[0].id
+
+        response = self.client.get(f'/users/changes?since={first}&limit=1')
+        self.assertEqual(response.status_code, 200)
+        content = json.loads(response.content)
+        self.assertEqual(len(content['data']), 1)
+        self.assertEqual(content['data'][0]['seq'], first + 1)
+        self.assertEqual(content['data'][0]['data']['first_name'], 'b')
+        self.assertEqual(content['meta']['last_seq'], first + 1)
+
+        response = self.client.get(f'/users/changes?since={first + 2}')
+        content = json.loads(response.content)
+        self.assertEqual(content['data'], [])
+        self.assertEqual(content['meta']['last_seq'], first + 2)
+
+    def test_feed_is_for_admins(self):
+        authentication_settings(self)
+        response = self.client.get('/users/changes')
+        self.assertEqual(response.status_code, 403)
+
+    def test_feed_params_validation(self):
+        admin_settings(self)
+        response = self.client.get('/users/changes?since=abc')
+        self.assertEqual(response.status_code, 422)
+        self.assertEqual(json.loads(response.content)['detail'][0]['type'], 'ChangesParamsValidation')
+
+    def test_webhooks_delivery_and_retry(self):
+        admin_settings(self)
+        self.client.patch('/users/users/1', data={'first_name': 'a'}, content_type='application/json')
+        self.client.patch('/users/users/1', data={'first_name': 'b'}, content_type='application/json')
+        subscription = WebhookSubscription.objects.create(url='http://example.com/hook')
+
+        def failing(url, data):
+            raise OSError('connection refused')
+
+        with self.assertLogs('users.webhooks', 'WARNING'):
+            self.assertEqual(deliver_pending(10, send=failing), 0)
+        subscription.refresh_from_db()
+        self.assertEqual(subscription.failures, 1)
+        self.assertIsNotNone(subscription.retry_at)
+        self.assertEqual(deliver_pending(10, send=failing), 0)  # not due yet
+        subscription.refresh_from_db()
+        self.assertEqual(subscription.failures, 1)
+
+        subscription.retry_at = None
+        subscription.save()
+        sent = []
+        self.assertEqual(deliver_pending(1, send=lambda url, data: sent.append((url, data))), 1)
+        self.assertEqual(deliver_pending(1, send=lambda url, data: sent.append((url, data))), 1)
+        self.assertEqual(deliver_pending(1, send=lambda url, data: sent.append((url, data))), 0)
+        self.assertEqual([data['data'][0]['data']['first_name'] for url, data in sent], ['a', 'b'])
+        subscription.refresh_from_db()
+        self.assertEqual(subscription.failures, 0)
+        self.assertEqual(subscription.last_seq, UserChange.objects.order_by('-id')[0].id)
+
+    def test_readers_wait_for_missing_seq(self):
+        admin_settings(self)
+        self.client.patch('/users/users/1', data={'first_name': 'a'}, content_type='application/json')
+        first = UserChange.objects.get().id
+        UserChange.objects.create(id=first + 2, user_id=1, action=UserChange.UPDATED)  # first + 1 isn't committed yet
+        subscription = WebhookSubscription.objects.create(url='http://example.com/hook')
+
+        content = json.loads(self.client.get('/users/changes?since=0').content)
+        self.assertEqual([change['seq'] for change in content['data']], [first])
+        sent = []
+        deliver_pending(10, send=lambda url, data: sent.extend(data['data']))
+        self.assertEqual([change['seq'] for change in sent], [first])
+
+        UserChange.objects.create(id=first + 1, user_id=1, action=UserChange.UPDATED)  # committed late
+        content = json.loads(self.client.get(f'/users/changes?since={first}').content)
+        self.assertEqual([change['seq'] for change in content['data']], [first + 1, first + 2])
+        deliver_pending(10, send=lambda url, data: sent.extend(data['data']))
+        self.assertEqual([change['seq'] for change in sent], [first, first + 1, first + 2])
+
+        UserChange.objects.create(id=first + 5, user_id=1, action=UserChange.UPDATED)
+        UserChange.objects.filter(id=first + 5).update(created_at=timezone.now() - datetime.timedelta(minutes=1))
+        content = json.loads(self.client.get(f'/users/changes?since={first + 2}').content)
+        self.assertEqual([change['seq'] for change in content['data']], [first + 5])  # rolled back ones are skipped
+
+    def test_prune(self):
+        admin_settings(self)
+        for name in ['a', 'b', 'c']:
+            self.client.patch('/users/users/1', data={'first_name': name}, content_type='application/json')
+        first, second, last = UserChange.objects.order_by('id').values_list('id', flat=True)
+        UserChange.objects.filter(id__in=[first, last]).update(created_at=timezone.now() - datetime.timedelta(days=60))
+
+        out = StringIO()
+        call_command('prune_user_changes', stdout=out)
+        self.assertIn('pruned 1 changes', out.getvalue())
+        self.assertEqual(list(UserChange.objects.values_list('id', flat=True)), [second, last])  # newest is kept
+
+        content = json.loads(self.client.get(f'/users/changes?since={first}').content)  # reader behind the pruned one
+        self.assertEqual([change['seq'] for change in content['data']], [second, last])
+
+
+def run_asgi(app, path, headers=(), until=None, publish=None):
+    """
+    runs ASGI `app` for GET `path` until response is complete or `until(messages)` is true,
+    `publish` is called from another thread once the response has started
+    """
+    async def main():
+        messages = []
+        disconnect = asyncio.Event()
+        started = asyncio.Event()
+
+        async def receive():
+            await disconnect.wait()
+            return {'type': 'http.disconnect'}
+
+        async def send(message):
+            messages.append(message)
+            if message['type'] == 'http.response.start':
+                started.set()
+            if not message.get('more_body') and message['type'] == 'http.response.body' or \
+                    until is not None and until(messages):
+                disconnect.set()
+
+        scope = {'type': 'http', 'method': 'GET', 'path': path,
+                 'headers': [(name.encode(), value.encode()) for name, value in headers]}
+        task = asyncio.ensure_future(app(scope, receive, send))
+        if publish is not None:
+            await started.wait()
+            await asyncio.get_running_loop().run_in_executor(None, publish)
+        await asyncio.wait_for(task, 5)
+        return messages
+
+    return asyncio.run(main())
+
+
+class EventsHubTest(TestCase):
+    def test_coalesce(self):
+        created = {'seq': 1, 'user_id': 1, 'action': 'created', 'data': {'first_name': 'a'}}
+        updated = {'seq': 2, 'user_id': 1, 'action': 'updated', 'data': {'first_name': 'b'}}
+        deleted = {'seq': 3, 'user_id': 1, 'action': 'deleted', 'data': None}
+        self.assertEqual(coalesce(created, updated), {**updated, 'action': 'created'})
+        self.assertIsNone(coalesce(created, deleted))
+        self.assertEqual(coalesce(updated, deleted), deleted)
+
+    def test_burst_is_coalesced(self):
+        async def main():
+            subscription = Subscription(asyncio.get_running_loop())
+            self.assertEqual(await subscription.next_batch(0, 0.01), [])  # keepalive timeout
+            for seq in range(1, 4):
+                subscription.push({'seq': seq, 'user_id': 1, 'action': 'updated', 'data': {}})
+            subscription.push({'seq': 4, 'user_id': 2, 'action': 'updated', 'data': {}})
+            return await subscription.next_batch(0, 1)
+
+        self.assertEqual([event['seq'] for event in asyncio.run(main())], [3, 4])
+
+    def test_hub_fans_out_from_other_threads(self):
+        broker = LocalBroker()
+        hub = EventHub(broker)
+
+        async def main():
+            first, second = hub.subscribe(), hub.subscribe()
+            thread = threading.Thread(target=broker.publish,
+                                      args=({'seq': 1, 'user_id': 1, 'action': 'created', 'data': {}},))
+            thread.start()
+            thread.join()
+            return await first.next_batch(0, 1), await second.next_batch(0, 1)
+
+        first, second = asyncio.run(main())
+        self.assertEqual(first[0]['seq'], 1)
+        self.assertEqual(second[0]['seq'], 1)
+
+    def test_stream_requires_admin(self):
+        messages = run_asgi(user_events_app, '/users/events')
+        self.assertEqual(messages[0]['status'], 401)
+        self.assertEqual(json.loads(messages[1]['body'])['code'], 4)
+
+
+@override_settings(USERS_EVENTS_COALESCE_WINDOW=0)
+class EventsStreamTest(TransactionTestCase):
+    def test_admin_receives_changes(self):
+        admin = MyUser.objects.create(email='admin@mail.ru', is_admin=True)
+        MyUser.objects.create(email='2@mail.ru')
+
+        def publish():
+            client = Client()
+            client.cookies['userid'] = admin.id
+            client.patch('/users/private/users/2', data={'first_name': 'Luigi'}, content_type='application/json')
+
+        messages = run_asgi(user_events_app, '/users/events', headers=[('cookie', f'userid={admin.id}')],
+                            until=lambda messages: len(messages) > 1, publish=publish)
+        self.assertEqual(messages[0]['status'], 200)
+        self.assertIn((b'content-type', b'text/event-stream'), messages[0]['headers'])
+        body = messages[1]['body'].decode('utf-8')
+        self.assertIn('event: updated', body)
+        self.assertIn('"first_name": "Luigi"', body)
+
+
+class WriteCoordinatorTest(TransactionTestCase):
+    def setUp(self):
+        self.lock = tempfile.NamedTemporaryFile()
+        get_write_coordinator.cache_clear()
+
+    def tearDown(self):
+        get_write_coordinator.cache_clear()
+        self.lock.close()
+
+    def test_waiting_writes_are_committed_together(self):
+        MyUser.objects.create(email='taken@mail.ru')
+        coordinator = WriteCoordinator(self.lock.name, max_batch=100, max_delay=0)
+        first_started, release, commits = threading.Event(), threading.Event(), []
+
+        def write(email, wait=False):
+            def create():
+                if wait:
+                    first_started.set()
+                    release.wait()
+                transaction.on_commit(lambda: commits.append(email))
+                MyUser.objects.create(email=email)
+                return len(commits)  # commits of earlier batches only
+
+            return create
+
+        first = coordinator.submit(write('1@mail.ru', wait=True))
+        first_started.wait()
+        rest = [coordinator.submit(write(email)) for email in ['2@mail.ru', 'taken@mail.ru', '3@mail.ru']]
+        release.set()
+
+        self.assertEqual(first.result(), 0)
+        self.assertEqual(rest[0].result(), 1)
+        self.assertRaises(IntegrityError, rest[1].result)
+        self.assertEqual(rest[2].result(), 1)  # second batch, failed write didn't roll it back
+        self.assertEqual(commits, ['1@mail.ru', '2@mail.ru', '3@mail.ru'])
+
+    def test_views_write_through_coordinator(self):
+        admin = MyUser.objects.create(email='admin@mail.ru', is_admin=True)
+        self.client.cookies['userid'] = admin.id
+        data = {'first_name': 'f', 'last_name': 'l', 'email': 'e@m.ru', 'is_admin': False, 'password': '1'}
+        with override_settings(USERS_WRITE_COORDINATOR={**settings.USERS_WRITE_COORDINATOR, 'ENABLED': True,
+                                                        'LOCK_PATH': self.lock.name}):
+            created = self.client.post('/users/private/users', data=data, content_type='application/json')
+            taken = self.client.post('/users/private/users', data=data, content_type='application/json')
+            deleted = self.client.delete(f'/users/private/users/{admin.id}')
+            writer_alive = get_write_coordinator()._thread.is_alive()
+
+        self.assertEqual(created.status_code, 201)
+        self.assertEqual(taken.status_code, 422)
+        self.assertEqual(deleted.status_code, 204)
+        self.assertTrue(writer_alive)
+        self.assertEqual(list(UserChange.objects.values_list('action', flat=True)), ['created', 'deleted'])
+
+
+class ActivityTest(TestCase):
+    def setUp(self):
+        admin_settings(self)
+        for i in range(2, 5):
+            MyUser.objects.create(email=f'{i}@mail.ru')
+
+    def test_requests_are_buffered(self):
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get('/users/current')
+        self.assertFalse([query for query in queries if query['sql'].startswith('UPDATE')])
+        self.assertEqual(get_activity_buffer().pending(), 1)
+        self.assertIsNone(MyUser.objects.get(id=1).last_seen_at)
+
+        with override_settings(USERS_ACTIVITY={**settings.USERS_ACTIVITY, 'FLUSH_INTERVAL': 0}):
+            self.client.get('/users/current')
+        self.assertEqual(get_activity_buffer().pending(), 0)
+        self.assertIsNotNone(MyUser.objects.get(id=1).last_seen_at)
+
+    def test_flush_batches(self):
+        buffer = ActivityBuffer(batch_size=2)
+        now = timezone.now()
+        MyUser.objects.filter(id=3).update(last_seen_at=now)
+        for user_id in [1, 2, 3, 4]:
+            buffer.touch(user_id, now - datetime.timedelta(minutes=user_id))
+        buffer.touch(1, now - datetime.timedelta(hours=1))  # older one is ignored
+
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(buffer.flush(), 4)
+        self.assertEqual(len([query for query in queries if query['sql'].startswith('UPDATE')]), 2)
+        last_seen = dict(MyUser.objects.values_list('id', 'last_seen_at'))
+        self.assertEqual(last_seen, {1: now - datetime.timedelta(minutes=1), 2: now - datetime.timedelta(minutes=2),
+                                     3: now, 4: now - datetime.timedelta(minutes=4)})  # 3 doesn't move back
+
+    def test_active_since_filter(self):
+        now = timezone.now()
+        MyUser.objects.filter(id__in=[2, 4]).update(last_seen_at=now)
+        MyUser.objects.filter(id=3).update(last_seen_at=now - datetime.timedelta(days=2))
+
+        since = (now - datetime.timedelta(days=1)).date().isoformat()
+        response = self.client.get(f'/users/private/users?page=1&size=10&active_since={since}')
+        self.assertEqual([user['id'] for user in json.loads(response.content)['data']], [2, 4])
+
+        response = self.client.get('/users/private/users?page=1&size=10&active_since=yesterday')
+        self.assertEqual(response.status_code, 422)
+        self.assertEqual(json.loads(response.content)['detail'][0]['type'], 'ActiveSinceParamsValidation')
+
+
+class StatsTest(TestCase):
+    def setUp(self):
+        admin_settings(self)
+        self.moscow, self.kazan = City.objects.create(name='Moscow'), City.objects.create(name='Kazan')
+
+    def test_stats_follow_every_write_path(self):
+        for i, birthday in enumerate(['2000-01-15', '1990-12-31', None], 2):
+            self.client.post('/users/private/users', content_type='application/json',
+                             data={'first_name': 'f', 'last_name': 'l', 'email': f'{i}@mail.ru', 'is_admin': False,
+                                   'password': '1', 'birthday': birthday})
+        self.client.patch('/users/private/users/2', data={'city': self.moscow.id, 'is_admin': True},
+                          content_type='application/json')
+        self.client.patch('/users/private/users/3', data={'city': self.moscow.id, 'birthday': '1990-02-01'},
+                          content_type='application/json')
+        self.client.delete('/users/private/users/4')
+        MyUser.objects.filter(id=1).update(city=self.kazan)  # bulk update around the views
+        HANDLERS['reassign_city'](Job(params={'from_city': self.moscow.id, 'to_city': self.kazan.id}),
+                                  lambda *args: None)
+        purge_deleted_users(100)
+
+        self.assertEqual(check_stats(), [])
+        with self.assertNumQueries(3):  # authorization, counts, city names
+            response = self.client.get('/users/private/stats')
+        self.assertEqual(json.loads(response.content), {
+            'total': 3,
+            'roles': {'admin': 2, 'user': 1},
+            'cities': [{'id': self.kazan.id, 'name': 'Kazan', 'count': 3}],
+            'birthday_months': [{'month': 1, 'count': 1}, {'month': 2, 'count': 1}, {'month': 8, 'count': 1}],
+        })
+
+    def test_stats_require_admin(self):
+        MyUser.objects.filter(id=1).update(is_admin=False)
+        self.assertEqual(self.client.get('/users/private/stats').status_code, 403)
+
+    def test_check_and_rebuild_commands(self):
+        UserStat.objects.filter(dimension=UserStat.TOTAL).update(count=10)
+        UserStat.objects.create(dimension=UserStat.CITY, key=str(self.moscow.id), count=1)
+        with self.assertRaises(CommandError):
+            call_command('check_user_stats', stdout=StringIO())
+
+        call_command('rebuild_user_stats', stdout=StringIO())
+        self.assertEqual(check_stats(), [])
+        self.assertEqual(stored_stats()[UserStat.TOTAL, ''], 1)
+
+    def test_triggers_are_reinstalled(self):
+        drop_triggers()
+        install_triggers()
+        install_triggers()  # idempotent
+        MyUser.objects.create(email='2@mail.ru', city=self.moscow)
+        self.assertEqual(stored_stats()[UserStat.CITY, str(self.moscow.id)], 1)
+
+    def test_backend_without_triggers(self):
+        drop_triggers()
+        connection.vendor = 'mysql'  # the instance attribute shadows the one of sqlite backend
+        try:
+            with self.assertLogs('users.stats', 'WARNING'):
+                install_triggers()
+            MyUser.objects.create(email='2@mail.ru', city=self.moscow)
+            self.assertEqual(stored_stats()[UserStat.TOTAL, ''], 1)  # no trigger
+            rebuild_stats()
+        finally:
+            del connection.vendor
+            install_triggers()
+        self.assertEqual(check_stats(), [])
+
+
+class SoftDeleteTest(TestCase):
+    def test_delete_is_single_update(self):
+        admin_settings(self)
+        MyUser.objects.create(email='2@mail.ru')
+
+        with self.assertNumQueries(5):  # auth, savepoint, update, outbox insert, release savepoint
+            response = self.client.delete('/users/private/users/2')
+        self.assertEqual(response.status_code, 204)
+        self.assertFalse(MyUser.objects.filter(id=2).exists())
+        self.assertIsNotNone(MyUser.all_objects.get(id=2).deleted_at)
+
+        response = self.client.delete('/users/private/users/2')
+        self.assertEqual(response.status_code, 404)
+        response = self.client.get('/users/private/users/2')
+        self.assertEqual(response.status_code, 404)
+
+    def test_deleted_user_is_gone_for_api(self):
+        admin_settings(self)
+        MyUser.objects.create(email='2@mail.ru', password='password')
+        self.client.delete('/users/private/users/2')
+
+        response = self.client.post('/users/login', {'login': '2@mail.ru', 'password': 'password'},
+                                    content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+        self.client.cookies['userid'] = 2
+        self.assertEqual(self.client.get('/users/current').status_code, 401)
+
+    def test_email_can_be_reused(self):
+        admin_settings(self)
+        MyUser.objects.create(email='2@mail.ru')
+        self.client.delete('/users/private/users/2')
+
+        response = self.client.post('/users/private/users',
+                                    data={"first_name": 'f', "last_name": 'l', "email": '2@mail.ru',
+                                          "is_admin": False, 'password': 123}, content_type='application/json')
+        self.assertEqual(response.status_code, 201)
+
+    def test_purge_in_batches(self):
+        for i in range(5):
+            MyUser.objects.create(email=f'{i}@mail.ru')
+        MyUser.objects.filter(email__in=['0@mail.ru', '1@mail.ru', '2@mail.ru']).update(deleted_at=timezone.now())
+
+        self.assertEqual(purge_deleted_users(2, datetime.timedelta(hours=1)), 0)  # too fresh
+        self.assertEqual(purge_deleted_users(2, max_batches=1), 2)
+        self.assertEqual(purge_deleted_users(2), 1)
+        self.assertEqual(MyUser.all_objects.count(), 2)
+
+
+class JobsTest(TestCase):
+    def test_every_kind_has_handler(self):
+        self.assertEqual(set(JOB_PARAMS_SERIALIZERS), set(HANDLERS))
+
+    def test_jobs_are_for_admins(self):
+        authentication_settings(self)
+        response = self.client.post('/users/private/jobs', data={'kind': 'export'}, content_type='application/json')
+        self.assertEqual(response.status_code, 403)
+        self.assertEqual(self.client.get('/users/private/jobs/1').status_code, 403)
+
+    def test_create_validation(self):
+        admin_settings(self)
+        response = self.client.post('/users/private/jobs', data={'kind': 'unknown'}, content_type='application/json')
+        self.assertEqual(response.status_code, 422)
+        response = self.client.post('/users/private/jobs', data={'kind': 'reassign_city', 'params': {'from_city': 1}},
+                                    content_type='application/json')
+        self.assertEqual(response.status_code, 422)
+        self.assertIn('params', json.loads(response.content)['detail'][0]['msg'])
+
+    def test_idempotency_key(self):
+        admin_settings(self)
+        body = {'kind': 'purge', 'params': {'older_than': 60}}
+        first = self.client.post('/users/private/jobs', data=body, content_type='application/json',
+                                 HTTP_IDEMPOTENCY_KEY='abc')
+        self.assertEqual(first.status_code, 202)
+        again = self.client.post('/users/private/jobs', data=body, content_type='application/json',
+                                 HTTP_IDEMPOTENCY_KEY='abc')
+        self.assertEqual(again.status_code, 200)
+        self.assertEqual(json.loads(again.content)['id'], json.loads(first.content)['id'])
+        other = self.client.post('/users/private/jobs', data={'kind': 'export'}, content_type='application/json',
+                                 HTTP_IDEMPOTENCY_KEY='abc')
+        self.assertEqual(other.status_code, 409)
+        self.client.post('/users/private/jobs', data=body, content_type='application/json')
+        self.assertEqual(Job.objects.count(), 2)
+
+    def test_reassign_city_job(self):
+        admin_settings(self)
+        moscow, kazan = City.objects.create(name='Moscow'), City.objects.create(name='Kazan')
+        for i in range(3):
+            MyUser.objects.create(email=f'{i}@mail.ru', city=moscow)
+        response = self.client.post('/users/private/jobs',
+                                    data={'kind': 'reassign_city', 'params': {'from_city': moscow.id,
+                                                                              'to_city': kazan.id}},
+                                    content_type='application/json')
+        job_id = json.loads(response.content)['id']
+        self.assertEqual(json.loads(response.content)['status'], 'queued')
+
+        with override_settings(USERS_JOBS_BATCH_SIZE=2):
+            self.assertEqual(claim_jobs(5), [job_id])
+            self.assertEqual(claim_jobs(5), [])
+            run_job(job_id)
+
+        content = json.loads(self.client.get(f'/users/private/jobs/{job_id}').content)
+        self.assertEqual((content['status'], content['progress'], content['total']), ('succeeded', 3, 3))
+        self.assertEqual(content['result'], {'updated': 3})
+        self.assertEqual(MyUser.objects.filter(city=kazan).count(), 3)
+        self.assertEqual(UserChange.objects.filter(action='updated').count(), 3)
+
+    def test_import_export_with_worker_command(self):
+        admin_settings(self)
+        rows = [{'first_name': 'f', 'last_name': 'l', 'email': 'new@mail.ru', 'is_admin': False, 'password': '1'},
+                {'first_name': 'f', 'last_name': 'l', 'email': 'ADMIN@mail.ru', 'is_admin': False, 'password': '1'}]
+        Job.objects.create(kind='import', params={'users': rows})
+        Job.objects.create(kind='export')
+        with override_settings(USERS_JOBS_BATCH_SIZE=1):
+            call_command('run_jobs', processes=0, once=True)
+
+        imported, exported = Job.objects.order_by('id')
+        self.assertEqual(imported.status, 'succeeded')
+        self.assertEqual(imported.result['created'], 1)
+        self.assertEqual(imported.result['errors'], [{'index': 1, 'msg': {'email': ['my user with this email already exists.']}}])
+        self.assertEqual(exported.result, {'exported': 2, 'parts': 2})
+        emails = []
+        for part in range(2):
+            content = json.loads(self.client.get(f'/users/private/jobs/{exported.id}/output?part={part}').content)
+            self.assertEqual(content['meta'], {'part': part})
+            emails.extend(user['email'] for user in content['data'])
+        self.assertEqual(emails, ['admin@mail.ru', 'new@mail.ru'])
+        self.assertEqual(self.client.get(f'/users/private/jobs/{exported.id}/output?part=2').status_code, 404)
+        self.assertEqual(self.client.get(f'/users/private/jobs/{exported.id}/output?part=x').status_code, 422)
+
+        response = self.client.get('/users/private/jobs?status=succeeded&limit=1')
+        jobs = json.loads(response.content)['data']
+        self.assertEqual([job['id'] for job in jobs], [exported.id])
+        self.assertNotIn('result', jobs[0])  # only the job itself returns it
+
+    def test_failed_job(self):
+        job = Job.objects.create(kind='reassign_city', params={}, status='running')
+        with self.assertLogs('users.jobs', 'ERROR'):
+            run_job(job.id)
+        job.refresh_from_db()
+        self.assertEqual(job.status, 'failed')
+        self.assertIn('KeyError', job.error)
+
+    def test_no_such_job(self):
+        admin_settings(self)
+        self.assertEqual(self.client.get('/users/private/jobs/100').status_code, 404)
+
+
+class DetailCacheTest(TestCase):
+    def setUp(self):
+        admin_settings(self)
+        MyUser.objects.create(email='2@mail.ru', first_name='Luigi')
+
+    def test_cached_response_is_reused(self):
+        self.client.get('/users/private/users/2')
+        with self.assertNumQueries(1):  # authorization only
+            response = self.client.get('/users/private/users/2')
+        self.assertEqual(json.loads(response.content)['first_name'], 'Luigi')
+
+        cache.clear()  # L2 is gone, L1 still answers once version is known again
+        self.client.get('/users/private/users/2')
+        with self.assertNumQueries(1):
+            self.client.get('/users/private/users/2')
+
+    def test_formats_are_cached_separately(self):
+        self.client.get('/users/private/users/2')
+        response = self.client.get('/users/private/users/2', HTTP_ACCEPT='application/msgpack')
+        self.assertEqual(response['Content-Type'], 'application/msgpack')
+        self.assertEqual(msgpack.unpackb(response.content)['first_name'], 'Luigi')
+
+    def test_version_lookup_is_indexed(self):
+        with connection.cursor() as cursor:
+            cursor.execute('EXPLAIN QUERY PLAN SELECT MAX(id) FROM users_userchange WHERE user_id = %s', [2])
+            plan = str(cursor.fetchall())
+        self.assertIn('users_userchange_user_idx', plan)
+
+    def test_mutations_invalidate(self):
+        self.client.get('/users/private/users/2')
+        self.client.get('/users/current')
+        with self.captureOnCommitCallbacks(execute=True):  # versions are bumped on commit
+            self.client.patch('/users/private/users/2', data={'first_name': 'Mario'},
+                              content_type='application/json')
+            self.client.patch('/users/users/1', data={'first_name': 'Peach'}, content_type='application/json')
+        self.assertEqual(json.loads(self.client.get('/users/private/users/2').content)['first_name'], 'Mario')
+        self.assertEqual(json.loads(self.client.get('/users/current').content)['first_name'], 'Peach')
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.delete('/users/private/users/2')
+        self.assertEqual(self.client.get('/users/private/users/2').status_code, 404)
+
+    def test_missing_user_is_not_cached(self):
+        self.assertEqual(self.client.get('/users/private/users/3').status_code, 404)
+        self.assertEqual(cache.get('users:detail:private:3:0:json:lock'), None)
+
+    def test_lru_is_bounded(self):
+        lru = LRUCache(2)
+        lru.set('a', 1)
+        lru.set('b', 2)
+        lru.get('a')
+        lru.set('c', 3)
+        self.assertEqual((lru.get('a'), lru.get('b'), lru.get('c')), (1, None, 3))
+
+    def test_lru_entries_expire(self):
+        lru = LRUCache(2, timeout=0.05)
+        lru.set('a', 1)
+        self.assertEqual(lru.get('a'), 1)
+        time.sleep(0.06)
+        self.assertIsNone(lru.get('a'))
+
+    def test_single_flight(self):
+        flights = SingleFlight()
+        started, release = threading.Event(), threading.Event()
+        calls, results = [], []
+
+        def load():
+            calls.append(1)
+            started.set()
+            release.wait(5)
+            return b'body'
+
+        leader = threading.Thread(target=lambda: results.append(flights.do('key', load)))
+        leader.start()
+        started.wait(5)
+        followers = [threading.Thread(target=lambda: results.append(flights.do('key', load))) for _ in range(3)]
+        for follower in followers:
+            follower.start()
+        time.sleep(0.05)
+        release.set()
+        for thread in [leader, *followers]:
+            thread.join(5)
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, [b'body'] * 4)
+
+
+class BatchGetTest(TestCase):
+    def setUp(self):
+        admin_settings(self)
+        for i in range(2, 5):
+            MyUser.objects.create(email=f'{i}@mail.ru', first_name=f'user{i}')
+
+    def test_private_batch_keeps_order_and_reports_missing(self):
+        with self.assertNumQueries(2):  # authorization and one IN query
+            response = self.client.get('/users/private/users?ids=4,2,10,4')
+        self.assertEqual(response.status_code, 200)
+        content = json.loads(response.content)
+        self.assertEqual([user['id'] for user in content['data']], [4, 2])
+        self.assertIn('additional_info', content['data'][0])
+        self.assertEqual(content['meta'], {'missing': [10]})
+
+    def test_public_batch_returns_short_model(self):
+        MyUser.objects.filter(id=3).update(deleted_at=timezone.now())
+        content = json.loads(self.client.get('/users/users?ids=3,1').content)
+        self.assertEqual(content['data'], [{'id': 1, 'first_name': 'mario', 'last_name': 'super',
+                                            'email': 'admin@mail.ru'}])
+        self.assertEqual(content['meta'], {'missing': [3]})
+
+    @override_settings(USERS_BATCH_MAX_IDS=2)
+    def test_batch_params_validation(self):
+        for ids in ['1,2,3', '1,a', '']:
+            response = self.client.get(f'/users/users?ids={ids}')
+            self.assertEqual(response.status_code, 422)
+            self.assertEqual(json.loads(response.content)['detail'][0]['type'], 'BatchParamsValidation')
+
+
+class LoadersTest(TestCase):
+    def test_ids_are_fetched_together_and_memoized(self):
+        for i in range(1, 4):
+            MyUser.objects.create(email=f'{i}@mail.ru')
+        users = Loader(MyUser.objects.all())
+        with self.assertNumQueries(1):
+            self.assertEqual([user.id for user in users.load_many([3, 1, 2])], [3, 1, 2])
+            self.assertEqual(users.load(2).email, '2@mail.ru')
+            self.assertIsNone(users.load(3).deleted_at)
+        with self.assertNumQueries(1):
+            self.assertIsNone(users.load(10))
+            self.assertIsNone(users.load(10))
+            self.assertRaises(MyUser.DoesNotExist, users.get, 10)
+
+    def test_authorized_user_is_not_fetched_again(self):
+        authentication_settings(self)
+        # the user is selected once for authorization and for the url, then savepoint, update, re-read, save,
+        # outbox insert, release
+        with self.assertNumQueries(7):
+            with self.captureOnCommitCallbacks():
+                response = self.client.patch('/users/users/1', data={'first_name': 'Luigi'},
+                                             content_type='application/json')
+        self.assertEqual(json.loads(response.content)['first_name'], 'Luigi')
+
+    def test_cities_hint_uses_loader(self):
+        admin_settings(self)
+        City.objects.create(name='Moscow')
+        content = json.loads(self.client.get('/users/private/users?page=1&size=10').content)
+        self.assertEqual(content['meta']['hint']['city'], [{'id': 1, 'name': 'Moscow'}])
+
+
+@override_settings(USERS_DIRECTORY_SNAPSHOT={'ENABLED': True, 'REFRESH_INTERVAL': 0, 'RELOAD_INTERVAL': 600})
+class DirectorySnapshotTest(TestCase):
+    def setUp(self):
+        reset_directory()
+        admin_settings(self)
+        for i in range(2, 6):
+            MyUser.objects.create(email=f'{i}@mail.ru', first_name='luigi', last_name=f'l{i}')
+
+    def tearDown(self):
+        reset_directory()
+
+    def test_pages_are_served_from_memory(self):
+        self.client.get('/users/users?page=1&size=2')
+        with self.assertNumQueries(2):  # authorization and check for new changes
+            response = self.client.get('/users/users?page=2&size=2')
+        content = json.loads(response.content)
+        self.assertEqual(content['data'], [{'id': 3, 'first_name': 'luigi', 'last_name': 'l3', 'email': '3@mail.ru'},
+                                           {'id': 4, 'first_name': 'luigi', 'last_name': 'l4', 'email': '4@mail.ru'}])
+        self.assertEqual(content['meta']['pagination'], {'total': 2, 'page': 2, 'size': 2})
+        self.assertEqual(self.client.get('/users/users?page=4&size=2').status_code, 400)
+
+        columnar = json.loads(self.client.get('/users/users?page=3&size=2&layout=columnar').content)
+        self.assertEqual(columnar['data']['id'], [5])
+
+    def test_changes_are_applied(self):
+        self.client.get('/users/users?page=1&size=10')
+        self.client.patch('/users/private/users/3', data={'first_name': 'Mario', 'email': 'new@mail.ru'},
+                          content_type='application/json')
+        self.client.delete('/users/private/users/2')
+        self.client.post('/users/private/users', data={'first_name': 'f', 'last_name': 'l', 'email': 'e@mail.ru',
+                                                       'is_admin': False, 'password': '1'},
+                         content_type='application/json')
+
+        content = json.loads(self.client.get('/users/users?page=1&size=10').content)
+        self.assertEqual([(user['id'], user['first_name'], user['email']) for user in content['data']],
+                         [(1, 'mario', 'admin@mail.ru'), (3, 'Mario', 'new@mail.ru'), (4, 'luigi', '4@mail.ru'),
+                          (5, 'luigi', '5@mail.ru'), (6, 'f', 'e@mail.ru')])
+
+    def test_waits_for_uncommitted_seq(self):
+        self.client.get('/users/users?page=1&size=10')
+        data = {'id': 3, 'first_name': 'Mario', 'last_name': 'l3', 'email': '3@mail.ru'}
+        UserChange.objects.create(id=2, user_id=3, action=UserChange.UPDATED, data=data)  # seq 1 isn't committed yet
+        content = json.loads(self.client.get('/users/users?page=1&size=10').content)
+        self.assertEqual(content['data'][2]['first_name'], 'luigi')
+
+        UserChange.objects.create(id=1, user_id=2, action=UserChange.DELETED)
+        content = json.loads(self.client.get('/users/users?page=1&size=10').content)
+        self.assertEqual([(user['id'], user['first_name']) for user in content['data']],
+                         [(1, 'mario'), (3, 'Mario'), (4, 'luigi'), (5, 'luigi')])
+
+    def test_blob_column_compacts(self):
+        column = BlobColumn()
+        for value in ['a@mail.ru', 'б@почта.рф', 'c@mail.ru']:
+            column.append(value)
+        column.set(0, 'aa@mail.ru')
+        column.delete(2)
+        self.assertEqual([column.get(index) for index in range(len(column))], ['aa@mail.ru', 'б@почта.рф'])
+        self.assertLessEqual(column.garbage * 2, len(column.data))
+
+
+class PageIndexTest(TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        options = {'ENABLED': True, 'PATH': os.path.join(directory.name, 'index.bin'), 'STEP': 2,
+                   'REFRESH_INTERVAL': 0}
+        self.enterContext(override_settings(USERS_PAGE_INDEX=options))
+        get_page_index.cache_clear()
+        self.addCleanup(get_page_index.cache_clear)
+
+    def assertPagesMatch(self, index):
+        expected = QuerysetPages(MyUser.objects.order_by('id'))
+        self.assertEqual(len(index), len(expected))
+        for start in range(len(expected) + 1):
+            self.assertEqual(index.page(start, start + 3), expected.page(start, start + 3), start)
+
+    def test_fenwick_find(self):
+        counts = [4, 0, 3, 1]
+        fenwick = Fenwick(Fenwick.build(counts, 4))
+        self.assertEqual([fenwick.find(offset) for offset in [0, 3, 4, 6, 7]],
+                         [(0, 0), (0, 3), (2, 0), (2, 2), (3, 0)])
+        fenwick.add(0, -2)
+        self.assertEqual(fenwick.find(2), (2, 0))
+
+    def test_pages_follow_changes(self):
+        admin_settings(self)
+        for i in range(2, 20):
+            MyUser.objects.create(email=f'{i}@mail.ru')
+        index = get_page_index()
+        self.assertPagesMatch(index)
+
+        random.seed(7)
+        for i in range(60):  # enough creations to grow the file
+            if random.random() < 0.7:
+                self.client.post('/users/private/users', data={'first_name': 'f', 'last_name': 'l', 'password': '1',
+                                                               'email': f'new{i}@mail.ru', 'is_admin': False},
+                                 content_type='application/json')
+            else:
+                user_id = random.choice(list(MyUser.objects.exclude(id=1).values_list('id', flat=True)))
+                self.client.delete(f'/users/private/users/{user_id}')
+        self.assertPagesMatch(index)
+        self.assertGreater(os.path.getsize(settings.USERS_PAGE_INDEX['PATH']), 16 * 3 * 8)  # has grown
+
+        index.rebuild()
+        self.assertPagesMatch(index)
+
+    def test_waits_for_uncommitted_seq(self):
+        for i in range(1, 5):
+            MyUser.objects.create(email=f'{i}@mail.ru')
+        index = get_page_index()
+        self.assertEqual(len(index), 4)
+
+        MyUser.objects.create(id=10, email='10@mail.ru')
+        UserChange.objects.create(id=2, user_id=10, action=UserChange.CREATED)  # seq 1 isn't committed yet
+        self.assertEqual(len(index), 4)
+        MyUser.objects.create(id=11, email='11@mail.ru')
+        UserChange.objects.create(id=1, user_id=11, action=UserChange.CREATED)
+        self.assertEqual(len(index), 6)
+
+    def test_archive_then_delete(self):
+        admin_settings(self)
+        for i in range(2, 7):
+            MyUser.objects.create(email=f'{i}@mail.ru', last_seen_at=timezone.now())
+        index = get_page_index()
+        self.assertPagesMatch(index)
+        MyUser.objects.filter(id=3).update(last_seen_at=timezone.now() - datetime.timedelta(days=3 * 365))
+        call_command('archive_inactive_users', stdout=StringIO())
+        self.assertPagesMatch(index)
+
+        self.assertEqual(self.client.delete('/users/private/users/3').status_code, 204)
+        self.assertEqual(UserChange.objects.last().action, UserChange.ERASED)
+        self.assertPagesMatch(index)
+        response = self.client.get('/users/users?page=3&size=2')
+        self.assertEqual([user['id'] for user in json.loads(response.content)['data']], [6])
+
+    def test_user_list_uses_index(self):
+        admin_settings(self)
+        for i in range(2, 12):
+            MyUser.objects.create(email=f'{i}@mail.ru')
+        get_page_index().rebuild()
+
+        with self.assertNumQueries(4):  # authorization, two outbox checks, page
+            response = self.client.get('/users/users?page=3&size=3')
+        self.assertEqual([user['id'] for user in json.loads(response.content)['data']], [7, 8, 9])
+        self.assertEqual(self.client.get('/users/users?page=5&size=3').status_code, 400)
+
+
+class SortTest(TestCase):
+    def setUp(self):
+        admin_settings(self)
+        for i, (last_name, birthday) in enumerate([('b', '2000-01-01'), ('a', '1990-01-01'), ('b', '2010-01-01'),
+                                                   ('a', '1990-01-01')], 2):
+            MyUser.objects.create(email=f'{i}@mail.ru', last_name=last_name, birthday=birthday)
+
+    def test_parse_sort(self):
+        self.assertEqual(parse_sort('last_name,-birthday'), ['last_name', '-birthday', 'id'])
+        self.assertEqual(parse_sort('-last_name,birthday'), ['-last_name', 'birthday', '-id'])
+        self.assertEqual(parse_sort('-id'), ['-id'])
+        for value in ['phone', 'birthday,last_name', 'last_name,birthday', '']:
+            self.assertRaises(ValueError, parse_sort, value)
+
+    def test_sorted_pages(self):
+        response = self.client.get('/users/users?page=1&size=3&sort=last_name,-birthday')
+        self.assertEqual([user['id'] for user in json.loads(response.content)['data']], [3, 5, 4])
+        response = self.client.get('/users/private/users?page=2&size=3&sort=-last_name,birthday')
+        self.assertEqual([user['id'] for user in json.loads(response.content)['data']], [5, 3])
+
+        response = self.client.get('/users/users?page=1&size=3&sort=phone')
+        self.assertEqual(response.status_code, 422)
+        self.assertEqual(json.loads(response.content)['detail'][0]['type'], 'SortParamsValidation')
+
+    def test_plans_use_indexes(self):
+        for value in SORTS:
+            plan = MyUser.objects.order_by(*parse_sort(value))[20:40].explain()
+            self.assertNotIn('TEMP B-TREE', plan, value)
+
+
+class BirthdaysTest(TestCase):
+    def setUp(self):
+        admin_settings(self)  # born on 2020-08-08
+        for i, birthday in enumerate(['2000-01-02', '1990-12-31', '2000-02-29', None, '1985-12-31'], 2):
+            MyUser.objects.create(email=f'{i}@mail.ru', birthday=birthday)
+
+    def test_day_of_year(self):
+        self.assertEqual(day_of_year(datetime.date(2023, 3, 1)), 61)  # the same in leap and non-leap years
+        self.assertEqual(day_of_year('2000-02-29'), 60)
+        self.assertEqual(day_of_year('2000-02-30'), None)
+        self.assertEqual(MyUser.objects.get(id=3).birthday_day, 366)
+
+    def test_celebration_dates(self):
+        dates = celebration_dates(datetime.date(2026, 12, 29), 7)
+        self.assertEqual(day_ranges(dates), [(364, 366), (1, 4)])
+        self.assertEqual(dates[1], datetime.date(2027, 1, 1))
+
+        dates = celebration_dates(datetime.date(2027, 2, 27), 3)
+        self.assertEqual(day_ranges(dates), [(58, 61)])
+        self.assertEqual(dates[FEB_29], datetime.date(2027, 2, 28))
+        self.assertEqual(celebration_dates(datetime.date(2028, 2, 28), 2)[FEB_29], datetime.date(2028, 2, 29))
+        self.assertEqual(len(celebration_dates(datetime.date(2027, 1, 1), 365)), 366)
+
+    def test_window_wraps_into_january(self):
+        response = self.client.get('/users/private/birthdays?from=2026-12-30&days=5&page=1&size=10')
+        self.assertEqual(response.status_code, 200)
+        content = json.loads(response.content)
+        self.assertEqual([(user['id'], user['next_birthday']) for user in content['data']],
+                         [(3, '2026-12-31'), (6, '2026-12-31'), (2, '2027-01-02')])
+        self.assertEqual(content['meta']['days'], 5)
+
+        response = self.client.get('/users/private/birthdays?from=2026-12-30&days=5&page=2&size=2')
+        self.assertEqual([user['id'] for user in json.loads(response.content)['data']], [2])  # second range
+        response = self.client.get('/users/private/birthdays?from=2026-12-30&days=5&page=3&size=2')
+        self.assertEqual(response.status_code, 400)
+
+    def test_feb_29(self):
+        response = self.client.get('/users/private/birthdays?from=2027-02-28&days=1&page=1&size=10')
+        self.assertEqual([(user['id'], user['birthday'], user['next_birthday'])
+                          for user in json.loads(response.content)['data']], [(4, '2000-02-29', '2027-02-28')])
+        response = self.client.get('/users/private/birthdays?from=2028-02-28&days=1&page=1&size=10')
+        self.assertEqual(json.loads(response.content)['data'], [])
+
+    def test_birthday_day_follows_updates(self):
+        self.client.patch('/users/private/users/5', data={'birthday': '1999-08-09'}, content_type='application/json')
+        response = self.client.get('/users/private/birthdays?from=2026-08-08&days=2&page=1&size=10')
+        self.assertEqual([user['id'] for user in json.loads(response.content)['data']], [1, 5])
+
+    def test_validation(self):
+        for query in ['days=366&page=1&size=1', 'days=0&page=1&size=1', 'from=tomorrow&page=1&size=1', 'days=7']:
+            response = self.client.get(f'/users/private/birthdays?{query}')
+            self.assertEqual(response.status_code, 422, query)
+            self.assertEqual(json.loads(response.content)['detail'][0]['type'], 'BirthdaysParamsValidation')
+
+    def test_plan_uses_index(self):
+        plan = MyUser.objects.filter(birthday_day__range=(364, 366)).order_by('birthday_day', 'id')[:10].explain()
+        self.assertIn('users_myuser_birthday_day_idx', plan)
+        self.assertNotIn('TEMP B-TREE', plan)
+
+
+class CitiesTest(TestCase):
+    def setUp(self):
+        admin_settings(self)
+        for name in ['Москва', 'Мурманск', 'москва-сити', 'Казань', 'Moscow']:
+            City.objects.create(name=name)
+
+    def test_prefix_search(self):
+        response = self.client.get('/users/cities?prefix=МО')
+        self.assertEqual(response.status_code, 200)
+        content = json.loads(response.content)
+        self.assertEqual([city['name'] for city in content['data']], ['Москва', 'москва-сити'])
+        self.assertEqual(content['meta']['total'], 2)
+
+        content = json.loads(self.client.get('/users/cities?prefix=м&limit=1').content)
+        self.assertEqual([city['name'] for city in content['data']], ['Москва'])
+        self.assertEqual(content['meta']['total'], 3)
+        self.assertEqual(json.loads(self.client.get('/users/cities').content)['meta']['total'], 5)
+        self.assertEqual(json.loads(self.client.get('/users/cities?prefix=x').content)['data'], [])
+
+    def test_search_doesnt_query_database(self):
+        self.client.get('/users/cities?prefix=к')
+        with CaptureQueriesContext(connection) as queries:
+            get_city_index().search('к', 10)
+        self.assertEqual([query for query in queries if 'users_city' in query['sql']], [])
+        self.assertEqual(search_key(' КАЗАНЬ '), 'казань')
+
+    def test_create(self):
+        self.client.get('/users/cities?prefix=к')  # index is loaded before the city is created
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post('/users/cities', data={'name': 'Калуга'}, content_type='application/json')
+        self.assertEqual(response.status_code, 201)
+        city = json.loads(response.content)
+        self.assertEqual(city['name'], 'Калуга')
+
+        content = json.loads(self.client.get('/users/cities?prefix=ка').content)
+        self.assertEqual([city['name'] for city in content['data']], ['Казань', 'Калуга'])
+
+        response = self.client.post('/users/private/users',
+                                    data={'first_name': 'f', 'last_name': 'l', 'email': 'new@mail.ru',
+                                          'is_admin': False, 'password': 123, 'city': city['id']},
+                                    content_type='application/json')
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(MyUser.objects.get(email='new@mail.ru').city_id, city['id'])
+
+    def test_unknown_city(self):
+        response = self.client.post('/users/private/users',
+                                    data={'first_name': 'f', 'last_name': 'l', 'email': 'new@mail.ru',
+                                          'is_admin': False, 'password': 123, 'city': 1000},
+                                    content_type='application/json')
+        self.assertEqual(response.status_code, 422)
+        response = self.client.patch('/users/private/users/1', data={'city': 1000}, content_type='application/json')
+        self.assertEqual(response.status_code, 422)
+
+    def test_validation(self):
+        for query in ['limit=0', 'limit=101', 'limit=ten']:
+            response = self.client.get(f'/users/cities?{query}')
+            self.assertEqual(response.status_code, 422, query)
+        response = self.client.post('/users/cities', data={'name': ' '}, content_type='application/json')
+        self.assertEqual(response.status_code, 422)
+
+    def test_create_only_for_admins(self):
+        MyUser.objects.filter(id=1).update(is_admin=False)
+        response = self.client.post('/users/cities', data={'name': 'Калуга'}, content_type='application/json')
+        self.assertEqual(response.status_code, 403)
+        self.assertEqual(self.client.get('/users/cities').status_code, 200)
+        self.client.logout()
+        self.assertEqual(self.client.get('/users/cities').status_code, 401)
+
+
+class CityNamesTest(TestCase):
+    def setUp(self):
+        admin_settings(self)
+        self.moscow = City.objects.create(name='Москва')
+        self.kazan = City.objects.create(name='Казань')
+        MyUser.objects.create(email='2@mail.ru', city=self.moscow)
+        MyUser.objects.create(email='3@mail.ru', city_id=self.kazan.id)
+
+    def names(self):
+        return dict(MyUser.all_objects.values_list('id', 'city_name'))
+
+    def test_name_follows_users_city(self):
+        self.assertEqual(self.names(), {1: '', 2: 'Москва', 3: 'Казань'})
+        self.client.patch('/users/private/users/2', data={'city': self.kazan.id}, content_type='application/json')
+        self.client.patch('/users/private/users/3', data={'city': self.moscow.id}, content_type='application/json')
+        self.assertEqual(self.names(), {1: '', 2: 'Казань', 3: 'Москва'})
+
+        user = MyUser.objects.get(id=2)
+        with CaptureQueriesContext(connection) as queries:
+            user.first_name = 'Luigi'
+            user.save()
+        self.assertEqual([query for query in queries if 'users_city' in query['sql']], [])  # city didn't change
+        user.city_id = self.moscow.id
+        user.save(update_fields=['city'])
+        self.assertEqual(MyUser.objects.get(id=2).city_name, 'Москва')
+
+    def test_rename(self):
+        response = self.client.patch(f'/users/cities/{self.moscow.id}', data={'name': 'Moscow'},
+                                     content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        content = json.loads(response.content)
+        self.assertEqual(content['name'], 'Moscow')
+        self.assertEqual(self.names()[2], 'Москва')  # until the job runs
+
+        run_job(content['job'])
+        self.assertEqual(Job.objects.get(id=content['job']).result, {'updated': 1})
+        self.assertEqual(self.names(), {1: '', 2: 'Moscow', 3: 'Казань'})
+
+        self.assertEqual(self.client.patch('/users/cities/1000', data={'name': 'x'},
+                                           content_type='application/json').status_code, 404)
+
+    def test_rename_only_for_admins(self):
+        MyUser.objects.filter(id=1).update(is_admin=False)
+        response = self.client.patch(f'/users/cities/{self.moscow.id}', data={'name': 'Moscow'},
+                                     content_type='application/json')
+        self.assertEqual(response.status_code, 403)
+
+    def test_reassign_and_delete(self):
+        job = Job.objects.create(kind='reassign_city', params={'from_city': self.moscow.id, 'to_city': self.kazan.id})
+        run_job(job.id)
+        self.assertEqual(self.names(), {1: '', 2: 'Казань', 3: 'Казань'})
+
+        self.kazan.delete()
+        self.assertEqual(self.names(), {1: '', 2: '', 3: ''})
+
+    def test_list_includes_name_without_join(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get('/users/private/users?page=1&size=10&include=city_name')
+        self.assertEqual([user['city_name'] for user in json.loads(response.content)['data']], ['', 'Москва', 'Казань'])
+        self.assertEqual([query for query in queries if 'JOIN' in query['sql']], [])
+
+        response = self.client.get('/users/private/users?page=1&size=10&include=city_name&layout=columnar')
+        self.assertEqual(json.loads(response.content)['data']['city_name'], ['', 'Москва', 'Казань'])
+        response = self.client.get('/users/private/users?ids=3&include=city_name')
+        self.assertEqual(json.loads(response.content)['data'][0]['city_name'], 'Казань')
+        response = self.client.get('/users/private/users?page=1&size=10')
+        self.assertNotIn('city_name', json.loads(response.content)['data'][0])
+
+        response = self.client.get('/users/private/users?page=1&size=10&include=city')
+        self.assertEqual(response.status_code, 422)
+        self.assertEqual(json.loads(response.content)['detail'][0]['type'], 'IncludeParamsValidation')
+
+    def test_repair_command(self):
+        MyUser.objects.filter(id=2).update(city_name='Moscow')
+        MyUser.objects.filter(id=1).update(city_name='Казань')
+        self.assertEqual(stale_cities(), [None, self.moscow.id])
+        with self.assertRaises(CommandError):
+            call_command('repair_city_names', '--check', stdout=StringIO())
+
+        out = StringIO()
+        call_command('repair_city_names', stdout=out)
+        self.assertIn('repaired 2 users of 2 cities', out.getvalue())
+        self.assertEqual(self.names(), {1: '', 2: 'Москва', 3: 'Казань'})
+        call_command('repair_city_names', '--check', stdout=StringIO())
+
+
+SHARDS = ['default', 'users_shard_1', 'users_shard_2']
+
+
+@unittest.skipUnless(set(SHARDS) <= set(settings.DATABASES), 'shard databases are added by main_project.test_settings')
+@override_settings(USERS_SHARDING={'SHARDS': SHARDS, 'DIRECTORY': 'default'})
+class ShardingTest(TestCase):
+    databases = set(SHARDS) & set(settings.DATABASES)
+
+    def setUp(self):
+        reset_login_state()
+        random.seed(3)
+        admin = create_user(email='admin@mail.ru', password='password', first_name='mario', last_name='super',
+                            is_admin=True)
+        self.client.cookies['userid'] = admin.id
+        for i, (last_name, birthday) in enumerate([('b', '1990-01-01'), ('a', '1980-05-05'), ('b', '1985-03-03'),
+                                                   ('c', None), ('a', '1999-09-09'), ('b', '1990-01-01')], 2):
+            response = self.client.post('/users/private/users',
+                                        data={'first_name': 'f', 'last_name': last_name, 'email': f'{i}@mail.ru',
+                                              'is_admin': False, 'password': 'password', 'birthday': birthday},
+                                        content_type='application/json')
+            self.assertEqual(response.status_code, 201)
+        call_command('rebalance_user_shards', stdout=StringIO())
+
+    def counts(self):
+        return [MyUser.objects.using(shard).count() for shard in SHARDS]
+
+    def test_users_are_spread_and_found(self):
+        self.assertEqual(sorted(self.counts()), [2, 2, 3])
+        self.assertEqual(UserShard.objects.count(), 7)
+        for shard, user_id in UserShard.objects.values_list('shard', 'id'):
+            self.assertTrue(MyUser.objects.using(shard).filter(id=user_id).exists())
+            response = self.client.get(f'/users/private/users/{user_id}')
+            self.assertEqual(json.loads(response.content)['id'], user_id)
+
+        user_id, shard = UserShard.objects.exclude(shard='default').values_list('id', 'shard')[0]
+        self.client.cookies['userid'] = user_id  # authorized user lives on a shard too
+        response = self.client.patch(f'/users/users/{user_id}', data={'first_name': 'Luigi'},
+                                     content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(MyUser.objects.using(shard).get(id=user_id).first_name, 'Luigi')
+
+        email = MyUser.objects.using(shard).get(id=user_id).email
+        self.assertEqual(get_by_login(email.upper()).id, user_id)
+        response = self.client.post('/users/login', data={'login': email, 'password': 'password'},
+                                    content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+
+    def test_lists_merge_shards(self):
+        users = [MyUser.objects.using(shard).get(id=user_id)
+                 for shard, user_id in UserShard.objects.order_by('id').values_list('shard', 'id')]
+        by_name = sorted(users, key=lambda user: (user.last_name, -(user.birthday or datetime.date.min).toordinal(),
+                                                  user.id))
+        response = self.client.get('/users/private/users?page=2&size=3&sort=last_name,-birthday')
+        self.assertEqual([user['id'] for user in json.loads(response.content)['data']],
+                         [user.id for user in by_name[3:6]])
+
+        response = self.client.get('/users/users?page=1&size=10')
+        self.assertEqual([user['id'] for user in json.loads(response.content)['data']], sorted(user.id for user in users))
+        response = self.client.get('/users/users?page=1&size=2&sort=-birthday')
+        self.assertEqual(json.loads(response.content)['data'][0]['email'], '6@mail.ru')
+        response = self.client.get('/users/users?page=1&size=1&sort=birthday')  # nulls first, as sqlite orders
+        self.assertIn(json.loads(response.content)['data'][0]['email'], {'admin@mail.ru', '5@mail.ru'})
+
+        self.assertEqual(len(ShardedPages(MyUser.objects.filter(last_name='b'), ['id'])), 3)
+        response = self.client.get(f'/users/users?ids={users[-1].id},{users[0].id},1000')
+        content = json.loads(response.content)
+        self.assertEqual([user['id'] for user in content['data']], [users[-1].id, users[0].id])
+        self.assertEqual(content['meta']['missing'], [1000])
+
+    def test_email_is_unique_among_shards(self):
+        user_id = UserShard.objects.get(email_normalized='2@mail.ru').id
+        response = self.client.post('/users/private/users',
+                                    data={'first_name': 'f', 'last_name': 'l', 'email': ' 2@Mail.ru',
+                                          'is_admin': False, 'password': 'password'}, content_type='application/json')
+        self.assertEqual(response.status_code, 422)
+        response = self.client.patch(f'/users/private/users/{user_id}', data={'email': '3@mail.ru'},
+                                     content_type='application/json')
+        self.assertEqual(response.status_code, 422)
+
+        self.assertEqual(self.client.delete(f'/users/private/users/{user_id}').status_code, 204)
+        self.assertEqual(self.client.get(f'/users/private/users/{user_id}').status_code, 404)
+        response = self.client.post('/users/private/users',
+                                    data={'first_name': 'f', 'last_name': 'l', 'email': '2@mail.ru',
+                                          'is_admin': False, 'password': 'password'}, content_type='application/json')
+        self.assertEqual(response.status_code, 201)
+
+    def test_writes_roll_back_on_every_shard(self):
+        user_id, shard = UserShard.objects.exclude(shard='default').values_list('id', 'shard')[0]
+
+        def write():
+            users_by_id(user_id).update(first_name='Luigi')
+            raise IntegrityError('as if the outbox row failed')
+
+        with self.assertRaises(IntegrityError):
+            run_write(write)
+        self.assertNotEqual(MyUser.objects.using(shard).get(id=user_id).first_name, 'Luigi')
+
+        with tempfile.NamedTemporaryFile() as lock:
+            [(_, error)] = WriteCoordinator(lock.name, max_batch=1, max_delay=0)._commit([(write, None)])  # group commit
+        self.assertIsInstance(error, IntegrityError)
+        self.assertNotEqual(MyUser.objects.using(shard).get(id=user_id).first_name, 'Luigi')
+
+    def test_rebalance_indexes_users_and_removes_stale_copies(self):
+        moved_id = UserShard.objects.filter(shard='users_shard_1').values_list('id', flat=True)[0]
+        stray = MyUser.objects.using('users_shard_1').get(id=moved_id)
+        move_users([moved_id], 'users_shard_1', 'users_shard_2')
+        MyUser.objects.db_manager('users_shard_1').bulk_create([stray])  # as if the move was interrupted
+        MyUser.objects.using('users_shard_1').create(id=100, email='old@mail.ru')  # created before sharding
+
+        out = StringIO()
+        call_command('rebalance_user_shards', stdout=out)
+        self.assertIn('users_shard_1: 1 users indexed, 1 stale copies removed', out.getvalue())
+        self.assertEqual(UserShard.objects.get(id=100).shard, 'users_shard_1')
+        self.assertEqual(sorted(self.counts()), [2, 3, 3])
+        self.assertEqual(sum(MyUser.objects.using(shard).filter(id=moved_id).count() for shard in SHARDS), 1)
+        self.assertGreater(create_user(email='new@mail.ru').id, 100)  # allocation continues after indexed ids
+
+    def test_aggregates_and_jobs_cover_every_shard(self):
+        self.assertEqual(json.loads(self.client.get('/users/private/stats').content)['total'], 7)
+        self.assertEqual(check_stats(), [])
+        response = self.client.get('/users/private/birthdays?from=2026-12-31&days=65&page=1&size=10')
+        self.assertEqual([(user['id'], user['next_birthday']) for user in json.loads(response.content)['data']],
+                         [(2, '2027-01-01'), (7, '2027-01-01'), (4, '2027-03-03')])
+
+        city, other = City.objects.create(name='Москва'), City.objects.create(name='Казань')
+        on_shards = list(UserShard.objects.exclude(shard='default').values_list('id', 'shard'))
+        for user_id, shard in on_shards:
+            MyUser.objects.using(shard).filter(id=user_id).update(city=city)
+        job = Job.objects.create(kind='reassign_city', params={'from_city': city.id, 'to_city': other.id})
+        run_job(job.id)
+        self.assertEqual(Job.objects.get(id=job.id).result, {'updated': len(on_shards)})
+        job = Job.objects.create(kind='export')
+        run_job(job.id)
+        self.assertEqual(Job.objects.get(id=job.id).result['exported'], 7)
+
+        user_id, shard = on_shards[0]
+        self.client.delete(f'/users/private/users/{user_id}')
+        self.assertEqual(purge_deleted_users(100), 1)
+        self.assertFalse(MyUser.all_objects.using(shard).filter(id=user_id).exists())
+        self.assertFalse(UserShard.objects.filter(id=user_id).exists())
+        self.assertEqual(check_stats(), [])
+
+        response = self.client.post('/users/private/jobs', data={'kind': 'archive'}, content_type='application/json')
+        self.assertEqual(response.status_code, 422)
+        with self.assertRaises(ImproperlyConfigured):
+            call_command('archive_inactive_users', stdout=StringIO())
+
+    def test_cities_are_copied_to_shards(self):
+        city = City.objects.create(name='Москва')
+        user_id, shard = UserShard.objects.exclude(shard='default').values_list('id', 'shard')[0]
+        response = self.client.patch(f'/users/private/users/{user_id}', data={'city': city.id},
+                                     content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(MyUser.objects.using(shard).get(id=user_id).city_name, 'Москва')
+
+        City.objects.filter(id=city.id).update(name='Moscow')  # bypasses signals
+        self.assertEqual(json.loads(self.client.get('/users/cities?prefix=mos').content)['data'], [])
+        call_command('rebalance_user_shards', stdout=StringIO())
+        self.assertEqual([City.objects.using(alias).get(id=city.id).name for alias in SHARDS], ['Moscow'] * 3)
+
+        City.objects.get(id=city.id).delete()
+        self.assertEqual([City.objects.using(alias).count() for alias in SHARDS], [0, 0, 0])
+        user = MyUser.objects.using(shard).get(id=user_id)
+        self.assertEqual((user.city_id, user.city_name), (None, ''))
+
+
+class ArchiveTest(TestCase):
+    def setUp(self):
+        admin_settings(self)
+        long_ago = timezone.now() - datetime.timedelta(days=3 * 365)
+        city = City.objects.create(name='Москва')
+        for i, last_seen_at in enumerate([long_ago, long_ago, timezone.now(), None], 2):
+            MyUser.objects.create(email=f'{i}@mail.ru', password='password', birthday='1990-03-01', city=city,
+                                  last_seen_at=last_seen_at)
+        with self.captureOnCommitCallbacks(execute=True):
+            out = StringIO()
+            call_command('archive_inactive_users', stdout=out)
+        self.assertIn('archived 2 users', out.getvalue())
+
+    def test_inactive_users_are_moved(self):
+        self.assertEqual(sorted(MyUser.objects.values_list('id', flat=True)), [1, 4, 5])
+        self.assertEqual(sorted(ArchivedUser.objects.values_list('id', flat=True)), [2, 3])
+        self.assertEqual(list(UserChange.objects.values_list('user_id', 'action')),
+                         [(2, UserChange.ARCHIVED), (3, UserChange.ARCHIVED)])
+        response = self.client.get('/users/users?page=1&size=10')
+        self.assertEqual([user['id'] for user in json.loads(response.content)['data']], [1, 4, 5])
+
+        self.assertEqual(check_stats(), [])  # archived users are still counted
+        self.assertEqual(stored_stats()[UserStat.TOTAL, ''], 5)
+
+    def test_detail_falls_back_to_archive(self):
+        response = self.client.get('/users/private/users/2')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.content)['email'], '2@mail.ru')
+        self.assertEqual(self.client.get('/users/private/users/1000').status_code, 404)
+
+    def test_login_restores_user(self):
+        response = self.client.post('/users/login', data={'login': '2@mail.ru', 'password': 'wrong'},
+                                    content_type='application/json')
+        self.assertEqual(json.loads(response.content)['code'], 2)
+        self.assertTrue(ArchivedUser.objects.filter(id=2).exists())
+
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post('/users/login', data={'login': ' 2@Mail.ru', 'password': 'password'},
+                                        content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.cookies['userid'].value, '2')
+        user = MyUser.objects.get(id=2)
+        self.assertEqual((user.birthday_day, user.city_name), (61, 'Москва'))
+        self.assertFalse(ArchivedUser.objects.filter(id=2).exists())
+        self.assertEqual(UserChange.objects.last().action, UserChange.RESTORED)
+        self.assertEqual(check_stats(), [])
+
+        call_command('archive_inactive_users', stdout=StringIO())  # seen now, so it isn't archived again
+        self.assertTrue(MyUser.objects.filter(id=2).exists())
+
+    def test_taken_email_keeps_user_archived(self):
+        MyUser.objects.create(email='2@MAIL.ru', password='other')
+        self.assertIsNone(restore_by_id(2))
+        self.assertTrue(ArchivedUser.objects.filter(id=2).exists())
+        response = self.client.post('/users/login', data={'login': '2@mail.ru', 'password': 'password'},
+                                    content_type='application/json')
+        self.assertEqual(json.loads(response.content)['code'], 2)  # the new user is the one logging in
+
+    def test_patch_of_user_with_taken_email(self):
+        MyUser.objects.create(email='2@MAIL.ru', password='other')
+        response = self.client.patch('/users/private/users/2', data={'first_name': 'Luigi'},
+                                     content_type='application/json')
+        self.assertEqual(response.status_code, 422)
+        self.assertEqual(json.loads(response.content)['detail'][0]['msg'], {'email': [EMAIL_TAKEN]})
+        self.assertEqual(self.client.get('/users/private/users/2').status_code, 200)
+
+        response = self.client.patch('/users/private/users/2', data={'email': 'luigi@mail.ru'},
+                                     content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(MyUser.objects.get(id=2).email, 'luigi@mail.ru')
+        self.assertFalse(ArchivedUser.objects.filter(id=2).exists())
+
+    def test_patch_restores_and_delete_removes(self):
+        response = self.client.patch('/users/private/users/2', data={'first_name': 'Luigi'},
+                                     content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(MyUser.objects.get(id=2).first_name, 'Luigi')
+
+        self.assertEqual(self.client.delete('/users/private/users/3').status_code, 204)
+        self.assertFalse(ArchivedUser.objects.exists())
+        self.assertEqual(self.client.get('/users/private/users/3').status_code, 404)
+        self.assertEqual(check_stats(), [])
+
+    def test_rejected_patch_keeps_user_archived(self):
+        response = self.client.patch('/users/private/users/2', data={'birthday': 'never'},
+                                     content_type='application/json')
+        self.assertEqual(response.status_code, 422)
+        MyUser.objects.create(email='new@mail.ru', password='password')
+        response = self.client.patch('/users/private/users/2', data={'email': 'NEW@mail.ru'},
+                                     content_type='application/json')
+        self.assertEqual(response.status_code, 422)
+        self.assertTrue(ArchivedUser.objects.filter(id=2).exists())
+        self.assertFalse(UserChange.objects.filter(action=UserChange.RESTORED).exists())
+        self.assertEqual(check_stats(), [])
+
+    def test_job(self):
+        MyUser.objects.filter(id=4).update(last_seen_at=timezone.now() - datetime.timedelta(days=2))
+        response = self.client.post('/users/private/jobs', data={'kind': 'archive', 'params': {'inactive_for': 86400}},
+                                    content_type='application/json')
+        job_id = json.loads(response.content)['id']
+        run_job(job_id)
+        self.assertEqual(Job.objects.get(id=job_id).result, {'archived': 1})
+        self.assertTrue(ArchivedUser.objects.filter(id=4).exists())
+
+    @override_settings(USERS_DIRECTORY_SNAPSHOT={'ENABLED': True, 'REFRESH_INTERVAL': 0, 'RELOAD_INTERVAL': 600})
+    def test_snapshot_follows_archive(self):
+        reset_directory()
+        self.addCleanup(reset_directory)
+        self.client.get('/users/users?page=1&size=10')
+        MyUser.objects.filter(id=4).update(last_seen_at=timezone.now() - datetime.timedelta(days=3 * 365))
+        call_command('archive_inactive_users', stdout=StringIO())
+        response = self.client.get('/users/users?page=1&size=10')
+        self.assertEqual([user['id'] for user in json.loads(response.content)['data']], [1, 5])
+
+        self.client.patch('/users/private/users/4', data={'first_name': 'Luigi'}, content_type='application/json')
+        response = self.client.get('/users/users?page=1&size=10')
+        self.assertEqual([user['id'] for user in json.loads(response.content)['data']], [1, 4, 5])
+
+
+class LeanMiddlewareTest(TestCase):
+    def test_api_skips_session_and_auth(self):
+        authentication_settings(self)
+        response = self.client.get('/users/current')
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(hasattr(response.wsgi_request, 'session'))
+        self.assertNotIn('csrftoken', response.cookies)
+
+    def test_admin_still_works(self):
+        response = self.client.get('/admin/login/')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('csrftoken', response.cookies)
+
+        self.client.force_login(get_user_model().objects.create_superuser('root', 'root@mail.ru', 'password'))
+        response = self.client.get('/admin/users/webhooksubscription/')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.wsgi_request.user.is_superuser)
+
+        csrf_client = Client(enforce_csrf_checks=True)
+        csrf_client.force_login(get_user_model().objects.get(username='root'))
+        self.assertEqual(csrf_client.post('/admin/logout/').status_code, 403)
+
+    def test_swagger_still_works(self):
+        self.assertEqual(self.client.get('/swagger/').status_code, 200)
+        response = self.client.get('/swagger/?format=openapi')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('/private/users', json.loads(response.content)['paths'])
+
+    def test_api_post_needs_no_csrf_token(self):
+        MyUser.objects.create(email='admin@mail.ru', password='password')
+        client = Client(enforce_csrf_checks=True)
+        response = client.post('/users/login', data={'login': 'admin@mail.ru', 'password': 'password'},
+                               content_type='application/json')
+        self.assertEqual(response.status_code, 200)
@@ -0,0 +1,117 @@
+import hashlib
+import math
+import threading
+import time
+from functools import lru_cache
+
+from django.conf import settings
+from django.core.cache import caches
+from django.utils.module_loading import import_string
+
+from .models import normalize_email
+
+
+class TokenBucket:
+    """
+    bucket holds up to `capacity` tokens and refills completely in `per_seconds`,
+    every attempt takes one token. State is a (tokens, updated_at) tuple kept by backend
+    """
+
+    def __init__(self, capacity, per_seconds):
+        self.capacity = capacity
+        self.per_seconds = per_seconds
+        self.rate = capacity / per_seconds
+
+    def take(self, state, now):
+        """
+        returns new state and seconds to wait before next attempt (0 if token was taken)
+        """
+        if state is None:
+            tokens = self.capacity
+        else:
+            tokens, updated_at = state
+            tokens = min(self.capacity, tokens + max(0.0, now - updated_at) * self.rate)
+
+        if tokens >= 1:
+            return (tokens - 1, now), 0
+
+        return (tokens, now), (1 - tokens) / self.rate
+
+
+class LocMemBucketBackend:
+    """
+    per-process buckets, good for single worker deployments and tests
+    """
+
+    def __init__(self, max_entries=10000):
+        self.max_entries = max_entries
+        self._states = {}
+        self._lock = threading.Lock()
+
+    def take(self, key, bucket):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._states.get(key)
+            state, retry_after = bucket.take(entry[0] if entry else None, now)
+            self._states[key] = (state, now + bucket.per_seconds)
+            if len(self._states) > self.max_entries:
+                self._prune(now)
+
+        return retry_after
+
+    def _prune(self, now):
+        # buckets idle for a whole window are full again, so forgetting them changes nothing
+        for key in [key for key, (_, expires_at) in self._states.items() if expires_at <= now]:
+            del self._states[key]
+
+
+class CacheBucketBackend:
+    """
+    buckets stored in django cache, so all workers using the same cache share limits.
+    Read-modify-write isn't atomic, under a race a few extra attempts may pass, which is fine for throttling
+    """
+
+    def __init__(self, cache_alias='default', key_prefix='users:throttle:'):
+        self.cache_alias = cache_alias
+        self.key_prefix = key_prefix
+
+    @property
+    def cache(self):
+        return caches[self.cache_alias]
+
+    def take(self, key, bucket):
+        key = self.key_prefix + key
+        state, retry_after = bucket.take(self.cache.get(key), time.time())
+        self.cache.set(key, state, timeout=math.ceil(bucket.per_seconds))
+
+        return retry_after
+
+
+class LoginThrottle:
+    """
+    limits login attempts both per client ip and per login
+    """
+
+    def __init__(self, backend, ip_rate, login_rate):
+        self.backend = backend
+        self.ip_bucket = TokenBucket(*ip_rate)
+        self.login_bucket = TokenBucket(*login_rate)
+
+    def check(self, request, login):
+        """
+        returns seconds client has to wait, 0 means attempt is allowed
+        """
+        retry_after = self.backend.take('ip:' + request.META.get('REMOTE_ADDR', ''), self.ip_bucket)
+        if retry_after:
+            return retry_after
+
+        login_key = hashlib.sha1(normalize_email(login).encode('utf-8')).hexdigest()
+        return self.backend.take('login:' + login_key, self.login_bucket)
+
+
+@lru_cache(maxsize=None)
+def get_login_throttle():
+    config = settings.USERS_LOGIN_THROTTLE
+    backend = import_string(config['BACKEND'])(**config.get('OPTIONS', {}))
+
+    return LoginThrottle(backend, config['IP_RATE'], config['LOGIN_RATE'])
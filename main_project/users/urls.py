@@ -1,5 +1,6 @@
 from django.urls import path
-from .views import LoginView, LogoutView, PrivateUserList, PrivateUser, UserList, User, CurrentUser
+from .views import LoginView, LogoutView, PrivateUserList, PrivateUser, UserList, User, CurrentUser, \
+    UserChanges, PrivateJobList, PrivateJob, PrivateJobOutput, PrivateStats, PrivateBirthdays, CityList, CityDetail
 
 urlpatterns = [
     path('login', LoginView.as_view(), name='login'),
@@ -9,4 +10,12 @@ urlpatterns = [
     path('users', UserList.as_view(), name='users'),
     path('current', CurrentUser.as_view(), name='current_user'),
     path('users/<int:pk>', User.as_view(), name='user'),
+    path('changes', UserChanges.as_view(), name='user_changes'),
+    path('private/jobs', PrivateJobList.as_view(), name='private_jobs'),
+    path('private/jobs/<int:pk>', PrivateJob.as_view(), name='private_job'),
+    path('private/jobs/<int:pk>/output', PrivateJobOutput.as_view(), name='private_job_output'),
+    path('private/stats', PrivateStats.as_view(), name='private_stats'),
+    path('private/birthdays', PrivateBirthdays.as_view(), name='private_birthdays'),
+    path('cities', CityList.as_view(), name='cities'),
+    path('cities/<int:pk>', CityDetail.as_view(), name='city'),
 ]
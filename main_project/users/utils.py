@@ -1,21 +1,275 @@
+import datetime
+import json
+from io import BytesIO
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
 from django.http.request import HttpRequest
-from django.http.response import JsonResponse
-from .models import MyUser
+from django.http.response import HttpResponse
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+from rest_framework.exceptions import APIException, ParseError
+from .activity import touch_user
+from .loaders import Loader, get_loaders
+from .models import MyUser, USER_SORT_INDEXES, EMAIL_TAKEN
+from .sharding import ShardedUsers, is_sharded
+
+BODY_FORMAT_ERROR = 'incorrect data format. application/json, application/msgpack or application/cbor expected'
+
+
+def response_format(request):
+    renderer = getattr(request, 'accepted_renderer', None)
+    return 'json' if renderer is None else renderer.format
+
+
+def render(request, data):
+    """
+    (body bytes, content type) of data in format client asked for in Accept header
+    """
+    if response_format(request) == 'json':
+        return json.dumps(data, cls=DjangoJSONEncoder).encode('utf-8'), 'application/json'
+
+    renderer = request.accepted_renderer
+    return renderer.render(data), renderer.media_type
+
+
+def respond(request, data, status=200, reason=None):
+    """
+    json response or the same data in binary format (msgpack, cbor) if client asked for it in Accept header
+    """
+    body, content_type = render(request, data)
+    return HttpResponse(body, content_type=content_type, status=status, reason=reason)
+
+
+def respond_body(request, body, status=200, reason=None):
+    """
+    response with body already rendered by `render` for this request
+    """
+    fmt = response_format(request)
+    content_type = 'application/json' if fmt == 'json' else request.accepted_renderer.media_type
+    return HttpResponse(body, content_type=content_type, status=status, reason=reason)
+
+
+def parse_body(request):
+    """
+    body decoded by parser matching Content-Type (json, msgpack or cbor), empty body is an error as well.
+    Body bytes are read once and decoded straight into python objects. Bodies without Content-Type or with
+    one no parser handles (e.g. curl's default form type) are decoded as json, as they always were.
+    request.data isn't used: DRF takes the body for empty when there is no Content-Length (chunked requests)
+    """
+    if not request.body:
+        raise ParseError('empty body')
+
+    parser = request.negotiator.select_parser(request, request.parsers)
+    if parser is not None:
+        return parser.parse(BytesIO(request.body), request.content_type, request.parser_context)
+
+    try:
+        return json.loads(request.body)
+    except ValueError:
+        raise ParseError('body is not json')
+
+
+def email_taken(request, loc):
+    """
+    response for writes rejected by unique email constraint, the same as validation errors of serializers
+    """
+    return respond(request, status=422,
+                   data={'detail': [{'loc': [loc],
+                                     'msg': {'email': [EMAIL_TAKEN]},
+                                     'type': 'UserValidationError'}]},
+                   reason='Validation Error')
+
+
+def validate_request(request, serializer_class, loc, instance=None):
+    """
+    common parsing and validation for write views.
+    Returns valid serializer, or response to return in caller-function when body is too large,
+    can't be decoded or doesn't pass validation
+    """
+    try:
+        content_length = int(request.META.get('CONTENT_LENGTH') or 0)
+    except ValueError:
+        content_length = 0
+    # the header is checked before reading anything, bytes read for requests without it (chunked ones)
+    if content_length > settings.USERS_MAX_BODY_SIZE or len(request.body) > settings.USERS_MAX_BODY_SIZE:
+        return respond(request, status=413, data={'code': 12, 'message': 'request body is too large'},
+                       reason='Request Entity Too Large')
+
+    try:
+        body = parse_body(request)
+    except APIException:
+        return respond(request, status=422,
+                       data={'detail': [{'loc': [loc],
+                                         'msg': BODY_FORMAT_ERROR,
+                                         'type': 'ParamsParseError'}]},
+                       reason='Validation Error')
+
+    ser = serializer_class(instance, data=body)
+    if not ser.is_valid():
+        return respond(request, status=422,
+                       data={'detail': [{'loc': [loc],
+                                         'msg': ser.errors,
+                                         'type': 'UserValidationError'}]},
+                       reason='Validation Error')
+
+    return ser
+
+
+def get_session_user(cookies, users=None):
+    """
+    user by id in `userid` cookie, looked up through `users` loader if it's given.
+    Returns (user, None), or (None, (status, error data)) when it can't be found
+    """
+    if 'userid' not in cookies:
+        return None, (401, {'code': 4, 'msg': 'no cookie to recognise session was specified'})
+    if users is None:
+        users = Loader(ShardedUsers() if is_sharded() else MyUser.objects.all())
+    try:
+        user = users.load(int(cookies['userid']))
+    except ValueError:
+        user = None
+    if user is None:
+        return None, (401, {'code': 5, 'msg': 'user with such cookie bounding doesn\'t exist'})
+
+    return user, None
 
 
 def try_authorization(request: HttpRequest):
     """
     we will try to return corresponding user by id in cookie
-    if not success we will return JsonResponse to return in caller-function
+    if not success we will return error response to return in caller-function
+    """
+    user, error = get_session_user(request.COOKIES, get_loaders(request).users)
+    if error is not None:
+        status, data = error
+        return respond(request, status=status, data=data, reason='Unauthorized')
+
+    touch_user(user)
+    return user
+
+
+def parse_moment(value):
+    """
+    ISO 8601 date (midnight) or datetime, naive ones are in current timezone. Raises ValueError if it's neither
+    """
+    moment = parse_datetime(value) or parse_date(value)
+    if moment is None:
+        raise ValueError(f'invalid date or datetime {value}')
+    if not hasattr(moment, 'hour'):
+        moment = datetime.datetime.combine(moment, datetime.time())
+    if timezone.is_naive(moment):
+        moment = timezone.make_aware(moment)
+
+    return moment
+
+
+def _reversed(keys):
+    return tuple(key[1:] if key.startswith('-') else '-' + key for key in keys)
+
+
+SORTS = {'id', '-id', *(','.join(keys) for fields in USER_SORT_INDEXES.values() for keys in (fields, _reversed(fields)))}
+
+
+def parse_sort(value):
+    """
+    `last_name,-birthday` -> order_by arguments with id as the last key, so pages are stable.
+    Only orderings having an index are accepted (or reversed ones, index is read backwards then),
+    raises ValueError for others
+    """
+    keys = tuple(key.strip() for key in value.split(','))
+    if ','.join(keys) not in SORTS:
+        raise ValueError(f'unsupported sort {value}')
+    if keys[0].lstrip('-') == 'id':
+        return list(keys)
+
+    # id goes in the direction of the first key: reversed orderings read the whole index backwards
+    return [*keys, '-id' if keys[0].startswith('-') else 'id']
+
+
+INCLUDES = {'city_name'}
+
+
+def parse_include(value):
+    """
+    `city_name` -> set of optional fields to add to listed users, raises ValueError for unknown ones
+    """
+    fields = {field.strip() for field in value.split(',') if field.strip()}
+    if not fields <= INCLUDES:
+        raise ValueError(f'unsupported include {value}')
+
+    return fields
+
+
+class QuerysetPages:
+    """
+    offset pages of users (short models unless `serialize` is given) straight from the database,
+    the same interface as directory.DirectorySnapshot and page_index.PageIndex have
+    """
+
+    def __init__(self, queryset, serialize=MyUser.get_short_user_model):
+        self.queryset = queryset
+        self.serialize = serialize
+
+    def __len__(self):
+        return self.queryset.count()
+
+    def page(self, start, stop):
+        return [self.serialize(user) for user in self.queryset[start:stop]]
+
+
+class ChainPages:
+    """
+    pages of several page sources one after another, each source is counted once
+    """
+
+    def __init__(self, sources):
+        self.sources = sources
+        self._lengths = None
+
+    def __len__(self):
+        if self._lengths is None:
+            self._lengths = [len(source) for source in self.sources]
+
+        return sum(self._lengths)
+
+    def page(self, start, stop):
+        len(self)
+        rows = []
+        for source, length in zip(self.sources, self._lengths):
+            if start < length and start < stop:
+                rows.extend(source.page(start, min(stop, length)))
+            start, stop = max(start - length, 0), max(stop - length, 0)
+
+        return rows
+
+
+def to_columns(rows, fields):
+    """
+    list of dicts -> dict of lists, used by compact (columnar) list responses
+    """
+    return {field: [row[field] for row in rows] for field in fields}
+
+
+def batch_response(request, loc, serialize):
+    """
+    response for `?ids=1,2,3`: requested users in the same order, fetched with one IN query.
+    Ids of users which don't exist are listed in meta.missing
     """
-    if 'userid' not in request.COOKIES:
-        return JsonResponse(status=401,
-                            data={'code': 4, 'msg': 'no cookie to recognise session was specified'},
-                            reason='Unauthorized')
     try:
-        user = MyUser.objects.get(id=request.COOKIES['userid'])
-        return user
-    except MyUser.DoesNotExist:
-        return JsonResponse(status=401,
-                            data={'code': 5, 'msg': 'user with such cookie bounding doesn\'t exist'},
-                            reason='Unauthorized')
+        ids = list(dict.fromkeys(int(item) for item in request.GET['ids'].split(',')))  # unique, order kept
+    except ValueError:
+        ids = []
+    if not ids or len(ids) > settings.USERS_BATCH_MAX_IDS:
+        return respond(request, status=422,
+                       data={'detail': [{'loc': [loc],
+                                         'msg': f'ids must be comma separated list of 1 to '
+                                                f'{settings.USERS_BATCH_MAX_IDS} integers',
+                                         'type': 'BatchParamsValidation'}]},
+                       reason='Validation Error')
+
+    users = get_loaders(request).users.load_many(ids)
+
+    return respond(request, data={'data': [serialize(user) for user in users if user is not None],
+                                  'meta': {'missing': [user_id for user_id, user in zip(ids, users) if user is None]}},
+                   status=200, reason='Successful Response')
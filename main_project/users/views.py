@@ -1,12 +1,31 @@
 from rest_framework.views import APIView
 from drf_yasg.utils import swagger_auto_schema
-from django.http import JsonResponse
-from .models import MyUser, City
-import json
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.http import HttpResponse
+from django.utils import timezone
+from .models import MyUser, City, UserChange, Job, JobOutput, ArchivedUser, normalize_email, is_email_conflict, \
+    SHORT_USER_FIELDS
+import datetime
+import math
 from .schemas import *
 from .serialisers import LoginModelSerializer, PrivateCreateUserModelSerializer, PrivateUpdateUserModelSerializer, \
-    UpdateUserModelSerializer
-from .utils import try_authorization
+    UpdateUserModelSerializer, CreateJobSerializer, CreateCitySerializer
+from .utils import try_authorization, to_columns, respond, respond_body, render, response_format, validate_request, \
+    email_taken, batch_response, QuerysetPages, parse_sort, parse_moment, parse_include, SORTS
+from .throttling import get_login_throttle
+from .caching import is_missing_login, remember_missing_login
+from .changes import record_change, record_deletion, get_changes
+from .detail_cache import get_detail_cache
+from .loaders import get_loaders
+from .directory import get_directory
+from .page_index import get_page_index
+from .writer import run_write
+from .stats import get_stats_model
+from .birthdays import upcoming_birthdays, MAX_DAYS
+from .cities import get_city_index
+from .sharding import ShardedPages, is_sharded, users_by_id, set_directory_email
+from .archive import load_user, move_back, restore_user, get_archived_by_login, delete_archived_user
 
 
 class LoginView(APIView):
@@ -18,39 +37,50 @@ class LoginView(APIView):
         operation_description='После успешного входа в систему необходимо установить Cookies для пользователя',
         responses={400: openapi.Response('Bad Request', ErrorResponseModel),
                    422: openapi.Response('Validation Error', HTTPValidationError),
+                   429: openapi.Response('Too Many Requests', ErrorResponseModel),
                    200: openapi.Response('Successful Response', CurrentUserResponseModel)}
     )
     def post(self, request):
-        try:
-            body = json.loads(request.body.decode('utf-8'))
-        except Exception:
-            return JsonResponse(status=422,
-                                data={'detail': [{'loc': ['LoginView.post'],
-                                                  'msg': 'incorrect data format. application/json expected',
-                                                  'type': 'ParamsParseError'}]},
-                                reason='Validation Error')
-
-        ser = LoginModelSerializer(data=body)
-        flag = ser.is_valid()
-        if not ser.is_valid():
-            return JsonResponse(status=422,
-                                data={'detail': [{'loc': ['LoginView.post'],
-                                                  'msg': ser.errors,
-                                                  'type': 'UserValidationError'}]},
-                                reason='Validation Error')
+        ser = validate_request(request, LoginModelSerializer, 'LoginView.post')
+        if isinstance(ser, HttpResponse):
+            return ser
+
+        login = normalize_email(ser.validated_data['login'])
+        retry_after = get_login_throttle().check(request, login)  # must be done before touching db
+        if retry_after:
+            response = respond(request, status=429, data={'code': 11, 'message': 'Too many login attempts'},
+                               reason='Too Many Requests')
+            response['Retry-After'] = str(math.ceil(retry_after))
+            return response
+
+        if is_missing_login(login):
+            return respond(request, status=400, data={'code': 1, 'message': 'User with such login doesn\'t exist'},
+                           reason='Bad Request')
 
         try:
             user = ser.get_instance()
         except MyUser.DoesNotExist:
-            return JsonResponse(status=400, data={'code': 1, 'message': 'User with such login doesn\'t exist'},
-                                reason='Bad Request')
+            user = get_archived_by_login(login)
+            if user is None:
+                remember_missing_login(login)
+                return respond(request, status=400,
+                               data={'code': 1, 'message': 'User with such login doesn\'t exist'},
+                               reason='Bad Request')
 
         if not user.check_password(
                 ser.validated_data['password']):  # todo: realise whether it needs to be in serializer
-            return JsonResponse(status=400, data={'code': 2, 'message': 'Incorrect password for such user'},
-                                reason='Bad Request')
+            return respond(request, status=400, data={'code': 2, 'message': 'Incorrect password for such user'},
+                           reason='Bad Request')
+
+        if isinstance(user, ArchivedUser):  # back to the hot table once the password is right
+            user = run_write(lambda: restore_user(user))
+            if user is None:  # email was taken by a new user
+                return respond(request, status=400,
+                               data={'code': 1, 'message': 'User with such login doesn\'t exist'},
+                               reason='Bad Request')
 
-        response = JsonResponse(data=user.get_current_user_response_model(), status=200, reason='Successful Response')
+        response = respond(request, data=user.get_current_user_response_model(),
+                           status=200, reason='Successful Response')
 
         cookie_expires = 300
         response.set_cookie('userid', str(user.id), max_age=cookie_expires)
@@ -67,7 +97,7 @@ class LogoutView(APIView):
         responses={200: openapi.Response('Successful Response')}
     )
     def get(self, request):
-        response = JsonResponse(status=200, data={}, reason='Successful Response')
+        response = respond(request, status=200, data={}, reason='Successful Response')
         response.delete_cookie('userid')
 
         return response
@@ -79,6 +109,9 @@ class UserList(APIView):
         manual_parameters=[
             openapi.Parameter(name='page', type=openapi.TYPE_INTEGER, in_=openapi.IN_QUERY),
             openapi.Parameter(name='size', type=openapi.TYPE_INTEGER, in_=openapi.IN_QUERY),
+            LayoutParameter,
+            SortParameter,
+            IdsParameter,
         ],
         operation_id='users_users_get',
         operation_summary='Постраничное получение кратких данных обо всех пользователях',
@@ -92,33 +125,58 @@ class UserList(APIView):
         }
     )
     def get(self, request):
-        user = try_authorization(request)  # JsonResponse will return, when can't get user
-        if type(user) is JsonResponse:
+        user = try_authorization(request)  # error response will return, when can't get user
+        if isinstance(user, HttpResponse):
             return user
 
+        if 'ids' in request.GET:
+            return batch_response(request, 'UsersList.get', MyUser.get_short_user_model)
+
         if 'page' not in request.GET or 'size' not in request.GET:
-            return JsonResponse(status=422,
-                                data={'detail': [{'loc': ['UsersList.get'],
-                                                  'msg': 'no page or size parameter in request',
-                                                  'type': 'PageParamsValidation'}]},
-                                reason='Validation Error')
+            return respond(request, status=422,
+                           data={'detail': [{'loc': ['UsersList.get'],
+                                             'msg': 'no page or size parameter in request',
+                                             'type': 'PageParamsValidation'}]},
+                           reason='Validation Error')
 
         page = int(request.GET['page'])
         size = int(request.GET['size'])
 
-        users = MyUser.objects.all()
+        try:
+            ordering = parse_sort(request.GET.get('sort', 'id'))
+        except ValueError:
+            return respond(request, status=422,
+                           data={'detail': [{'loc': ['UsersList.get'],
+                                             'msg': f'sort must be one of: {", ".join(sorted(SORTS))}',
+                                             'type': 'SortParamsValidation'}]},
+                           reason='Validation Error')
+
+        if is_sharded():
+            users = ShardedPages(MyUser.objects.all(), ordering)  # merged from every shard
+        elif ordering != ['id']:
+            users = QuerysetPages(MyUser.objects.order_by(*ordering))
+        elif settings.USERS_DIRECTORY_SNAPSHOT['ENABLED']:
+            users = get_directory()  # pages are served from memory, without queries
+        elif settings.USERS_PAGE_INDEX['ENABLED']:
+            users = get_page_index()  # pages are keyset queries, deep ones don't scan skipped rows
+        else:
+            users = QuerysetPages(MyUser.objects.order_by('id'))
         if len(users) <= (page - 1) * size:
-            return JsonResponse(status=400, data={'code': 3, 'message': 'no such page'},
-                                reason='Bad Request')
+            return respond(request, status=400, data={'code': 3, 'message': 'no such page'},
+                           reason='Bad Request')
 
-        users = users[(page - 1) * size: page * size]
+        rows = users.page((page - 1) * size, page * size)
+        data = rows
+        if request.GET.get('layout') == 'columnar':
+            data = to_columns(rows, SHORT_USER_FIELDS)
 
-        return JsonResponse(
+        return respond(
+            request,
             data={
-                'data': [user.get_short_user_model() for user in users],
+                'data': data,
                 'meta': {
                     'pagination': {
-                        'total': len(users),
+                        'total': len(rows),
                         'page': page,
                         'size': size
                     },
@@ -134,6 +192,11 @@ class PrivateUserList(APIView):
         manual_parameters=[
             openapi.Parameter(name='page', type=openapi.TYPE_INTEGER, in_=openapi.IN_QUERY),
             openapi.Parameter(name='size', type=openapi.TYPE_INTEGER, in_=openapi.IN_QUERY),
+            LayoutParameter,
+            SortParameter,
+            ActiveSinceParameter,
+            IncludeParameter,
+            IdsParameter,
         ],
         operation_id='private_users_private_users_get',
         operation_summary='Постраничное получение кратких данных обо всех пользователях',
@@ -151,47 +214,89 @@ class PrivateUserList(APIView):
         }
     )
     def get(self, request):
-        user = try_authorization(request)  # JsonResponse will return, when can't get user
-        if type(user) is JsonResponse:
+        user = try_authorization(request)  # error response will return, when can't get user
+        if isinstance(user, HttpResponse):
             return user
 
         if not user.is_admin:
-            return JsonResponse(status=403,
-                                data={'code': 10, 'msg': 'only admins can access this info'},
-                                reason='Forbidden')
+            return respond(request, status=403,
+                           data={'code': 10, 'msg': 'only admins can access this info'},
+                           reason='Forbidden')
+
+        try:
+            include = parse_include(request.GET.get('include', ''))
+        except ValueError:
+            return respond(request, status=422,
+                           data={'detail': [{'loc': ['PrivateUserList.get'],
+                                             'msg': 'include must be comma separated fields of: city_name',
+                                             'type': 'IncludeParamsValidation'}]},
+                           reason='Validation Error')
+
+        if 'ids' in request.GET:
+            def serialize_detail(listed):
+                data = listed.get_privateDetailUserResponseModel()
+                if 'city_name' in include:
+                    data['city_name'] = listed.city_name
+                return data
+
+            return batch_response(request, 'PrivateUserList.get', serialize_detail)
 
         if 'page' not in request.GET or 'size' not in request.GET:
-            return JsonResponse(status=422,
-                                data={'detail': [{'loc': ['PrivateUserList.get'],
-                                                  'msg': 'no page or size parameter in request',
-                                                  'type': 'PageParamsValidation'}]},
-                                reason='Validation Error')
+            return respond(request, status=422,
+                           data={'detail': [{'loc': ['PrivateUserList.get'],
+                                             'msg': 'no page or size parameter in request',
+                                             'type': 'PageParamsValidation'}]},
+                           reason='Validation Error')
 
         page = int(request.GET['page'])
         size = int(request.GET['size'])
 
-        users = MyUser.objects.all()
+        try:
+            ordering = parse_sort(request.GET.get('sort', 'id'))
+        except ValueError:
+            return respond(request, status=422,
+                           data={'detail': [{'loc': ['PrivateUserList.get'],
+                                             'msg': f'sort must be one of: {", ".join(sorted(SORTS))}',
+                                             'type': 'SortParamsValidation'}]},
+                           reason='Validation Error')
+
+        users = MyUser.objects.order_by(*ordering)
+        if 'active_since' in request.GET:
+            try:
+                users = users.filter(last_seen_at__gte=parse_moment(request.GET['active_since']))
+            except ValueError:
+                return respond(request, status=422,
+                               data={'detail': [{'loc': ['PrivateUserList.get'],
+                                                 'msg': 'active_since must be ISO 8601 date or datetime',
+                                                 'type': 'ActiveSinceParamsValidation'}]},
+                               reason='Validation Error')
+
+        serialize, fields = MyUser.get_short_user_model, SHORT_USER_FIELDS
+        if 'city_name' in include:  # stored with the user, no join with cities
+            serialize, fields = MyUser.get_short_user_model_with_city_name, (*SHORT_USER_FIELDS, 'city_name')
+
+        users = ShardedPages(users, ordering, serialize) if is_sharded() else QuerysetPages(users, serialize)
         if len(users) <= (page - 1) * size:
-            return JsonResponse(status=400, data={'code': 3, 'message': 'no such page'},
-                                reason='Bad Request')
+            return respond(request, status=400, data={'code': 3, 'message': 'no such page'},
+                           reason='Bad Request')
 
-        users = users[(page - 1) * size: page * size]
+        rows = users.page((page - 1) * size, page * size)
+        data = rows
+        if request.GET.get('layout') == 'columnar':
+            data = to_columns(rows, fields)
 
-        return JsonResponse(
+        return respond(
+            request,
             data={
-                'data': [user.get_short_user_model() for user in users],
+                'data': data,
                 'meta': {
                     'pagination': {
-                        'total': len(users),
+                        'total': len(rows),
                         'page': page,
                         'size': size
                     },
                     'hint': {
-                        'city': [{
-                            'id': city.id,
-                            'name': city.name
-                        } for city in City.objects.all()
-                        ]
+                        'city': get_city_index().all()
                     }
                 }
             },
@@ -217,34 +322,32 @@ class PrivateUserList(APIView):
         }
     )
     def post(self, request):
-        user = try_authorization(request)  # JsonResponse will return, when can't get user
-        if type(user) is JsonResponse:
+        user = try_authorization(request)  # error response will return, when can't get user
+        if isinstance(user, HttpResponse):
             return user
 
         if not user.is_admin:
-            return JsonResponse(status=403,
-                                data={'code': 10, 'msg': 'only admins can access this info'},
-                                reason='Forbidden')
-        try:
-            body = json.loads(request.body.decode('utf-8'))
-        except Exception:
-            return JsonResponse(status=422,
-                                data={'detail': [{'loc': ['PrivateUserList.post'],
-                                                  'msg': 'incorrect data format. application/json expected',
-                                                  'type': 'ParamsParseError'}]},
-                                reason='Validation Error')
+            return respond(request, status=403,
+                           data={'code': 10, 'msg': 'only admins can access this info'},
+                           reason='Forbidden')
+        ser = validate_request(request, PrivateCreateUserModelSerializer, 'PrivateUserList.post')
+        if isinstance(ser, HttpResponse):
+            return ser
 
-        ser = PrivateCreateUserModelSerializer(data=body)
-        if not ser.is_valid():
-            return JsonResponse(status=422,
-                                data={'detail': [{'loc': ['PrivateUserList.post'],
-                                                  'msg': ser.errors,
-                                                  'type': 'UserValidationError'}]},
-                                reason='Validation Error')
+        def create():
+            created = ser.save()
+            record_change(UserChange.CREATED, created)
+            return created
 
-        user = ser.save()
+        try:
+            user = run_write(create)
+        except IntegrityError as error:
+            if not is_email_conflict(error):
+                raise
+            return email_taken(request, 'PrivateUserList.post')
 
-        return JsonResponse(data=user.get_privateDetailUserResponseModel(), status=201, reason='Successful Response')
+        return respond(request, data=user.get_privateDetailUserResponseModel(),
+                       status=201, reason='Successful Response')
 
 
 class PrivateUser(APIView):
@@ -268,21 +371,23 @@ class PrivateUser(APIView):
                    }
     )
     def get(self, request, pk):
-        user = try_authorization(request)  # JsonResponse will return, when can't get user
-        if type(user) is JsonResponse:
+        user = try_authorization(request)  # error response will return, when can't get user
+        if isinstance(user, HttpResponse):
             return user
 
         if not user.is_admin:
-            return JsonResponse(status=403,
-                                data={'code': 10, 'msg': 'only admins can access this info'},
-                                reason='Forbidden')
+            return respond(request, status=403,
+                           data={'code': 10, 'msg': 'only admins can access this info'},
+                           reason='Forbidden')
 
-        user = MyUser.objects.filter(id=pk)
-        if len(user) == 0:
-            return JsonResponse(status=404, data={'code': 8, 'message': 'User with such id doesn\'t exist'},
-                                reason='Not Found')
+        try:
+            body = get_detail_cache().get('private', pk, response_format(request), lambda: render(
+                request, load_user(get_loaders(request).users, pk).get_privateDetailUserResponseModel())[0])
+        except MyUser.DoesNotExist:
+            return respond(request, status=404, data={'code': 8, 'message': 'User with such id doesn\'t exist'},
+                           reason='Not Found')
 
-        return JsonResponse(data=user[0].get_privateDetailUserResponseModel(), status=200, reason='Successful Response')
+        return respond_body(request, body, status=200, reason='Successful Response')
 
     @swagger_auto_schema(
         tags=['admin'],
@@ -298,27 +403,42 @@ class PrivateUser(APIView):
                                          openapi.Schema(title='Response 403 Private Delete User Private Users  Pk  '
                                                               'Delete',
                                                         type=openapi.TYPE_STRING)),
+                   404: openapi.Response('Not Found',
+                                         openapi.Schema(title='Response 404 Private Delete User Private Users  Pk  '
+                                                              'Delete',
+                                                        type=openapi.TYPE_STRING)),
                    422: openapi.Response('Validation Error', HTTPValidationError)
                    }
     )
     def delete(self, request, pk):
-        user = try_authorization(request)  # JsonResponse will return, when can't get user
-        if type(user) is JsonResponse:
+        user = try_authorization(request)  # error response will return, when can't get user
+        if isinstance(user, HttpResponse):
             return user
 
         if not user.is_admin:
-            return JsonResponse(status=403,
-                                data={'code': 10, 'msg': 'only admins can access this info'},
-                                reason='Forbidden')
+            return respond(request, status=403,
+                           data={'code': 10, 'msg': 'only admins can access this info'},
+                           reason='Forbidden')
+
+        def delete():
+            # single UPDATE, rows are removed later by purge_deleted_users
+            if users_by_id(pk).update(deleted_at=timezone.now()):
+                archived = False
+            elif delete_archived_user(pk):
+                archived = True
+            else:
+                return False
+            set_directory_email(pk, None)  # may be taken by new users
+            record_deletion(pk, archived)
+            return True
 
-        user = MyUser.objects.filter(id=pk)
-        if len(user) == 0:
-            return JsonResponse(status=404, data={'code': 8, 'message': 'User with such id doesn\'t exist'},
-                                reason='Not Found')
+        deleted = run_write(delete)
 
-        user.delete()
+        if not deleted:
+            return respond(request, status=404, data={'code': 8, 'message': 'User with such id doesn\'t exist'},
+                           reason='Not Found')
 
-        return JsonResponse(status=204, reason='Successful Response', data={})
+        return respond(request, status=204, reason='Successful Response', data={})
 
     @swagger_auto_schema(
         tags=['admin'],
@@ -341,41 +461,52 @@ class PrivateUser(APIView):
                    }
     )
     def patch(self, request, pk):
-        user = try_authorization(request)  # JsonResponse will return, when can't get user
-        if type(user) is JsonResponse:
+        user = try_authorization(request)  # error response will return, when can't get user
+        if isinstance(user, HttpResponse):
             return user
 
         if not user.is_admin:
-            return JsonResponse(status=403,
-                                data={'code': 10, 'msg': 'only admins can access this info'},
-                                reason='Forbidden')
-
-        user = MyUser.objects.filter(id=pk)
-        if len(user) == 0:
-            return JsonResponse(status=404, data={'code': 8, 'message': 'User with such id doesn\'t exist'},
-                                reason='Not Found')
+            return respond(request, status=403,
+                           data={'code': 10, 'msg': 'only admins can access this info'},
+                           reason='Forbidden')
 
         try:
-            body = json.loads(request.body.decode('utf-8'))
-        except Exception:
-            return JsonResponse(status=422,
-                                data={'detail': [{'loc': ['PrivateUser.patch'],
-                                                  'msg': 'incorrect data format. application/json expected',
-                                                  'type': 'ParamsParseError'}]},
-                                reason='Validation Error')
+            user = load_user(get_loaders(request).users, pk)
+        except MyUser.DoesNotExist:
+            return respond(request, status=404, data={'code': 8, 'message': 'User with such id doesn\'t exist'},
+                           reason='Not Found')
 
-        ser = PrivateUpdateUserModelSerializer(data=body)
-        if not ser.is_valid():
-            return JsonResponse(status=422,
-                                data={'detail': [{'loc': ['LoginView.post'],
-                                                  'msg': ser.errors,
-                                                  'type': 'UserValidationError'}]},
-                                reason='Validation Error')
+        ser = validate_request(request, PrivateUpdateUserModelSerializer, 'PrivateUser.patch', instance=user)
+        if isinstance(ser, HttpResponse):
+            return ser
 
-        user.update(**ser.validated_data)
-        user[0].save()
+        def update():
+            target = user
+            if isinstance(target, ArchivedUser):  # moved back to be changed, in the same transaction
+                # a new email lets admins restore users whose email was taken, a taken one is 422 like for others
+                target = move_back(target, ser.validated_data.get('email')) or MyUser.objects.filter(id=pk).first()
+                if target is None:  # deleted meanwhile
+                    return None
+            if 'email' in ser.validated_data:
+                set_directory_email(pk, ser.validated_data['email'])
+            MyUser.objects.using(target._state.db).filter(id=pk).update(**ser.validated_data)  # on user's shard
+            target.refresh_from_db()
+            target.save()
+            record_change(UserChange.UPDATED, target)
+            return target
 
-        return JsonResponse(data=user[0].get_privateDetailUserResponseModel(), status=200, reason='Successful Response')
+        try:
+            user = run_write(update)
+        except IntegrityError as error:
+            if not is_email_conflict(error):
+                raise
+            return email_taken(request, 'PrivateUser.patch')
+        if user is None:
+            return respond(request, status=404, data={'code': 8, 'message': 'User with such id doesn\'t exist'},
+                           reason='Not Found')
+
+        return respond(request, data=user.get_privateDetailUserResponseModel(),
+                       status=200, reason='Successful Response')
 
 
 class User(APIView):
@@ -397,47 +528,46 @@ class User(APIView):
                    }
     )
     def patch(self, request, pk):
-        auth_user = try_authorization(request)  # JsonResponse will return, when can't get user
-        if type(auth_user) is JsonResponse:
+        auth_user = try_authorization(request)  # error response will return, when can't get user
+        if isinstance(auth_user, HttpResponse):
             return auth_user
 
-        users = MyUser.objects.filter(pk=pk)
-        if len(users) == 0:
-            return JsonResponse(status=404, data={'code': 8, 'message': 'User with such id doesn\'t exist'},
-                                reason='Not Found')
+        user = get_loaders(request).users.load(pk)  # the authorized user is already there
+        if user is None:
+            return respond(request, status=404, data={'code': 8, 'message': 'User with such id doesn\'t exist'},
+                           reason='Not Found')
 
         if auth_user.id != pk:
-            return JsonResponse(status=400,
-                                data={'code': 7, 'message': f'This user cannot modify user with id {pk}'
-                                                            f'if this user admin, he must use private mode'},
-                                reason='Bad Request')
+            return respond(request, status=400,
+                           data={'code': 7, 'message': f'This user cannot modify user with id {pk}'
+                                                       f'if this user admin, he must use private mode'},
+                           reason='Bad Request')
+
+        ser = validate_request(request, UpdateUserModelSerializer, 'User.patch', instance=user)
+        if isinstance(ser, HttpResponse):
+            return ser
+
+        def update():
+            if 'email' in ser.validated_data:
+                set_directory_email(pk, ser.validated_data['email'])
+            MyUser.objects.using(user._state.db).filter(id=pk).update(**ser.validated_data)  # on user's shard
+            user.refresh_from_db()
+            user.save()
+            record_change(UserChange.UPDATED, user)
 
         try:
-            body = json.loads(request.body.decode('utf-8'))
-        except Exception:
-            return JsonResponse(status=422,
-                                data={'detail': [{'loc': ['User.patch'],
-                                                  'msg': 'incorrect data format. application/json expected',
-                                                  'type': 'ParamsParseError'}]},
-                                reason='Validation Error')
-
-        ser = UpdateUserModelSerializer(data=body)
-        if not ser.is_valid():
-            return JsonResponse(status=422,
-                                data={'detail': [{'loc': ['LoginView.post'],
-                                                  'msg': ser.errors,
-                                                  'type': 'UserValidationError'}]},
-                                reason='Validation Error')
-
-        users.update(**ser.validated_data)
-        users[0].save()
-
-        data = users[0].get_privateDetailUserResponseModel()
+            run_write(update)
+        except IntegrityError as error:
+            if not is_email_conflict(error):
+                raise
+            return email_taken(request, 'User.patch')
+
+        data = user.get_privateDetailUserResponseModel()
         del data['is_admin']
         del data['city']
         del data['additional_info']
 
-        return JsonResponse(data=data, status=200, reason='Successful Response')
+        return respond(request, data=data, status=200, reason='Successful Response')
 
 
 class CurrentUser(APIView):
@@ -454,10 +584,474 @@ class CurrentUser(APIView):
                    400: openapi.Response('Bad Request', ErrorResponseModel)}
     )
     def get(self, request):
-        user = try_authorization(request)  # JsonResponse will return, when can't get user
-        if type(user) is JsonResponse:
+        user = try_authorization(request)  # error response will return, when can't get user
+        if isinstance(user, HttpResponse):
             return user
 
-        response = JsonResponse(data=user.get_current_user_response_model(), status=200, reason='Successful Response')
+        body = get_detail_cache().get('current', user.id, response_format(request),
+                                      lambda: render(request, user.get_current_user_response_model())[0])
 
-        return response
+        return respond_body(request, body, status=200, reason='Successful Response')
+
+
+class UserChanges(APIView):
+    @swagger_auto_schema(
+        tags=['admin'],
+        manual_parameters=[
+            openapi.Parameter(name='since', type=openapi.TYPE_INTEGER, in_=openapi.IN_QUERY,
+                              description='seq of the last change client already has, 0 by default'),
+            openapi.Parameter(name='limit', type=openapi.TYPE_INTEGER, in_=openapi.IN_QUERY),
+            openapi.Parameter(name='wait', type=openapi.TYPE_INTEGER, in_=openapi.IN_QUERY,
+                              description='seconds to wait for new changes if there are none yet (long polling)'),
+        ],
+        operation_id='user_changes_changes_get',
+        operation_summary='Лента изменений пользователей',
+        operation_description='Изменения пользователей после указанного номера, вместо периодического '
+                              'перечитывания всего списка пользователей',
+        responses={
+            200: openapi.Response('Successful Response', UserChangesResponseModel),
+            401: openapi.Response('Unauthorized', openapi.Schema(title='Response 401 User Changes Changes Get',
+                                                                 type=openapi.TYPE_STRING)),
+            403: openapi.Response('Forbidden', openapi.Schema(title='Response 403 User Changes Changes Get',
+                                                              type=openapi.TYPE_STRING)),
+            422: openapi.Response('Validation Error', HTTPValidationError),
+        }
+    )
+    def get(self, request):
+        user = try_authorization(request)  # error response will return, when can't get user
+        if isinstance(user, HttpResponse):
+            return user
+
+        if not user.is_admin:
+            return respond(request, status=403,
+                           data={'code': 10, 'msg': 'only admins can access this info'},
+                           reason='Forbidden')
+
+        try:
+            since = int(request.GET.get('since', 0))
+            limit = min(int(request.GET.get('limit', 100)), settings.USERS_CHANGES_MAX_LIMIT)
+            wait = min(int(request.GET.get('wait', 0)), settings.USERS_CHANGES_MAX_WAIT)
+        except ValueError:
+            limit = 0
+        if limit <= 0:
+            return respond(request, status=422,
+                           data={'detail': [{'loc': ['UserChanges.get'],
+                                             'msg': 'since, limit and wait must be integers, limit must be positive',
+                                             'type': 'ChangesParamsValidation'}]},
+                           reason='Validation Error')
+
+        changes = get_changes(since, limit, wait)
+
+        return respond(request, data={'data': [change.get_change_model() for change in changes],
+                                      'meta': {'last_seq': changes[-1].id if changes else since}},
+                       status=200, reason='Successful Response')
+
+
+class PrivateJobList(APIView):
+    @swagger_auto_schema(
+        tags=['admin'],
+        manual_parameters=[
+            openapi.Parameter(name='status', type=openapi.TYPE_STRING, in_=openapi.IN_QUERY,
+                              enum=['queued', 'running', 'succeeded', 'failed']),
+            openapi.Parameter(name='limit', type=openapi.TYPE_INTEGER, in_=openapi.IN_QUERY),
+        ],
+        operation_id='private_jobs_private_jobs_get',
+        operation_summary='Список фоновых задач',
+        operation_description='Последние фоновые задачи администраторов, начиная с новых. '
+                              'Результат задачи доступен только по её id',
+        responses={
+            200: openapi.Response('Successful Response', JobsListResponseModel),
+            401: openapi.Response('Unauthorized', openapi.Schema(title='Response 401 Private Jobs Private Jobs Get',
+                                                                 type=openapi.TYPE_STRING)),
+            403: openapi.Response('Forbidden', openapi.Schema(title='Response 403 Private Jobs Private Jobs Get',
+                                                              type=openapi.TYPE_STRING)),
+            422: openapi.Response('Validation Error', HTTPValidationError),
+        }
+    )
+    def get(self, request):
+        user = try_authorization(request)  # error response will return, when can't get user
+        if isinstance(user, HttpResponse):
+            return user
+
+        if not user.is_admin:
+            return respond(request, status=403,
+                           data={'code': 10, 'msg': 'only admins can access this info'},
+                           reason='Forbidden')
+
+        try:
+            limit = min(int(request.GET.get('limit', 100)), settings.USERS_JOBS_MAX_LIMIT)
+        except ValueError:
+            limit = 0
+        if limit <= 0:
+            return respond(request, status=422,
+                           data={'detail': [{'loc': ['PrivateJobList.get'],
+                                             'msg': 'limit must be a positive integer',
+                                             'type': 'JobsParamsValidation'}]},
+                           reason='Validation Error')
+
+        jobs = Job.objects.order_by('-id')
+        if 'status' in request.GET:
+            jobs = jobs.filter(status=request.GET['status'])
+
+        return respond(request, data={'data': [job.get_job_list_element_model() for job in jobs[:limit]]},
+                       status=200, reason='Successful Response')
+
+    @swagger_auto_schema(
+        request_body=CreateJobModel,
+        tags=['admin'],
+        manual_parameters=[
+            openapi.Parameter(name='Idempotency-Key', type=openapi.TYPE_STRING, in_=openapi.IN_HEADER,
+                              description='repeated requests with the same key return the job created by the first '
+                                          'one instead of creating another job'),
+        ],
+        operation_id='private_create_job_private_jobs_post',
+        operation_summary='Создание фоновой задачи',
+        operation_description='Массовые операции над пользователями выполняются вне запроса командой run_jobs, '
+                              'ход выполнения доступен по id задачи',
+        responses={
+            200: openapi.Response('Job with the same Idempotency-Key already exists', JobModel),
+            202: openapi.Response('Accepted', JobModel),
+            401: openapi.Response('Unauthorized',
+                                  openapi.Schema(title='Response 401 Private Create Job Private Jobs Post',
+                                                 type=openapi.TYPE_STRING)),
+            403: openapi.Response('Forbidden',
+                                  openapi.Schema(title='Response 403 Private Create Job Private Jobs Post',
+                                                 type=openapi.TYPE_STRING)),
+            409: openapi.Response('Conflict', ErrorResponseModel),
+            422: openapi.Response('Validation Error', HTTPValidationError),
+        }
+    )
+    def post(self, request):
+        user = try_authorization(request)  # error response will return, when can't get user
+        if isinstance(user, HttpResponse):
+            return user
+
+        if not user.is_admin:
+            return respond(request, status=403,
+                           data={'code': 10, 'msg': 'only admins can access this info'},
+                           reason='Forbidden')
+
+        ser = validate_request(request, CreateJobSerializer, 'PrivateJobList.post')
+        if isinstance(ser, HttpResponse):
+            return ser
+
+        key = request.headers.get('Idempotency-Key') or None
+        job = Job.objects.filter(idempotency_key=key).first() if key is not None else None
+        if job is None:
+            try:
+                with transaction.atomic():
+                    job = Job.objects.create(idempotency_key=key, **ser.validated_data)
+            except IntegrityError:  # the same key was used by a concurrent request
+                job = Job.objects.get(idempotency_key=key)
+            else:
+                return respond(request, data=job.get_job_model(), status=202, reason='Accepted')
+
+        if job.kind != ser.validated_data['kind'] or job.params != ser.validated_data['params']:
+            return respond(request, status=409,
+                           data={'code': 13, 'message': 'Idempotency-Key was already used for another job'},
+                           reason='Conflict')
+
+        return respond(request, data=job.get_job_model(), status=200, reason='Successful Response')
+
+
+class PrivateJob(APIView):
+    @swagger_auto_schema(
+        tags=['admin'],
+        operation_summary='Состояние фоновой задачи',
+        operation_id='private_get_job_private_jobs__pk__get',
+        operation_description='Статус, прогресс и результат фоновой задачи',
+        responses={200: openapi.Response('Successful Response', JobModel),
+                   401: openapi.Response('Unauthorized',
+                                         openapi.Schema(title='Response 401 Private Get Job Private Jobs  Pk  Get',
+                                                        type=openapi.TYPE_STRING)),
+                   403: openapi.Response('Forbidden',
+                                         openapi.Schema(title='Response 403 Private Get Job Private Jobs  Pk  Get',
+                                                        type=openapi.TYPE_STRING)),
+                   404: openapi.Response('Not Found',
+                                         openapi.Schema(title='Response 404 Private Get Job Private Jobs  Pk  Get',
+                                                        type=openapi.TYPE_STRING)),
+                   }
+    )
+    def get(self, request, pk):
+        user = try_authorization(request)  # error response will return, when can't get user
+        if isinstance(user, HttpResponse):
+            return user
+
+        if not user.is_admin:
+            return respond(request, status=403,
+                           data={'code': 10, 'msg': 'only admins can access this info'},
+                           reason='Forbidden')
+
+        job = Job.objects.filter(id=pk).first()
+        if job is None:
+            return respond(request, status=404, data={'code': 8, 'message': 'Job with such id doesn\'t exist'},
+                           reason='Not Found')
+
+        return respond(request, data=job.get_job_model(), status=200, reason='Successful Response')
+
+
+class PrivateJobOutput(APIView):
+    @swagger_auto_schema(
+        tags=['admin'],
+        manual_parameters=[
+            openapi.Parameter(name='part', type=openapi.TYPE_INTEGER, in_=openapi.IN_QUERY),
+        ],
+        operation_summary='Выгрузка фоновой задачи',
+        operation_id='private_get_job_output_private_jobs__pk__output_get',
+        operation_description='Данные, выгруженные задачей export, по частям начиная с 0, '
+                              'число частей есть в её результате',
+        responses={200: openapi.Response('Successful Response', JobOutputResponseModel),
+                   401: openapi.Response('Unauthorized',
+                                         openapi.Schema(title='Response 401 Private Get Job Output',
+                                                        type=openapi.TYPE_STRING)),
+                   403: openapi.Response('Forbidden',
+                                         openapi.Schema(title='Response 403 Private Get Job Output',
+                                                        type=openapi.TYPE_STRING)),
+                   404: openapi.Response('Not Found',
+                                         openapi.Schema(title='Response 404 Private Get Job Output',
+                                                        type=openapi.TYPE_STRING)),
+                   422: openapi.Response('Validation Error', HTTPValidationError),
+                   }
+    )
+    def get(self, request, pk):
+        user = try_authorization(request)  # error response will return, when can't get user
+        if isinstance(user, HttpResponse):
+            return user
+
+        if not user.is_admin:
+            return respond(request, status=403,
+                           data={'code': 10, 'msg': 'only admins can access this info'},
+                           reason='Forbidden')
+
+        try:
+            part = int(request.GET.get('part', 0))
+        except ValueError:
+            part = -1
+        if part < 0:
+            return respond(request, status=422,
+                           data={'detail': [{'loc': ['PrivateJobOutput.get'],
+                                             'msg': 'part must be a non-negative integer',
+                                             'type': 'JobsParamsValidation'}]},
+                           reason='Validation Error')
+
+        output = JobOutput.objects.filter(job_id=pk, part=part).first()
+        if output is None:
+            return respond(request, status=404,
+                           data={'code': 8, 'message': 'Job output with such id and part doesn\'t exist'},
+                           reason='Not Found')
+
+        return respond(request, data={'data': output.data, 'meta': {'part': part}}, status=200,
+                       reason='Successful Response')
+
+
+class PrivateStats(APIView):
+    @swagger_auto_schema(
+        tags=['admin'],
+        operation_summary='Статистика пользователей',
+        operation_id='private_stats_private_stats_get',
+        operation_description='Количество пользователей по городам, администраторов и дней рождения по месяцам',
+        responses={200: openapi.Response('Successful Response', StatsResponseModel),
+                   401: openapi.Response('Unauthorized',
+                                         openapi.Schema(title='Response 401 Private Stats Private Stats Get',
+                                                        type=openapi.TYPE_STRING)),
+                   403: openapi.Response('Forbidden',
+                                         openapi.Schema(title='Response 403 Private Stats Private Stats Get',
+                                                        type=openapi.TYPE_STRING)),
+                   }
+    )
+    def get(self, request):
+        user = try_authorization(request)  # error response will return, when can't get user
+        if isinstance(user, HttpResponse):
+            return user
+
+        if not user.is_admin:
+            return respond(request, status=403,
+                           data={'code': 10, 'msg': 'only admins can access this info'},
+                           reason='Forbidden')
+
+        return respond(request, data=get_stats_model(get_loaders(request).cities), status=200,
+                       reason='Successful Response')
+
+
+class PrivateBirthdays(APIView):
+    @swagger_auto_schema(
+        tags=['admin'],
+        manual_parameters=[
+            openapi.Parameter(name='page', type=openapi.TYPE_INTEGER, in_=openapi.IN_QUERY),
+            openapi.Parameter(name='size', type=openapi.TYPE_INTEGER, in_=openapi.IN_QUERY),
+            openapi.Parameter(name='days', type=openapi.TYPE_INTEGER, in_=openapi.IN_QUERY,
+                              description=f'length of the window, 1..{MAX_DAYS}, 7 by default'),
+            openapi.Parameter(name='from', type=openapi.TYPE_STRING, format=openapi.FORMAT_DATE, in_=openapi.IN_QUERY,
+                              description='first day of the window, today by default'),
+        ],
+        operation_id='private_birthdays_private_birthdays_get',
+        operation_summary='Ближайшие дни рождения',
+        operation_description='Пользователи, у которых день рождения в ближайшие дни, по порядку дат',
+        responses={200: openapi.Response('Successful Response', BirthdaysResponseModel),
+                   400: openapi.Response('Bad Request', ErrorResponseModel),
+                   401: openapi.Response('Unauthorized',
+                                         openapi.Schema(title='Response 401 Private Birthdays Private Birthdays Get',
+                                                        type=openapi.TYPE_STRING)),
+                   403: openapi.Response('Forbidden',
+                                         openapi.Schema(title='Response 403 Private Birthdays Private Birthdays Get',
+                                                        type=openapi.TYPE_STRING)),
+                   422: openapi.Response('Validation Error', HTTPValidationError),
+                   }
+    )
+    def get(self, request):
+        user = try_authorization(request)  # error response will return, when can't get user
+        if isinstance(user, HttpResponse):
+            return user
+
+        if not user.is_admin:
+            return respond(request, status=403,
+                           data={'code': 10, 'msg': 'only admins can access this info'},
+                           reason='Forbidden')
+
+        try:
+            page, size = int(request.GET['page']), int(request.GET['size'])
+            days = int(request.GET.get('days', 7))
+            start = datetime.date.fromisoformat(request.GET['from']) if 'from' in request.GET else timezone.localdate()
+            if page < 1 or size < 1 or not 1 <= days <= MAX_DAYS:
+                raise ValueError
+        except (KeyError, ValueError):
+            return respond(request, status=422,
+                           data={'detail': [{'loc': ['PrivateBirthdays.get'],
+                                             'msg': f'page and size must be positive integers, days 1..{MAX_DAYS}, '
+                                                    f'from ISO 8601 date',
+                                             'type': 'BirthdaysParamsValidation'}]},
+                           reason='Validation Error')
+
+        users = upcoming_birthdays(start, days)
+        if page > 1 and len(users) <= (page - 1) * size:
+            return respond(request, status=400, data={'code': 3, 'message': 'no such page'},
+                           reason='Bad Request')
+
+        rows = users.page((page - 1) * size, page * size)
+        return respond(request, data={'data': rows,
+                                      'meta': {'pagination': {'total': len(rows), 'page': page, 'size': size},
+                                               'from': start, 'days': days}},
+                       status=200, reason='Successful Response')
+
+
+class CityList(APIView):
+    @swagger_auto_schema(
+        tags=['user'],
+        manual_parameters=[
+            openapi.Parameter(name='prefix', type=openapi.TYPE_STRING, in_=openapi.IN_QUERY,
+                              description='beginning of city name, case is ignored. All cities match empty prefix'),
+            openapi.Parameter(name='limit', type=openapi.TYPE_INTEGER, in_=openapi.IN_QUERY,
+                              description='most cities to return, 10 by default, up to USERS_CITIES_MAX_LIMIT'),
+        ],
+        operation_id='cities_cities_get',
+        operation_summary='Поиск городов по началу названия',
+        operation_description='Города в алфавитном порядке, подходящие под начало названия, для выбора города',
+        responses={200: openapi.Response('Successful Response', CitiesListResponseModel),
+                   401: openapi.Response('Unauthorized',
+                                         openapi.Schema(title='Response 401 Cities Cities Get',
+                                                        type=openapi.TYPE_STRING)),
+                   422: openapi.Response('Validation Error', HTTPValidationError),
+                   }
+    )
+    def get(self, request):
+        user = try_authorization(request)  # error response will return, when can't get user
+        if isinstance(user, HttpResponse):
+            return user
+
+        try:
+            limit = int(request.GET.get('limit', 10))
+            if not 1 <= limit <= settings.USERS_CITIES_MAX_LIMIT:
+                raise ValueError
+        except ValueError:
+            return respond(request, status=422,
+                           data={'detail': [{'loc': ['CityList.get'],
+                                             'msg': f'limit must be 1..{settings.USERS_CITIES_MAX_LIMIT}',
+                                             'type': 'CitiesParamsValidation'}]},
+                           reason='Validation Error')
+
+        total, cities = get_city_index().search(request.GET.get('prefix', ''), limit)
+        return respond(request, data={'data': cities, 'meta': {'total': total}}, status=200,
+                       reason='Successful Response')
+
+    @swagger_auto_schema(
+        request_body=CreateCityModel,
+        tags=['admin'],
+        operation_id='private_create_city_cities_post',
+        operation_summary='Создание города',
+        operation_description='Новый город становится доступен для выбора у пользователей',
+        responses={201: openapi.Response('Successful Response', CityModel),
+                   401: openapi.Response('Unauthorized',
+                                         openapi.Schema(title='Response 401 Private Create City Cities Post',
+                                                        type=openapi.TYPE_STRING)),
+                   403: openapi.Response('Forbidden',
+                                         openapi.Schema(title='Response 403 Private Create City Cities Post',
+                                                        type=openapi.TYPE_STRING)),
+                   413: openapi.Response('Request Entity Too Large', ErrorResponseModel),
+                   422: openapi.Response('Validation Error', HTTPValidationError),
+                   }
+    )
+    def post(self, request):
+        user = try_authorization(request)  # error response will return, when can't get user
+        if isinstance(user, HttpResponse):
+            return user
+
+        if not user.is_admin:
+            return respond(request, status=403,
+                           data={'code': 10, 'msg': 'only admins can access this info'},
+                           reason='Forbidden')
+
+        ser = validate_request(request, CreateCitySerializer, 'CityList.post')
+        if isinstance(ser, HttpResponse):
+            return ser
+
+        city = run_write(ser.save)
+        return respond(request, data={'id': city.id, 'name': city.name}, status=201, reason='Successful Response')
+
+
+class CityDetail(APIView):
+    @swagger_auto_schema(
+        request_body=CreateCityModel,
+        tags=['admin'],
+        operation_id='private_rename_city_cities__pk__patch',
+        operation_summary='Переименование города',
+        operation_description='Новое название копируется пользователям города фоновой задачей rename_city',
+        responses={200: openapi.Response('Successful Response', RenameCityResponseModel),
+                   401: openapi.Response('Unauthorized',
+                                         openapi.Schema(title='Response 401 Private Rename City Cities  Pk  Patch',
+                                                        type=openapi.TYPE_STRING)),
+                   403: openapi.Response('Forbidden',
+                                         openapi.Schema(title='Response 403 Private Rename City Cities  Pk  Patch',
+                                                        type=openapi.TYPE_STRING)),
+                   404: openapi.Response('Not Found',
+                                         openapi.Schema(title='Response 404 Private Rename City Cities  Pk  Patch',
+                                                        type=openapi.TYPE_STRING)),
+                   413: openapi.Response('Request Entity Too Large', ErrorResponseModel),
+                   422: openapi.Response('Validation Error', HTTPValidationError),
+                   }
+    )
+    def patch(self, request, pk):
+        user = try_authorization(request)  # error response will return, when can't get user
+        if isinstance(user, HttpResponse):
+            return user
+
+        if not user.is_admin:
+            return respond(request, status=403,
+                           data={'code': 10, 'msg': 'only admins can access this info'},
+                           reason='Forbidden')
+
+        city = City.objects.filter(id=pk).first()
+        if city is None:
+            return respond(request, status=404, data={'code': 8, 'message': 'City with such id doesn\'t exist'},
+                           reason='Not Found')
+
+        ser = validate_request(request, CreateCitySerializer, 'CityDetail.patch', instance=city)
+        if isinstance(ser, HttpResponse):
+            return ser
+
+        def rename():
+            ser.save()
+            return Job.objects.create(kind='rename_city', params={'city': city.id})  # users are updated by run_jobs
+
+        job = run_write(rename)
+        return respond(request, data={'id': city.id, 'name': city.name, 'job': job.id}, status=200,
+                       reason='Successful Response')
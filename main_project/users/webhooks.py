@@ -0,0 +1,62 @@
+import datetime
+import json
+import logging
+import urllib.request
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import Q
+from django.utils import timezone
+
+from .changes import committed_changes
+from .models import WebhookSubscription
+
+logger = logging.getLogger(__name__)
+
+
+def post_json(url, data):
+    """
+    raises on network errors and on non 2xx responses (urllib raises HTTPError for them)
+    """
+    body = json.dumps(data, cls=DjangoJSONEncoder).encode('utf-8')
+    request = urllib.request.Request(url, data=body, method='POST', headers={'Content-Type': 'application/json'})
+    with urllib.request.urlopen(request, timeout=settings.USERS_WEBHOOK_TIMEOUT):
+        pass
+
+
+def retry_delay(failures):
+    """
+    exponential backoff: 2, 4, 8 ... seconds, but not more than USERS_WEBHOOK_MAX_RETRY_DELAY
+    """
+    return datetime.timedelta(seconds=min(2 ** failures, settings.USERS_WEBHOOK_MAX_RETRY_DELAY))
+
+
+def deliver_pending(batch_size, send=post_json):
+    """
+    sends one batch of undelivered changes to every subscription which is due,
+    returns number of delivered changes
+    """
+    now = timezone.now()
+    delivered = 0
+    subscriptions = WebhookSubscription.objects.filter(is_active=True).filter(Q(retry_at__isnull=True) |
+                                                                               Q(retry_at__lte=now))
+    for subscription in subscriptions:
+        changes = committed_changes(subscription.last_seq, batch_size)
+        if not changes:
+            continue
+
+        try:
+            send(subscription.url, {'data': [change.get_change_model() for change in changes]})
+        except Exception:
+            logger.warning('webhook delivery to %s failed', subscription.url, exc_info=True)
+            subscription.failures += 1
+            subscription.retry_at = now + retry_delay(subscription.failures)
+        else:
+            subscription.last_seq = changes[-1].id
+            subscription.failures = 0
+            subscription.retry_at = None
+            delivered += len(changes)
+
+        subscription.save(update_fields=['last_seq', 'failures', 'retry_at'])
+
+    return delivered
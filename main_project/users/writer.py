@@ -0,0 +1,120 @@
+"""
+single writer for sqlite deployments (USERS_WRITE_COORDINATOR). Sqlite lets one connection write at a time,
+so concurrent writes of several workers fail with "database is locked" once busy timeout runs out.
+With the coordinator on, views hand their writes to one thread per process, which takes a file lock shared by all
+workers and commits every write waiting in its queue in one transaction (group commit)
+"""
+import fcntl
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from contextlib import contextmanager
+from functools import lru_cache
+
+from django.conf import settings
+from django.db import close_old_connections, connection
+
+from . import sharding
+
+
+class WriteCoordinator:
+    """
+    writes are callables run by the writer thread, each one in its own savepoint of the batch transaction,
+    so a failing write (e.g. IntegrityError) doesn't roll back the others. Results and exceptions are handed
+    to waiting requests only after the batch is committed, and on_commit callbacks have run
+    """
+
+    def __init__(self, lock_path, max_batch, max_delay):
+        self.lock_path = lock_path
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self._queue = queue.SimpleQueue()
+        self._thread = None
+        self._start_lock = threading.Lock()
+        self._file = None
+        self._pid = None
+
+    def submit(self, write):
+        future = Future()
+        self._queue.put((write, future))
+        if self._thread is None or not self._thread.is_alive():  # forked workers don't inherit threads
+            with self._start_lock:
+                if self._thread is None or not self._thread.is_alive():
+                    self._thread = threading.Thread(target=self._run, name='users-writer', daemon=True)
+                    self._thread.start()
+
+        return future
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            try:
+                results = self._commit(batch)
+            except Exception as error:  # commit itself failed, none of the writes is applied
+                close_old_connections()  # drops the connection if it became unusable
+                results = [(None, error)] * len(batch)
+
+            for (_, future), (result, error) in zip(batch, results):
+                if error is None:
+                    future.set_result(result)
+                else:
+                    future.set_exception(error)
+
+    def _next_batch(self):
+        """
+        blocks for the first write, then takes what is queued meanwhile, waiting up to max_delay seconds for more
+        """
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.max_delay
+        while len(batch) < self.max_batch:
+            try:
+                batch.append(self._queue.get(timeout=max(deadline - time.monotonic(), 0)))
+            except queue.Empty:
+                break
+
+        return batch
+
+    def _commit(self, batch):
+        results = []
+        with self._locked(), sharding.atomic():
+            for write, _ in batch:
+                try:
+                    with sharding.atomic():
+                        results.append((write(), None))
+                except Exception as error:
+                    results.append((None, error))
+
+        return results
+
+    @contextmanager
+    def _locked(self):
+        if self._pid != os.getpid():  # forked worker must not share open file description (and its flock) with parent
+            self._file = open(self.lock_path, 'a+b')
+            self._pid = os.getpid()
+        fcntl.flock(self._file.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(self._file.fileno(), fcntl.LOCK_UN)
+
+
+@lru_cache(maxsize=None)
+def get_write_coordinator():
+    config = settings.USERS_WRITE_COORDINATOR
+    return WriteCoordinator(config['LOCK_PATH'], config['MAX_BATCH'], config['MAX_DELAY'])
+
+
+def run_write(write):
+    """
+    runs write() in a transaction (on shards of users too, see sharding.atomic) and returns its result,
+    exceptions of write() are raised here.
+    Goes through the coordinator when it is enabled, unless the caller is already in a transaction
+    (its writes have to stay in it)
+    """
+    if not settings.USERS_WRITE_COORDINATOR['ENABLED'] or connection.in_atomic_block:
+        with sharding.atomic():
+            return write()
+
+    return get_write_coordinator().submit(write).result()